@@ -57,7 +57,10 @@ class ResponsesHandler(handlers.TemplateHandler):
         entities.append(e)
 
     entities.sort(key=lambda e: (e.source, e.activities, e.response))
-    return {'responses': entities}
+    return {
+      'responses': entities,
+      'endpoint_cache_stats': util.webmention_endpoint_cache.total_stats(),
+    }
 
 
 class SourcesHandler(handlers.TemplateHandler):
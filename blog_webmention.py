@@ -34,7 +34,7 @@ class BlogWebmentionHandler(webmention.WebmentionHandler):
     self.target_url = urlparse.urldefrag(util.get_required_param(self, 'target'))[0]
 
     # follow target url through any redirects, strip utm_* query params
-    resp = util.follow_redirects(self.target_url)
+    resp = util.redirect_cache.resolve(self.target_url)
     redirected_target_urls = [r.url for r in resp.history]
     self.target_url = util.clean_url(resp.url)
 
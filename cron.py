@@ -42,6 +42,18 @@ class ReplacePollTasks(webapp2.RequestHandler):
         util.add_poll_task(source)
 
 
+class PollBatches(webapp2.RequestHandler):
+  """Adds a poll-batch task for each silo that polls in batches.
+
+  See :class:`tasks.BatchPoll`.
+  """
+
+  def get(self):
+    for cls in models.sources.values():
+      if cls.BATCH_POLL:
+        util.add_poll_batch_task(cls.SHORT_NAME)
+
+
 class UpdateTwitterPictures(webapp2.RequestHandler):
   """Finds :class:`Twitter` sources with new profile pictures and updates them.
 
@@ -200,6 +212,7 @@ class DatastoreBackup(webapp2.RequestHandler):
 
 application = webapp2.WSGIApplication([
     ('/cron/replace_poll_tasks', ReplacePollTasks),
+    ('/cron/poll_batches', PollBatches),
     ('/cron/update_twitter_pictures', UpdateTwitterPictures),
     ('/cron/update_instagram_pictures', UpdateInstagramPictures),
     ('/cron/update_flickr_pictures', UpdateFlickrPictures),
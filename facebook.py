@@ -85,6 +85,9 @@ class FacebookPage(models.Source):
 
   GR_CLASS = gr_facebook.Facebook
   SHORT_NAME = 'facebook'
+  # the Graph API allows 200 calls per user per hour, and polls make several.
+  # https://developers.facebook.com/docs/graph-api/advanced/rate-limiting
+  TOKEN_RATE_LIMIT = (40, datetime.timedelta(hours=1))
 
   URL_CANONICALIZER = util.UrlCanonicalizer(
     domain=GR_CLASS.DOMAIN,
@@ -154,6 +154,12 @@ class ItemHandler(util.Handler):
       logging.info('Using cached object for %s', label)
     else:
       logging.info('Fetching %s', label)
+      delay = self.source.rate_limit_delay()
+      if delay:
+        self.abort(429, 'Over %s rate limit budget, try again later' %
+                   self.source.GR_CLASS.NAME,
+                   headers={'Retry-After': str(int(delay.total_seconds()) + 1)})
+
       try:
         obj = self.get_item(*ids)
       except models.DisableSource as e:
@@ -163,6 +169,8 @@ class ItemHandler(util.Handler):
       except Exception as e:
         # pass through all API HTTP errors if we can identify them
         code, body = util.interpret_http_exception(e)
+        if code in self.source.RATE_LIMIT_HTTP_CODES:
+          self.source.record_rate_limit(e)
         # temporary, trying to debug a flaky test failure
         # eg https://circleci.com/gh/snarfed/bridgy/769
         if code:
@@ -50,6 +50,9 @@ class Instagram(Source):
   FAST_POLL = datetime.timedelta(minutes=120)
   RATE_LIMITED_POLL = Source.SLOW_POLL
   RATE_HTTP_LIMIT_CODES = Source.RATE_LIMIT_HTTP_CODES + ('503',)
+  # we scrape Instagram's HTML, which it rate limits by IP, not by access token,
+  # so all sources share one budget.
+  SILO_RATE_LIMIT = (500, datetime.timedelta(hours=1))
 
   URL_CANONICALIZER = util.UrlCanonicalizer(
     domain=GR_CLASS.DOMAIN,
@@ -2,15 +2,17 @@
 """
 from __future__ import unicode_literals
 
+import collections
+import copy
 import datetime
 import json
 import logging
 import re
+import threading
 
 import appengine_config
 from appengine_config import HTTP_TIMEOUT
 
-from google.appengine.api import memcache
 from granary import microformats2
 from granary import source as gr_source
 from oauth_dropins.webutil.models import StringIdModel
@@ -20,6 +22,7 @@ from webmentiontools import send
 import superfeedr
 import util
 
+from google.appengine.api.datastore import MAX_ALLOWABLE_QUERIES
 from google.appengine.ext import ndb
 
 VERB_TYPES = ('post', 'comment', 'like', 'react', 'repost', 'rsvp', 'tag')
@@ -29,6 +32,21 @@ MAX_AUTHOR_URLS = 5
 
 REFETCH_HFEED_TRIGGER = datetime.datetime.utcfromtimestamp(-1)
 
+# refetch skips h-entries that haven't changed in the h-feed since the last
+# time we processed them, *unless* we'd have to fetch their permalinks to find
+# their syndication links. those often get added after they're published, so
+# we keep refetching them until they've been unchanged for this long.
+REFETCH_UNCHANGED_PERMALINKS_FOR = datetime.timedelta(days=7)
+HFEED_ENTRY_HASH_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# max number of entity groups in a cross-group transaction
+MAX_XG_ENTITY_GROUPS = 25
+
+# max number of staged SyndicatedPost changes that SyndicatedPostIndex commits in
+# one transaction. each insert can also delete up to two blanks, so this keeps
+# us well under the datastore's limit of 500 writes per commit.
+MAX_SYNDICATED_POST_BATCH = 100
+
 # maps string short name to Source subclass. populated by SourceMeta.
 sources = {}
 
@@ -95,16 +113,41 @@ class Source(StringIdModel):
   # how long to wait after signup for a successful webmention before dropping to
   # the lower frequency poll
   FAST_POLL_GRACE_PERIOD = datetime.timedelta(days=7)
+  # bounds for the poll period when we have an estimate of how often this
+  # source gets new responses. see poll_period().
+  ADAPTIVE_POLL_MIN = FAST_POLL
+  ADAPTIVE_POLL_MAX = SLOW_POLL
+  # we aim to find this many new responses per poll, on average
+  ADAPTIVE_POLL_TARGET_RESPONSES = 1.0
+  # don't use the response rate estimates until they include this many polls
+  ADAPTIVE_POLL_MIN_OBSERVATIONS = 10
+  # weight of each hour covered by the newest observation in the response rate
+  # moving averages
+  POLL_RATE_EWMA_ALPHA = .05
   # how often refetch author url to look for updated syndication links
   FAST_REFETCH = datetime.timedelta(hours=6)
   # refetch less often (this often) if it's been >2w since the last synd link
   SLOW_REFETCH = datetime.timedelta(days=2)
+  # refetch this often, as a fallback, while we're subscribed to the author's
+  # h-feeds with WebSub. see websub.py and should_refetch().
+  WEBSUB_REFETCH = datetime.timedelta(days=7)
+  WEBSUB_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
   # rate limiting HTTP status codes returned by this silo. e.g. twitter returns
   # 429, instagram 503, google+ 403.
   # TODO: facebook. it returns 200 and reports the error in the response.
   # https://developers.facebook.com/docs/reference/ads-api/api-rate-limiting/
   RATE_LIMIT_HTTP_CODES = ('429',)
   DISABLE_HTTP_CODES = ('401',)
+  # token bucket budgets for calls to this silo, as (number of calls,
+  # datetime.timedelta) tuples, or None for no budget. SILO_RATE_LIMIT is shared
+  # by all of this silo's sources, TOKEN_RATE_LIMIT is per access token. see
+  # rate_limit_delay().
+  SILO_RATE_LIMIT = None
+  TOKEN_RATE_LIMIT = None
+
+  # whether to poll this silo's sources in batches, via the poll-pull queue and
+  # tasks.BatchPoll, instead of one poll task per source
+  BATCH_POLL = False
 
   # whether to require a u-syndication link for backfeed
   BACKFEED_REQUIRES_SYNDICATION_LINK = False
@@ -159,10 +202,36 @@ class Source(StringIdModel):
   # the last time we saw a syndication link in an h-feed, as opposed to just on
   # permalinks. background: https://github.com/snarfed/bridgy/issues/624
   last_feed_syndication_url = ndb.DateTimeProperty()
+  # JSON dict mapping author URL to dict mapping h-entry permalink to
+  # [hash, time first seen with that hash] for each entry in the author's
+  # h-feed(s) that original post discovery processed last time. see
+  # original_post_discovery._process_author().
+  hfeed_entry_hashes_json = ndb.TextProperty(compressed=True)
+
+  # WebSub subscriptions to the author's h-feeds, one per topic, since each
+  # author URL may have its own hub. JSON dict mapping topic URL to [author URL,
+  # hub URL, time we last asked the hub to subscribe us, time the hub says it
+  # expires or null until it verifies it]. when a hub notifies us that a topic
+  # changed, we refetch on the next poll. see websub.py.
+  websub_subscriptions_json = ndb.TextProperty()
+  # shared by all of the subscriptions
+  websub_secret = ndb.StringProperty()
+
+  # exponentially weighted moving average of new responses per hour, overall
+  # and for each hour of the day (UTC), and the number of polls they include.
+  # updated by record_poll_responses().
+  poll_response_rate = ndb.FloatProperty()
+  poll_hourly_response_rates = ndb.FloatProperty(repeated=True)
+  poll_response_observations = ndb.IntegerProperty(default=0)
 
   last_activity_id = ndb.StringProperty()
   last_activities_etag = ndb.StringProperty()
   last_activities_cache_json = ndb.TextProperty()
+  # JSON dict mapping id to util.activity_fingerprint() for each response we
+  # saw in the last poll that found new responses.
+  seen_response_fingerprints_json = ndb.TextProperty(compressed=True)
+  # deprecated, replaced by seen_response_fingerprints_json. JSON list of
+  # pruned response objects.
   seen_responses_cache_json = ndb.TextProperty(compressed=True)
 
   # maps updated property names to values that put_updates() writes back to the
@@ -187,24 +256,31 @@ class Source(StringIdModel):
     :attr:`gr_source` will be returned normally.
     """
     if name == 'gr_source' and self.auth_entity:
-      auth_entity = self.auth_entity.get()
-      token = auth_entity.access_token()
-      if not isinstance(token, tuple):
-        token = (token,)
-
-      kwargs = {}
-      if self.key.kind() == 'FacebookPage' and auth_entity.type == 'user':
-        kwargs = {'user_id': self.key.id()}
-      elif self.key.kind() == 'Instagram':
-        kwargs = {'scrape': True, 'cookie': appengine_config.INSTAGRAM_SESSIONID_COOKIE}
-      elif self.key.kind() == 'Twitter':
-        kwargs = {'username': self.key.id()}
-
-      self.gr_source = self.GR_CLASS(*token, **kwargs)
-      return self.gr_source
+      return self.load_gr_source(self.auth_entity.get())
 
     return getattr(super(Source, self), name)
 
+  def load_gr_source(self, auth_entity):
+    """Instantiates and returns :attr:`self.gr_source` from an auth entity.
+
+    Args:
+      auth_entity: oauth-dropins auth entity for :attr:`self.auth_entity`
+    """
+    token = auth_entity.access_token()
+    if not isinstance(token, tuple):
+      token = (token,)
+
+    kwargs = {}
+    if self.key.kind() == 'FacebookPage' and auth_entity.type == 'user':
+      kwargs = {'user_id': self.key.id()}
+    elif self.key.kind() == 'Instagram':
+      kwargs = {'scrape': True, 'cookie': appengine_config.INSTAGRAM_SESSIONID_COOKIE}
+    elif self.key.kind() == 'Twitter':
+      kwargs = {'username': self.key.id()}
+
+    self.gr_source = self.GR_CLASS(*token, **kwargs)
+    return self.gr_source
+
   @classmethod
   def lookup(cls, id):
     """Returns the entity with the given id.
@@ -252,21 +328,65 @@ class Source(StringIdModel):
     if not source.updates:
       return source
 
+    source = cls._apply_updates(source, source.key.get())
+    source.put()
+    return source
+
+  @classmethod
+  def put_updates_multi(cls, sources):
+    """Writes each source's updates to the datastore, in batched transactions.
+
+    Cross-group transactions can only include 25 entity groups, so this uses
+    one transaction per :const:`MAX_XG_ENTITY_GROUPS` sources.
+
+    Args:
+      sources: sequence of :class:`Source`
+
+    Returns:
+      list of the updated :class:`Source`\ s, in the same order
+    """
+    updated = []
+    for i in xrange(0, len(sources), MAX_XG_ENTITY_GROUPS):
+      updated.extend(cls._put_updates_batch(sources[i:i + MAX_XG_ENTITY_GROUPS]))
+    return updated
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def _put_updates_batch(cls, sources):
+    to_update = [source for source in sources if source.updates]
+    updated = {}
+    for source, stored in zip(to_update,
+                              ndb.get_multi([s.key for s in to_update])):
+      stored = cls._apply_updates(source, stored)
+      # keep the already loaded granary source, if any
+      if 'gr_source' in source.__dict__:
+        stored.gr_source = source.gr_source
+      updated[source.key] = stored
+
+    ndb.put_multi(updated.values())
+    return [updated.get(source.key, source) for source in sources]
+
+  @staticmethod
+  def _apply_updates(source, stored):
+    """Sets source.updates on the stored copy of source and returns it.
+
+    Args:
+      source: :class:`Source`, with :attr:`updates` populated
+      stored: :class:`Source`, the same entity freshly loaded from the datastore
+    """
     logging.info('Updating %s %s : %r', source.label(), source.bridgy_path(),
                  {k: v for k, v in source.updates.items() if not k.endswith('_json')})
 
     updates = source.updates
-    source = source.key.get()
-    source.updates = updates  # because FacebookPage._pre_put_hook uses it
+    stored.updates = updates  # because FacebookPage._pre_put_hook uses it
     for name, val in updates.items():
-      setattr(source, name, val)
+      setattr(stored, name, val)
 
-    if source.status == 'error':  # deprecated
+    if stored.status == 'error':  # deprecated
       logging.warning('Resetting status from error to enabled')
-      source.status = 'enabled'
+      stored.status = 'enabled'
 
-    source.put()
-    return source
+    return stored
 
   def poll_period(self):
     """Returns the poll frequency for this source, as a :class:`datetime.timedelta`.
@@ -274,13 +394,36 @@ class Source(StringIdModel):
     Defaults to ~15m, depending on silo. If we've never sent a webmention for
     this source, or the last one we sent was over a month ago, we drop them down
     to ~1d after a week long grace period.
+
+    After the grace period, once we have an estimate of how often this source
+    gets new responses at this time of day that includes at least
+    :attr:`ADAPTIVE_POLL_MIN_OBSERVATIONS` polls, we poll often enough to find
+    about :attr:`ADAPTIVE_POLL_TARGET_RESPONSES` per poll, between
+    :attr:`ADAPTIVE_POLL_MIN` and :attr:`ADAPTIVE_POLL_MAX`. We never poll less
+    often than the last webmention sent implies, though, so that active users
+    don't wait.
     """
     now = datetime.datetime.now()
     if self.rate_limited:
       return self.RATE_LIMITED_POLL
     elif now < self.created + self.FAST_POLL_GRACE_PERIOD:
       return self.FAST_POLL
-    elif not self.last_webmention_sent:
+
+    period = self._webmention_poll_period(now)
+    if (self.poll_response_rate is not None and
+        self.poll_response_observations >= self.ADAPTIVE_POLL_MIN_OBSERVATIONS):
+      rate = self.poll_response_rate
+      if len(self.poll_hourly_response_rates) == 24:
+        rate = max(rate, self.poll_hourly_response_rates[now.hour])
+      adaptive = (datetime.timedelta(hours=self.ADAPTIVE_POLL_TARGET_RESPONSES / rate)
+                  if rate > 0 else self.ADAPTIVE_POLL_MAX)
+      period = min(max(adaptive, self.ADAPTIVE_POLL_MIN), self.ADAPTIVE_POLL_MAX,
+                   period)
+    return period
+
+  def _webmention_poll_period(self, now):
+    """Returns the poll period implied by when we last sent a webmention."""
+    if not self.last_webmention_sent:
       return self.SLOW_POLL
     elif self.last_webmention_sent > now - datetime.timedelta(days=7):
       return self.FAST_POLL
@@ -289,6 +432,118 @@ class Source(StringIdModel):
     else:
       return self.SLOW_POLL
 
+  def seen_response_fingerprints(self):
+    """Returns the responses we've already seen, as a fingerprint index.
+
+    Falls back to the deprecated :attr:`seen_responses_cache_json` if we haven't
+    stored any fingerprints yet.
+
+    Returns:
+      dict mapping string response id to :func:`util.activity_fingerprint`
+    """
+    if self.seen_response_fingerprints_json:
+      return json.loads(self.seen_response_fingerprints_json)
+    elif self.seen_responses_cache_json:
+      return {seen['id']: util.activity_fingerprint(seen)
+              for seen in json.loads(self.seen_responses_cache_json)}
+    return {}
+
+  def record_poll_responses(self, num_responses):
+    """Updates the response rate estimates that :meth:`poll_period` uses.
+
+    Stores the new values in :attr:`updates`. Does nothing if we don't know
+    when the previous successful poll was.
+
+    Each observation is weighted by how many hours it covers, so that the
+    estimates change at the same speed no matter how often we poll. The first
+    one starts from the rate that the last webmention sent implies, not from
+    zero, since most polls find nothing.
+
+    Args:
+      num_responses: integer, number of new or changed responses found by the
+        current poll, which started at :attr:`last_poll_attempt`
+    """
+    if not self.last_polled or self.last_polled <= util.EPOCH:
+      return
+
+    hours = (self.last_poll_attempt - self.last_polled).total_seconds() / 3600
+    if hours <= 0:
+      return
+
+    observed = num_responses / hours
+    weight = 1 - (1 - self.POLL_RATE_EWMA_ALPHA) ** hours
+
+    def ewma(old):
+      return weight * observed + (1 - weight) * old
+
+    old_rate = self.poll_response_rate
+    if old_rate is None:
+      seed_period = self._webmention_poll_period(self.last_poll_attempt)
+      old_rate = (self.ADAPTIVE_POLL_TARGET_RESPONSES /
+                  (seed_period.total_seconds() / 3600))
+    self.updates['poll_response_rate'] = ewma(old_rate)
+
+    hourly = list(self.poll_hourly_response_rates)
+    if len(hourly) != 24:
+      hourly = [old_rate] * 24
+    hour = self.last_poll_attempt.hour
+    hourly[hour] = ewma(hourly[hour])
+    self.updates['poll_hourly_response_rates'] = hourly
+    self.updates['poll_response_observations'] = self.poll_response_observations + 1
+
+  def _rate_limit_buckets(self):
+    """Returns the :class:`util.TokenBucket`\ s for this source's silo calls.
+
+    The per access token bucket comes first. The silo bucket is omitted if it
+    has no budget and this source has an access token, since
+    :meth:`record_rate_limit` only pauses it for sources without one. That saves
+    a memcache round trip per call.
+    """
+    buckets = []
+    if self.auth_entity:
+      buckets.append(util.TokenBucket(
+        'token %s' % self.auth_entity.urlsafe(), *(self.TOKEN_RATE_LIMIT or ())))
+    if self.SILO_RATE_LIMIT or not buckets:
+      buckets.append(util.TokenBucket(
+        'silo %s' % self.SHORT_NAME, *(self.SILO_RATE_LIMIT or ())))
+    return buckets
+
+  def rate_limit_delay(self):
+    """Spends one call from this source's silo rate limit budgets, if available.
+
+    Call this before polling, fetching a post, etc. If it returns a nonzero
+    delay, do the work later instead.
+
+    Returns:
+      :class:`datetime.timedelta`, zero if it's ok to call the silo now,
+      otherwise how long to wait
+    """
+    for bucket in self._rate_limit_buckets():
+      delay = bucket.take()
+      if delay:
+        logging.info('Over rate limit budget %s for %s', bucket.key, delay)
+        return delay
+    return datetime.timedelta(0)
+
+  def record_rate_limit(self, exception):
+    """Pauses this source's silo calls after the silo rate limited us.
+
+    If the silo said when its rate limit resets, pauses this source's access
+    token's budget until then. Sources without an access token pause the whole
+    silo.
+
+    Args:
+      exception: the exception from the rate limited silo call
+
+    Returns:
+      :class:`datetime.datetime` when the rate limit resets, or None if unknown
+    """
+    reset = util.rate_limit_reset(exception)
+    if reset:
+      logging.info('Rate limited until %s', reset)
+      self._rate_limit_buckets()[0].pause_until(reset)
+    return reset
+
   def should_refetch(self):
     """Returns True if we should run OPD refetch on this source now."""
     now = datetime.datetime.now()
@@ -297,11 +552,71 @@ class Source(StringIdModel):
     elif not self.last_syndication_url:
       return False
 
-    period = (self.FAST_REFETCH
-              if self.last_syndication_url > now - datetime.timedelta(days=14)
-              else self.SLOW_REFETCH)
+    if self._websub_covers_hfeeds(now):
+      # the hubs will tell us when the h-feeds change
+      period = self.WEBSUB_REFETCH
+    else:
+      period = (self.FAST_REFETCH
+                if self.last_syndication_url > now - datetime.timedelta(days=14)
+                else self.SLOW_REFETCH)
     return self.last_poll_attempt >= self.last_hfeed_refetch + period
 
+  def _websub_covers_hfeeds(self, now):
+    """Returns True if WebSub will tell us everything refetch could find.
+
+    That's when we have a live subscription for every author URL we've
+    processed, and none of their h-entries are recent enough that their
+    permalinks may still get syndication links without their h-feeds changing.
+    See :const:`REFETCH_UNCHANGED_PERMALINKS_FOR`.
+
+    Args:
+      now: :class:`datetime.datetime`
+    """
+    subscribed = set(author_url for author_url, _, _, expires
+                     in self.websub_subscriptions().values()
+                     if expires and expires > now)
+    if not subscribed:
+      return False
+
+    hashes = json.loads(self.hfeed_entry_hashes_json or '{}')
+    if not set(hashes) <= subscribed:
+      return False
+
+    settled = (now - REFETCH_UNCHANGED_PERMALINKS_FOR).strftime(
+      HFEED_ENTRY_HASH_TIME_FORMAT)
+    return all(first_seen <= settled for entries in hashes.values()
+               for _, first_seen in entries.values())
+
+  def websub_subscriptions(self):
+    """Returns this source's WebSub subscriptions.
+
+    Returns:
+      dict mapping string topic URL to (string author URL, string hub URL,
+      :class:`datetime.datetime` requested, :class:`datetime.datetime` expires
+      or None) tuple
+    """
+    def parse(time):
+      return (datetime.datetime.strptime(time, self.WEBSUB_TIME_FORMAT)
+              if time else None)
+
+    return {topic: (author_url, hub, parse(requested), parse(expires))
+            for topic, (author_url, hub, requested, expires)
+            in json.loads(self.websub_subscriptions_json or '{}').items()}
+
+  def set_websub_subscriptions(self, subscriptions):
+    """Stores WebSub subscriptions. Only sets them; doesn't put() the entity!
+
+    Args:
+      subscriptions: dict, same format as :meth:`websub_subscriptions` returns
+    """
+    def unparse(time):
+      return time.strftime(self.WEBSUB_TIME_FORMAT) if time else None
+
+    self.websub_subscriptions_json = json.dumps({
+      topic: [author_url, hub, unparse(requested), unparse(expires)]
+      for topic, (author_url, hub, requested, expires) in subscriptions.items()
+    }, sort_keys=True) if subscriptions else None
+
   @classmethod
   def bridgy_webmention_endpoint(cls, domain='brid.gy'):
     """Returns the Bridgy webmention endpoint for this source type."""
@@ -455,7 +770,8 @@ class Source(StringIdModel):
       source.populate(**existing.to_dict(include=(
             'created', 'last_hfeed_refetch', 'last_poll_attempt', 'last_polled',
             'last_syndication_url', 'last_webmention_sent', 'superfeedr_secret',
-            'webmention_endpoint')))
+            'webmention_endpoint', 'websub_subscriptions_json',
+            'websub_secret')))
       verb = 'Updated'
     else:
       verb = 'Added'
@@ -730,6 +1046,13 @@ class Webmentions(StringIdModel):
   failed = ndb.StringProperty(repeated=True)
   skipped = ndb.StringProperty(repeated=True)
 
+  # Retry ledger for targets that errored. JSON dict mapping target URL to
+  # [int number of attempts, ISO 8601 time it's next due, or null if we've
+  # given up]. See :meth:`tasks.SendWebmentions._prepare_targets`.
+  retries_json = ndb.TextProperty()
+
+  RETRY_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
   def label(self):
     """Returns a human-readable string description for use in log messages.
 
@@ -744,24 +1067,39 @@ class Webmentions(StringIdModel):
     """
     raise NotImplementedError()
 
+  def retries(self):
+    """Returns the retry ledger.
+
+    Returns:
+      dict mapping string target URL to (integer attempts,
+      :class:`datetime.datetime` next due time or None) tuple
+    """
+    return {url: (attempts, datetime.datetime.strptime(
+                              next, self.RETRY_TIME_FORMAT) if next else None)
+            for url, (attempts, next)
+            in json.loads(self.retries_json or '{}').items()}
+
+  def set_retries(self, retries):
+    """Stores the retry ledger. Only sets it; doesn't put() the entity!
+
+    Args:
+      retries: dict, same format as :meth:`retries` returns
+    """
+    self.retries_json = json.dumps({
+      url: [attempts, next.strftime(self.RETRY_TIME_FORMAT) if next else None]
+      for url, (attempts, next) in retries.items()}) if retries else None
+
   @ndb.transactional(xg=True)
   def get_or_save(self):
     existing = self.key.get()
     if existing:
       return existing
 
-    # TODO(ryan): take this out eventually. (and the xg=Trues!) background:
-    # https://github.com/snarfed/bridgy/issues/305#issuecomment-94004416
-    resp_json = getattr(self, 'response_json', None)
-    if resp_json:
-      resp = json.loads(resp_json)
-      fb_id = resp.get('fb_id')
-      if fb_id:
-        tag_fb_id = 'tag:facebook.com,2013:' + fb_id
-        if tag_fb_id != resp.get('id'):
-          resp = Response.get_by_id(tag_fb_id)
-          if resp:
-            return resp
+    fb_key = self.legacy_fb_key()
+    if fb_key:
+      resp = fb_key.get()
+      if resp:
+        return resp
 
     if self.unsent or self.error:
       logging.debug('New webmentions to propagate! %s', self.label())
@@ -772,16 +1110,24 @@ class Webmentions(StringIdModel):
     self.put()
     return self
 
+  def legacy_fb_key(self):
+    """Returns the key of this response's Facebook id based entity, or None.
+
+    TODO(ryan): take this out eventually. (and the xg=Trues!) background:
+    https://github.com/snarfed/bridgy/issues/305#issuecomment-94004416
+    """
+    resp_json = getattr(self, 'response_json', None)
+    if resp_json:
+      resp = json.loads(resp_json)
+      fb_id = resp.get('fb_id')
+      if fb_id:
+        tag_fb_id = 'tag:facebook.com,2013:' + fb_id
+        if tag_fb_id != resp.get('id'):
+          return ndb.Key(Response, tag_fb_id)
+
   def restart(self):
     """Moves status and targets to 'new' and adds a propagate task."""
-    self.status = 'new'
-    self.unsent = util.dedupe_urls(self.unsent + self.sent + self.error +
-                                   self.failed + self.skipped)
-    self.sent = self.error = self.failed = self.skipped = []
-
-    # clear any cached webmention endpoints
-    memcache.delete_multi(util.webmention_endpoint_cache_key(url)
-                          for url in self.unsent)
+    self.reset_targets()
 
     @ndb.transactional
     def finish():
@@ -790,6 +1136,22 @@ class Webmentions(StringIdModel):
 
     finish()
 
+  def reset_targets(self, clear_endpoints=True):
+    """Moves status and targets to 'new'. Doesn't store or add a task.
+
+    Args:
+      clear_endpoints: boolean, whether to clear the targets' cached webmention
+        endpoints. Pass False to clear them yourself, e.g. in a batch.
+    """
+    self.status = 'new'
+    self.unsent = util.dedupe_urls(self.unsent + self.sent + self.error +
+                                   self.failed + self.skipped)
+    self.sent = self.error = self.failed = self.skipped = []
+    self.retries_json = None
+
+    if clear_endpoints:
+      util.webmention_endpoint_cache.delete(self.unsent)
+
 
 class Response(Webmentions):
   """A comment, like, or repost to be propagated.
@@ -827,23 +1189,118 @@ class Response(Webmentions):
   def get_or_save(self, source, restart=False):
     resp = super(Response, self).get_or_save()
 
-    if (self.type != resp.type or
-        source.gr_source.activity_changed(json.loads(resp.response_json),
-                                         json.loads(self.response_json),
-                                         log=True)):
-      logging.info('Response changed! Re-propagating. Original: %s' % resp)
-      resp.old_response_jsons = resp.old_response_jsons[:10] + [resp.response_json]
-      resp.response_json = self.response_json
+    if self._changed_from(resp, source):
       resp.restart(source)
     elif restart and resp is not self:  # ie it already existed
       resp.restart(source)
 
     return resp
 
+  @classmethod
+  def get_or_save_multi(cls, responses, source, restart=False):
+    """Batched version of :meth:`get_or_save` for many responses at once.
+
+    Loads existing entities with one :func:`ndb.get_multi`, stores new and
+    changed entities with one :func:`ndb.put_multi`, clears their targets'
+    cached webmention endpoints with one call, and adds all of their propagate
+    tasks with batched task queue calls.
+
+    Unlike :meth:`get_or_save`, this isn't transactional. If adding the tasks
+    fails, we delete the entities we just created and restore the existing ones
+    we changed, so that the next poll sees them all as new or changed again,
+    and re-raise.
+
+    Args:
+      responses: sequence of unsaved :class:`Response`\ s
+      source: :class:`Source`
+      restart: boolean, whether to restart existing responses
+
+    Returns:
+      list of stored :class:`Response`\ s, new or existing, in the same order
+    """
+    fb_keys = [resp.legacy_fb_key() for resp in responses]
+    keys = [resp.key for resp in responses] + filter(None, fb_keys)
+    existing = dict(zip(keys, ndb.get_multi(keys)))
+
+    results = []
+    to_put = collections.OrderedDict()
+    to_propagate = collections.OrderedDict()
+    created = []
+    originals = []  # copies of existing entities before we changed them
+    targets = []  # of changed responses, to clear cached endpoints
+    for resp, fb_key in zip(responses, fb_keys):
+      stored = existing.get(resp.key) or (existing.get(fb_key) if fb_key else None)
+      if not stored:
+        if resp.unsent or resp.error:
+          logging.debug('New webmentions to propagate! %s', resp.label())
+          to_propagate[resp.key] = resp
+        else:
+          resp.status = 'complete'
+        to_put[resp.key] = existing[resp.key] = resp
+        created.append(resp.key)
+        results.append(resp)
+        continue
+
+      # _changed_from() replaces these if it changed, so keep the old values
+      response_json = stored.response_json
+      old_response_jsons = stored.old_response_jsons
+      if resp._changed_from(stored, source) or restart:
+        original = copy.deepcopy(stored)
+        original.response_json = response_json
+        original.old_response_jsons = old_response_jsons
+        originals.append(original)
+        stored.add_syndicated_originals(source)
+        stored.reset_targets(clear_endpoints=False)
+        targets.extend(stored.unsent)
+        to_put[stored.key] = to_propagate[stored.key] = stored
+      results.append(stored)
+
+    if targets:
+      util.webmention_endpoint_cache.delete(targets)
+    ndb.put_multi(to_put.values())
+    try:
+      util.add_propagate_tasks(to_propagate.values())
+    except BaseException:
+      logging.warning('Adding propagate tasks failed, deleting new responses '
+                      'and restoring changed ones')
+      ndb.delete_multi(created)
+      ndb.put_multi(originals)
+      raise
+
+    return results
+
+  def _changed_from(self, existing, source):
+    """Returns True if this response differs from an existing stored one.
+
+    If so, also moves the existing entity's response_json to its
+    old_response_jsons and replaces it with this one's.
+
+    Args:
+      existing: :class:`Response`
+      source: :class:`Source`
+    """
+    if (self.type != existing.type or
+        source.gr_source.activity_changed(json.loads(existing.response_json),
+                                         json.loads(self.response_json),
+                                         log=True)):
+      logging.info('Response changed! Re-propagating. Original: %s' % existing)
+      existing.old_response_jsons = (existing.old_response_jsons[:10] +
+                                     [existing.response_json])
+      existing.response_json = self.response_json
+      return True
+
+    return False
+
   def restart(self, source=None):
     """Moves status and targets to 'new' and adds a propagate task."""
-    # add original posts with syndication URLs
-    # TODO: unify with Poll.repropagate_old_responses()
+    self.add_syndicated_originals(source)
+    return super(Response, self).restart()
+
+  def add_syndicated_originals(self, source=None):
+    """Adds original posts with syndication URLs to unsent.
+
+    TODO: unify with Poll.repropagate_old_responses()
+    """
     if not source:
       source = self.source.get()
 
@@ -861,8 +1318,6 @@ class Response(Webmentions):
                       SyndicatedPost.query(SyndicatedPost.syndication.IN(synd_urls))
                       if synd.original]
 
-    return super(Response, self).restart()
-
 
 class BlogPost(Webmentions):
   """A blog post to be processed for links to send webmentions to.
@@ -947,7 +1402,8 @@ class SyndicatedPost(ndb.Model):
   if we found no original post).  We discover the relationship by
   following rel=syndication links on the author's h-feed.
 
-  See :mod:`original_post_discovery`.
+  See :mod:`original_post_discovery`. Read and write them with
+  :class:`SyndicatedPostIndex`.
 
   When a :class:`SyndicatedPost` entity is about to be stored,
   :meth:`source.Source.on_new_syndicated_post()` is called before it's stored.
@@ -962,74 +1418,265 @@ class SyndicatedPost(ndb.Model):
   created = ndb.DateTimeProperty(auto_now_add=True)
   updated = ndb.DateTimeProperty(auto_now=True)
 
+  def _pre_put_hook(self):
+    # SyndicatedPostIndex sets _source so that batches only load it once
+    source = getattr(self, '_source', None) or self.key.parent().get()
+    source.on_new_syndicated_post(self)
+
+
+class SyndicatedPostIndex(object):
+  """An in-memory index and write-behind buffer for a source's
+  :class:`SyndicatedPost`\ s.
+
+  Loads them all with one ancestor query the first time it's used, then looks
+  them up by syndication or original URL in memory. :meth:`insert`,
+  :meth:`insert_original_blank`, :meth:`insert_syndication_blank` and
+  :meth:`delete` only stage their changes in memory. :meth:`commit` writes them
+  to the datastore in as few transactions as possible. Thread safe.
+
+  Use :meth:`for_source` to share one per :class:`Source` instance, which
+  usually lives for a single poll or task.
+  """
+  _for_source_lock = threading.Lock()
+
+  def __init__(self, source_key):
+    self.source_key = source_key
+    self._lock = threading.Lock()
+    self._pending = []  # list of (SyndicatedPost, boolean delete) tuples
+    self._reset()
+
   @classmethod
-  @ndb.transactional(xg=True)
-  def insert_original_blank(cls, source, original):
-    """Insert a new original -> None relationship. Does a check-and-set to
-    make sure no previous relationship exists for this original. If
-    there is, nothing will be added.
+  def for_source(cls, source):
+    """Returns the index for a :class:`Source` instance, creating it if necessary.
+    """
+    with cls._for_source_lock:
+      index = getattr(source, '_syndicated_post_index', None)
+      if index is None:
+        index = source._syndicated_post_index = cls(source.key)
+      return index
+
+  def by_syndication(self, url):
+    """Returns the list of :class:`SyndicatedPost`\ s with a syndication URL."""
+    with self._lock:
+      self._load()
+      return list(self._by_syndication.get(url, []))
+
+  def by_original(self, url):
+    """Returns the list of :class:`SyndicatedPost`\ s with an original URL."""
+    with self._lock:
+      self._load()
+      return list(self._by_original.get(url, []))
+
+  def insert(self, syndication, original):
+    """Stages a new (non-blank) syndication -> original relationship.
+
+    Also stages deleting blanks for either URL.
 
     Args:
-      source: :class:`Source` subclass
-      original: string
+      syndication: string (not None)
+      original: string (not None)
+
+    Returns:
+      SyndicatedPost: newly created or preexisting entity
     """
-    if cls.query(cls.original == original, ancestor=source.key).get():
-      return
-    cls(parent=source.key, original=original, syndication=None).put()
+    with self._lock:
+      self._load()
+      return self._insert(SyndicatedPost(
+        parent=self.source_key, syndication=syndication, original=original))
 
-  @classmethod
-  @ndb.transactional(xg=True)
-  def insert_syndication_blank(cls, source, syndication):
-    """Insert a new syndication -> None relationship. Does a check-and-set
-    to make sure no previous relationship exists for this
-    syndication. If there is, nothing will be added.
+  def insert_original_blank(self, original):
+    """Stages a new original -> None relationship, unless one already exists.
 
     Args:
-      source: :class:`Source` subclass
       original: string
+
+    Returns:
+      SyndicatedPost: newly created entity, or None if one already existed
     """
+    with self._lock:
+      self._load()
+      post = SyndicatedPost(parent=self.source_key, original=original,
+                            syndication=None)
+      return post if self._insert(post) is post else None
 
-    if cls.query(cls.syndication == syndication, ancestor=source.key).get():
-      return
-    cls(parent=source.key, original=None, syndication=syndication).put()
+  def insert_syndication_blank(self, syndication):
+    """Stages a new syndication -> None relationship, unless one already exists.
 
-  @classmethod
-  @ndb.transactional(xg=True)
-  def insert(cls, source, syndication, original):
-    """Insert a new (non-blank) syndication -> original relationship.
+    Args:
+      syndication: string
+
+    Returns:
+      SyndicatedPost: newly created entity, or None if one already existed
+    """
+    with self._lock:
+      self._load()
+      post = SyndicatedPost(parent=self.source_key, original=None,
+                            syndication=syndication)
+      return post if self._insert(post) is post else None
+
+  def delete(self, post):
+    """Stages deleting a :class:`SyndicatedPost`."""
+    with self._lock:
+      self._load()
+      self._delete(post)
+
+  def commit(self):
+    """Writes all staged changes to the datastore.
+
+    Each batch of :const:`MAX_SYNDICATED_POST_BATCH` changes is one transaction
+    that replays the changes against the source's stored
+    :class:`SyndicatedPost`\ s with the same URLs, so that writes from other
+    requests since we loaded can't cause duplicates. If the replay differs, e.g. because another
+    request stored the same relationship first, the index is reloaded the next
+    time it's used.
+    """
+    with self._lock:
+      pending = self._pending
+      self._pending = []
+      syndications = [(post, post.syndication) for post, delete in pending
+                      if not delete]
+
+      clean = True
+      for i in range(0, len(pending), MAX_SYNDICATED_POST_BATCH):
+        clean = self._commit_batch(
+          pending[i:i + MAX_SYNDICATED_POST_BATCH]) and clean
+
+      # Source.on_new_syndicated_post() may canonicalize syndication URLs
+      if not clean or any(post.syndication != syndication
+                          for post, syndication in syndications):
+        logging.info('SyndicatedPosts for %s changed underneath us; will reload',
+                     self.source_key.string_id())
+        self._reset()
 
-    This method does a check-and-set within transaction to avoid
-    including duplicate relationships.
+  @ndb.transactional(xg=True)
+  def _commit_batch(self, batch):
+    """Writes a batch of staged changes.
 
-    If blank entries exists for the syndication or original URL
-    (i.e. syndication -> None or original -> None), they will first be
-    removed. If non-blank relationships exist, they will be retained.
+    Cross-group because :meth:`Source.on_new_syndicated_post` implementations
+    may read other entities, e.g. :class:`facebook.FacebookPage` reads its auth
+    entity.
 
     Args:
-      source: :class:`Source` subclass
-      syndication: string (not None)
-      original: string (not None)
+      batch: sequence of (SyndicatedPost, boolean delete) tuples
 
     Returns:
-      SyndicatedPost: newly created or preexisting entity
+      boolean, True if all changes were written as staged, False otherwise
     """
-    # check for an exact match
-    duplicate = cls.query(cls.syndication == syndication,
-                          cls.original == original,
-                          ancestor=source.key).get()
-    if duplicate:
-      return duplicate
-
-    # delete blanks (expect at most 1 of each)
-    ndb.delete_multi(
-      cls.query(ndb.OR(
-        ndb.AND(cls.syndication == syndication, cls.original == None),
-        ndb.AND(cls.original == original, cls.syndication == None)),
-                ancestor=source.key).fetch(keys_only=True))
-
-    r = cls(parent=source.key, original=original, syndication=syndication)
-    r.put()
-    return r
+    # only load the stored posts that the replay looks at, ie the ones that
+    # share a URL with a post in this batch
+    stored = SyndicatedPostIndex(self.source_key)
+    stored._load_urls(set(post.syndication for post, _ in batch) - {None},
+                      set(post.original for post, _ in batch) - {None})
+
+    clean = True
+    for post, delete in batch:
+      if delete:
+        # every post has at least one URL, and we loaded all posts with it
+        candidates = (stored._by_syndication.get(post.syndication, [])
+                      if post.syndication
+                      else stored._by_original.get(post.original, []))
+        existing = [p for p in candidates if p.key == post.key]
+        if existing:
+          stored._delete(existing[0])
+        else:
+          clean = False
+      elif stored._insert(post) is not post:
+        clean = False
+
+    # SyndicatedPosts are all in the source's entity group, so we only need to
+    # load it once for _pre_put_hook
+    source = self.source_key.get()
+    to_put = []
+    to_delete = []
+    for post, delete in stored._pending:
+      if delete:
+        to_delete.append(post.key)
+      else:
+        post._source = source
+        to_put.append(post)
+
+    ndb.delete_multi(to_delete)
+    ndb.put_multi(to_put)
+    return clean
+
+  def _insert(self, post):
+    """Stages a new post unless it conflicts. Call with the lock held!
 
-  def _pre_put_hook(self):
-    self.key.parent().get().on_new_syndicated_post(self)
+    Returns:
+      SyndicatedPost: post, or the existing post it conflicts with
+    """
+    if post.syndication and post.original:
+      for existing in self._by_syndication.get(post.syndication, []):
+        if existing.original == post.original:
+          return existing
+      for blank in (self._by_syndication.get(post.syndication, []) +
+                    self._by_original.get(post.original, [])):
+        if not blank.syndication or not blank.original:
+          self._delete(blank)
+    else:
+      existing = (self._by_original.get(post.original) if post.original
+                  else self._by_syndication.get(post.syndication))
+      if existing:
+        return existing[0]
+
+    self._add(post)
+    self._pending.append((post, False))
+    return post
+
+  def _delete(self, post):
+    """Stages deleting a post. Call with the lock held!"""
+    for urls, url in ((self._by_syndication, post.syndication),
+                      (self._by_original, post.original)):
+      urls[url] = [p for p in urls.get(url, []) if p is not post]
+
+    if post.key and post.key.id():
+      self._pending.append((post, True))
+    else:  # not stored yet
+      self._pending = [(p, d) for p, d in self._pending if p is not post]
+
+  def _add(self, post):
+    """Adds a post to the in-memory index. Call with the lock held!"""
+    self._by_syndication[post.syndication].append(post)
+    self._by_original[post.original].append(post)
+
+  def _load(self):
+    """Loads the posts if they're not loaded yet. Call with the lock held!"""
+    if not self._loaded:
+      posts = SyndicatedPost.query(ancestor=self.source_key).fetch()
+      for post in posts:
+        self._add(post)
+      self._loaded = True
+      logging.debug('Loaded %d SyndicatedPosts for %s', len(posts),
+                    self.source_key.string_id())
+
+  def _load_urls(self, syndications, originals):
+    """Loads just the posts with the given syndication or original URLs.
+
+    Uses ancestor queries, so it works inside transactions. Doesn't mark the
+    index loaded, since it's partial. Call with the lock held, or on an index
+    that isn't shared!
+
+    Args:
+      syndications: collection of string syndication URLs
+      originals: collection of string original URLs
+    """
+    futures = []
+    for prop, urls in ((SyndicatedPost.syndication, list(syndications)),
+                       (SyndicatedPost.original, list(originals))):
+      for i in range(0, len(urls), MAX_ALLOWABLE_QUERIES):
+        futures.append(SyndicatedPost.query(
+          prop.IN(urls[i:i + MAX_ALLOWABLE_QUERIES]),
+          ancestor=self.source_key).fetch_async())
+
+    seen = set()
+    for future in futures:
+      for post in future.get_result():
+        if post.key not in seen:
+          seen.add(post.key)
+          self._add(post)
+
+  def _reset(self):
+    """Clears the in-memory index so it reloads. Call with the lock held!"""
+    self._loaded = False
+    self._by_syndication = collections.defaultdict(list)
+    self._by_original = collections.defaultdict(list)
@@ -15,39 +15,55 @@ lookups in the following primary cases:
   be 0 requests and 0 DB lookups.
 
 - For a syndicated post has been seen previously (regardless of
-  whether discovery was successful), there will be 0 requests and 1
-  DB lookup.
+  whether discovery was successful), there will be 0 requests and 0
+  DB lookups beyond loading the source's
+  :class:`models.SyndicatedPostIndex`, once per poll.
 
 - The first time a syndicated post has been seen:
     - 1 to 2 HTTP requests to get and parse the h-feed plus 1 additional
       request for *each* post permalink that has not been seen before.
-    - 1 DB query for the initial check plus 1 additional DB query for
-      *each* post permalink.
+    - 1 DB transaction per h-feed walk to store the new relationships, plus
+      1 more for every :const:`models.MAX_SYNDICATED_POST_BATCH` of them.
 """
 from __future__ import unicode_literals
 
 import collections
+import datetime
+import hashlib
 import itertools
+import json
 import logging
 import mf2util
+import threading
 import urlparse
 import util
 
 from granary import microformats2
 from granary import source as gr_source
-from google.appengine.api.datastore import MAX_ALLOWABLE_QUERIES
+from google.appengine.ext import ndb
 import models
 from models import SyndicatedPost
+import websub
 
 from google.appengine.api import memcache
 
 MAX_PERMALINK_FETCHES = 10
 MAX_PERMALINK_FETCHES_BETA = 50
 MAX_FEED_ENTRIES = 100
+MAX_PERMALINK_FETCHES_PER_HOST = 3
+
+# discover() may run concurrently on multiple activities for the same source,
+# e.g. in tasks.Poll.backfeed(). these serialize fetching each author URL and
+# changes to source.updates that read before they write. _author_fetch_locks
+# maps author URL to [Lock, number of threads using it], and we remove each
+# entry when the last thread is done with it, so that it doesn't grow forever.
+_author_fetch_locks = {}
+_author_fetch_locks_lock = threading.Lock()
+_updates_lock = threading.Lock()
 
 
 def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
-             already_fetched_hfeeds=None):
+             already_fetched_hfeeds=None, commit=True):
   """Augments the standard original_post_discovery algorithm with a
   reverse lookup that supports posts without a backlink or citation.
 
@@ -64,12 +80,17 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
     include_redirect_sources: boolean, whether to include URLs that redirect as
       well as their final destination URLs
     already_fetched_hfeeds: set, URLs that we have already fetched and run
-      posse-post-discovery on, so we can avoid running it multiple times
+      posse-post-discovery on, so we can avoid running it multiple times. May
+      be shared by concurrent calls for the same source.
+    commit: boolean, whether to write the :class:`models.SyndicatedPost`
+      changes we staged, e.g. blanks for new syndication URLs, before
+      returning. Pass False when calling this for many activities, then call
+      :meth:`models.SyndicatedPostIndex.commit` once at the end.
 
   Returns:
     (set(string original post URLs), set(string mention URLs)) tuple
   """
-  if not source.updates:
+  if source.updates is None:
     source.updates = {}
 
   if already_fetched_hfeeds is None:
@@ -97,15 +118,16 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
       logging.debug('running original post discovery on attachment: %s',
                     att.get('id'))
       att_origs, _ = discover(
-        source, att, include_redirect_sources=include_redirect_sources)
+        source, att, include_redirect_sources=include_redirect_sources,
+        commit=False)
       logging.debug('original post discovery found originals for attachment, %s',
                     att_origs)
       mentions.update(att_origs)
 
   def resolve(urls):
     resolved = set()
-    for url in urls:
-      final, _, send = util.get_webmention_target(url)
+    urls = list(urls)
+    for url, (final, _, send) in zip(urls, util.get_webmention_targets(urls)):
       if send:
         resolved.add(final)
         if include_redirect_sources:
@@ -140,6 +162,9 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
   if not syndication_url:
     logging.debug('no %s syndication url, cannot process h-entries', source.SHORT_NAME)
 
+  if commit:
+    models.SyndicatedPostIndex.for_source(source).commit()
+
   return ((originals, mentions) if not source.BACKFEED_REQUIRES_SYNDICATION_LINK
           else (set(syndicated), set()))
 
@@ -210,9 +235,8 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
   logging.info('starting posse post discovery with syndicated %s',
                syndication_url)
 
-  relationships = SyndicatedPost.query(
-    SyndicatedPost.syndication == syndication_url,
-    ancestor=source.key).fetch()
+  index = models.SyndicatedPostIndex.for_source(source)
+  relationships = index.by_syndication(syndication_url)
 
   if not relationships and fetch_hfeed:
     # a syndicated post we haven't seen before! fetch the author's URLs to see
@@ -222,13 +246,30 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
     # fallback in the future to support content from non-Bridgy users.
     results = {}
     for url in _get_author_urls(source):
-      if url not in already_fetched_hfeeds:
-        results.update(_process_author(source, url))
-        already_fetched_hfeeds.add(url)
-      else:
-        logging.debug('skipping %s, already fetched this round', url)
+      with _author_fetch_locks_lock:
+        entry = _author_fetch_locks.setdefault(url, [threading.Lock(), 0])
+        entry[1] += 1
+      lock = entry[0]
+      lock.acquire()
+      try:
+        if url not in already_fetched_hfeeds:
+          results.update(_process_author(source, url))
+          already_fetched_hfeeds.add(url)
+        else:
+          logging.debug('skipping %s, already fetched this round', url)
+      finally:
+        lock.release()
+        with _author_fetch_locks_lock:
+          entry[1] -= 1
+          if not entry[1]:
+            del _author_fetch_locks[url]
 
     relationships = results.get(syndication_url, [])
+    if not relationships:
+      # another thread's fetch of an author URL that we skipped may have stored
+      # relationships for this post after we first looked. this only checks
+      # the in-memory index, so it's cheap.
+      relationships = index.by_syndication(syndication_url)
 
   if not relationships:
     # No relationships were found. Remember that we've seen this
@@ -236,7 +277,8 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
     logging.debug('posse post discovery found no relationship for %s',
                   syndication_url)
     if fetch_hfeed:
-      SyndicatedPost.insert_syndication_blank(source, syndication_url)
+      # discover() or its caller commits this
+      index.insert_syndication_blank(syndication_url)
 
   originals = [r.original for r in relationships if r.original]
   if originals:
@@ -264,13 +306,17 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   if not ok:
     return {}
 
+  to_store = []  # util.FetchedUrl
+
   try:
     logging.debug('fetching author url %s', author_url)
-    author_resp = util.requests_get(author_url)
-    # TODO for error codes that indicate a temporary error, should we make
-    # a certain number of retries before giving up forever?
-    author_resp.raise_for_status()
-    author_dom = util.beautifulsoup_parse(author_resp.text)
+    author_resp, author_cached = util.requests_get_if_changed(author_url)
+    if not author_cached:
+      # TODO for error codes that indicate a temporary error, should we make
+      # a certain number of retries before giving up forever?
+      author_resp.raise_for_status()
+      author_doc = util.ParsedDocument(author_resp.text, author_url)
+      author_doc.soup  # parse now so that we catch errors
   except AssertionError:
     raise  # for unit tests
   except BaseException:
@@ -279,50 +325,56 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
     logging.info('Could not fetch author url %s', author_url, exc_info=True)
     return {}
 
-  feeditems = _find_feed_items(author_url, author_dom)
-
-  # look for all other feed urls using rel='feed', type='text/html'
-  feed_urls = set()
-  for rel_feed_node in (author_dom.find_all('link', rel='feed')
-                        + author_dom.find_all('a', rel='feed')):
-    feed_url = rel_feed_node.get('href')
-    if not feed_url:
-      continue
-
-    feed_url = urlparse.urljoin(author_url, feed_url)
-    feed_type = rel_feed_node.get('type')
-    if feed_type and feed_type != 'text/html':
-      feed_ok = False
-    else:
-      # double check that it's text/html, not too big, etc
-      feed_url, _, feed_ok = util.get_webmention_target(feed_url)
-
-    if feed_url == author_url:
-      logging.debug('author url is the feed url, ignoring')
-    elif not feed_ok:
-      logging.debug('skipping feed of type %s', feed_type)
-    else:
-      feed_urls.add(feed_url)
-
+  if author_cached:
+    feeditems = author_cached.data['items']
+    feed_urls = author_cached.data['feeds']
+    hub = author_cached.data.get('hub')
+    topic = author_cached.data.get('topic')
+  else:
+    feeditems = _find_feed_items(author_url, author_doc)
+    feed_urls = _find_rel_feeds(author_url, author_doc.soup)
+    hub, topic = websub.discover(author_resp, author_doc)
+    to_store.append(util.FetchedUrl.from_response(author_url, author_resp, {
+      'items': _summarize_feed_items(feeditems),
+      'feeds': feed_urls,
+      'hub': hub,
+      'topic': topic,
+    }))
+
+  if hub and source.is_beta_user():
+    # get notified when the h-feed changes so we don't have to refetch it blindly
+    websub.subscribe(source, author_url, hub, topic)
+
+  unchanged = bool(author_cached)
   for feed_url in feed_urls:
     try:
       logging.debug("fetching author's rel-feed %s", feed_url)
-      feed_resp = util.requests_get(feed_url)
-      feed_resp.raise_for_status()
-      logging.debug("author's rel-feed fetched successfully %s", feed_url)
-      feeditems = _merge_hfeeds(feeditems,
-                                _find_feed_items(feed_url, feed_resp.text))
+      feed_resp, feed_cached = util.requests_get_if_changed(feed_url)
+      if feed_cached:
+        feed_items = feed_cached.data['items']
+      else:
+        unchanged = False
+        feed_resp.raise_for_status()
+        logging.debug("author's rel-feed fetched successfully %s", feed_url)
+        feed_items = _find_feed_items(
+          feed_url, util.ParsedDocument(feed_resp.text, feed_url))
+        to_store.append(util.FetchedUrl.from_response(feed_url, feed_resp, {
+          'items': _summarize_feed_items(feed_items),
+        }))
+      feeditems = _merge_hfeeds(feeditems, feed_items)
 
       domain = util.domain_from_link(feed_url)
       if source.updates is not None and domain not in source.domains:
-        domains = source.updates.setdefault('domains', source.domains)
-        if domain not in domains:
-          logging.info('rel-feed found new domain %s! adding to source', domain)
-          domains.append(domain)
+        with _updates_lock:
+          domains = source.updates.setdefault('domains', source.domains)
+          if domain not in domains:
+            logging.info('rel-feed found new domain %s! adding to source', domain)
+            domains.append(domain)
 
     except AssertionError:
       raise  # reraise assertions for unit tests
     except BaseException:
+      unchanged = False
       logging.info('Could not fetch h-feed url %s.', feed_url, exc_info=True)
 
   # sort by dt-updated/dt-published
@@ -350,24 +402,74 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
       logging.info('Hit cap of %d permalinks. Stopping.', max)
       break
 
-  # query all preexisting permalinks at once, instead of once per link
-  permalinks_list = list(permalink_to_entry.keys())
-  # fetch the maximum allowed entries (currently 30) at a time
-  preexisting_list = itertools.chain.from_iterable(
-    SyndicatedPost.query(
-      SyndicatedPost.original.IN(permalinks_list[i:i + MAX_ALLOWABLE_QUERIES]),
-      ancestor=source.key)
-    for i in xrange(0, len(permalinks_list), MAX_ALLOWABLE_QUERIES))
-  preexisting = {}
-  for r in preexisting_list:
-    preexisting.setdefault(r.original, []).append(r)
+  index = models.SyndicatedPostIndex.for_source(source)
+  preexisting = {permalink: index.by_original(permalink)
+                 for permalink in permalink_to_entry}
+
+  if (unchanged and not refetch and
+      all(preexisting.get(permalink) for permalink in permalink_to_entry)):
+    # we already walked these permalinks for this source, and stored a
+    # SyndicatedPost (maybe blank) for each one, so there's nothing new to find.
+    # (the FetchedUrls are shared by all sources with this author URL, so we
+    # can't skip based on them alone.) refetch still walks them since
+    # permalinks can get new syndication links on their own.
+    logging.info("Author's h-feeds haven't changed. Not processing permalinks.")
+    return {}
 
-  results = {}
-  for permalink, entry in permalink_to_entry.iteritems():
+  # skip entries that haven't changed since we last processed them
+  now = util.now_fn()
+  old_hashes = _get_hfeed_entry_hashes(source).get(author_url, {})
+  new_hashes = {}
+  for permalink, entry in permalink_to_entry.items():
+    digest = _entry_hash(permalink, entry)
+    old = old_hashes.get(permalink)
+    if not old or old[0] != digest:
+      new_hashes[permalink] = [
+        digest, now.strftime(models.HFEED_ENTRY_HASH_TIME_FORMAT)]
+      continue
+
+    new_hashes[permalink] = old
+    if not refetch or not preexisting.get(permalink):
+      continue
+    settled = (now - datetime.datetime.strptime(
+                       old[1], models.HFEED_ENTRY_HASH_TIME_FORMAT)
+               >= models.REFETCH_UNCHANGED_PERMALINKS_FOR)
+    if (entry.get('properties', {}).get('syndication') or
+        source.last_feed_syndication_url or settled):
+      logging.debug('skipping unchanged h-entry %s', permalink)
+      del permalink_to_entry[permalink]
+
+  # process the entries concurrently, each as soon as its permalink is fetched,
+  # if it needs to be. process_entry() decides whether to fetch, so this only
+  # caps the fetches per host and notes which ones failed.
+  failed = set()
+  hosts = {}
+  lock = threading.Lock()
+
+  def fetch(permalink, resolved, type_ok):
+    host = util.domain_from_link(resolved)
+    with lock:
+      semaphore = hosts.setdefault(
+        host, threading.BoundedSemaphore(MAX_PERMALINK_FETCHES_PER_HOST))
+    with semaphore:
+      parsed, success = _fetch_permalink(resolved, type_ok)
+    if not success:
+      with lock:
+        failed.add(permalink)
+    return parsed, success
+
+  def process(permalink, entry):
     logging.debug('processing permalink: %s', permalink)
-    new_results = process_entry(
+    return process_entry(
       source, permalink, entry, refetch, preexisting.get(permalink, []),
-      store_blanks=store_blanks)
+      store_blanks=store_blanks,
+      fetch=lambda resolved, type_ok: fetch(permalink, resolved, type_ok))
+
+  results = {}
+  for new_results in util.run_concurrently(
+      [lambda permalink=permalink, entry=entry: process(permalink, entry)
+       for permalink, entry in permalink_to_entry.items()]):
+    # merge in feed order so that results are deterministic
     for key, value in new_results.iteritems():
       results.setdefault(key, []).extend(value)
 
@@ -378,9 +480,149 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
     # Source will be saved at the end of each round of polling
     source.updates['last_syndication_url'] = util.now_fn()
 
+  # write the relationships we found in a few batched transactions. only store
+  # the fetched feeds and entry hashes after that, so that we don't skip them
+  # next time if we die partway through.
+  index.commit()
+  ndb.put_multi(f for f in to_store if f)
+
+  if source.updates is not None:
+    for permalink in failed:
+      # process this entry again next time
+      old = old_hashes.get(permalink)
+      if old:
+        new_hashes[permalink] = old
+      else:
+        new_hashes.pop(permalink, None)
+    with _updates_lock:
+      hashes = _get_hfeed_entry_hashes(source)
+      hashes[author_url] = new_hashes
+      source.updates['hfeed_entry_hashes_json'] = json.dumps(hashes,
+                                                             sort_keys=True)
+
   return results
 
 
+def _get_hfeed_entry_hashes(source):
+  """Returns a source's h-feed entry hashes, including pending updates.
+
+  See :attr:`models.Source.hfeed_entry_hashes_json`.
+
+  Args:
+    source: :class:`models.Source` subclass
+
+  Returns:
+    dict mapping author URL to dict mapping permalink to [hash, time] list
+  """
+  hashes_json = ((source.updates or {}).get('hfeed_entry_hashes_json') or
+                 source.hfeed_entry_hashes_json)
+  return json.loads(hashes_json) if hashes_json else {}
+
+
+def _entry_hash(permalink, entry):
+  """Returns a hex hash of the parts of an h-feed entry that we process.
+
+  That's its permalink, u-syndication links, and published and updated times.
+
+  Args:
+    permalink: string URL
+    entry: mf2 h-entry dict from the h-feed
+
+  Returns:
+    string
+  """
+  props = entry.get('properties', {})
+  return hashlib.sha1(json.dumps([
+    permalink,
+    sorted(url for url in props.get('syndication', [])
+           if isinstance(url, basestring)),
+    props.get('published'),
+    props.get('updated'),
+  ], sort_keys=True)).hexdigest()
+
+
+def _fetch_permalink(permalink, type_ok):
+  """Fetches and parses a post permalink.
+
+  Args:
+    permalink: string URL, already resolved
+    type_ok: boolean, whether permalink is a valid webmention target. If False,
+      we don't fetch it.
+
+  Returns:
+    (mf2 dict or None, boolean success) tuple
+  """
+  parsed = None
+  try:
+    logging.debug('fetching post permalink %s', permalink)
+    if type_ok:
+      resp = util.requests_get(permalink)
+      resp.raise_for_status()
+      parsed = util.mf2py_parse(resp.text, permalink)
+  except AssertionError:
+    raise  # for unit tests
+  except BaseException:
+    # TODO limit the number of allowed failures
+    logging.info('Could not fetch permalink %s', permalink, exc_info=True)
+    return None, False
+
+  return parsed, True
+
+
+def _find_rel_feeds(author_url, author_dom):
+  """Finds an author page's rel-feed URLs that we should fetch.
+
+  Args:
+    author_url: string
+    author_dom: BeautifulSoup object
+
+  Returns:
+    list of string URLs
+  """
+  feed_urls = set()
+  for rel_feed_node in (author_dom.find_all('link', rel='feed')
+                        + author_dom.find_all('a', rel='feed')):
+    feed_url = rel_feed_node.get('href')
+    if not feed_url:
+      continue
+
+    feed_url = urlparse.urljoin(author_url, feed_url)
+    feed_type = rel_feed_node.get('type')
+    if feed_type and feed_type != 'text/html':
+      feed_ok = False
+    else:
+      # double check that it's text/html, not too big, etc
+      feed_url, _, feed_ok = util.get_webmention_target(feed_url)
+
+    if feed_url == author_url:
+      logging.debug('author url is the feed url, ignoring')
+    elif not feed_ok:
+      logging.debug('skipping feed of type %s', feed_type)
+    else:
+      feed_urls.add(feed_url)
+
+  return list(feed_urls)
+
+
+def _summarize_feed_items(feeditems):
+  """Returns just the parts of feed items that we use, to store them compactly.
+
+  That's their types and their url, syndication, published, and updated
+  properties. See :func:`_process_author` and :func:`process_entry`.
+
+  Args:
+    feeditems: list of mf2 item dicts
+
+  Returns:
+    list of mf2 item dicts
+  """
+  return [{
+    'type': item.get('type', []),
+    'properties': {name: vals for name, vals in item.get('properties', {}).items()
+                   if name in ('url', 'syndication', 'published', 'updated')},
+  } for item in feeditems]
+
+
 def _merge_hfeeds(feed1, feed2):
   """Merge items from two h-feeds into a composite feed. Skips items in
   feed2 that are already represented in feed1, based on the "url" property.
@@ -408,14 +650,13 @@ def _find_feed_items(feed_url, feed_doc):
   top-level items.
 
   Args:
-    feed_url: a string. the URL passed to mf2py parser
-    feed_doc: a string or BeautifulSoup object. document is passed to
-      mf2py parser
+    feed_url: a string. used in log messages
+    feed_doc: a :class:`util.ParsedDocument`
 
   Returns:
     a list of dicts, each one representing an mf2 h-* item
   """
-  parsed = util.mf2py_parse(feed_doc, feed_url)
+  parsed = feed_doc.mf2
 
   feeditems = parsed['items']
   hfeeds = mf2util.find_all_entries(parsed, ('h-feed',))
@@ -434,7 +675,7 @@ def _find_feed_items(feed_url, feed_doc):
 
 
 def process_entry(source, permalink, feed_entry, refetch, preexisting,
-                  store_blanks=True):
+                  store_blanks=True, fetch=None):
   """Fetch and process an h-entry and save a new :class:`models.SyndicatedPost`.
 
   Args:
@@ -447,6 +688,9 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
       for this permalink
     store_blanks: boolean, whether we should store blank
       :class:`models.SyndicatedPost`\ s when we don't find a relationship
+    fetch: optional function with the same signature and return value as
+      :func:`_fetch_permalink` to use instead of it, e.g. to limit concurrent
+      fetches
 
   Returns:
     a dict from syndicated url to a list of new :class:`models.SyndicatedPost`\ s
@@ -478,19 +722,7 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
     source.updates['last_feed_syndication_url'] = util.now_fn()
   elif not source.last_feed_syndication_url or not feed_entry:
     # fetch the full permalink page if we think it might have more details
-    parsed = None
-    try:
-      logging.debug('fetching post permalink %s', permalink)
-      if type_ok:
-        resp = util.requests_get(permalink)
-        resp.raise_for_status()
-        parsed = util.mf2py_parse(resp.text, permalink)
-    except AssertionError:
-      raise  # for unit tests
-    except BaseException:
-      # TODO limit the number of allowed failures
-      logging.info('Could not fetch permalink %s', permalink, exc_info=True)
-      success = False
+    parsed, success = (fetch or _fetch_permalink)(permalink, type_ok)
 
     if parsed:
       syndication_urls = set()
@@ -517,7 +749,7 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
     for syndpost in list(preexisting):
       if syndpost.syndication and syndpost not in result_syndposts:
         logging.info('deleting relationship that disappeared: %s', syndpost)
-        syndpost.key.delete()
+        models.SyndicatedPostIndex.for_source(source).delete(syndpost)
         preexisting.remove(syndpost)
 
   if not results:
@@ -529,7 +761,8 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
       # particular source
       logging.debug('saving empty relationship so that %s will not be '
                     'searched again', permalink)
-      SyndicatedPost.insert_original_blank(source, permalink)
+      models.SyndicatedPostIndex.for_source(source).insert_original_blank(
+        permalink)
 
   # only return results that are not in the preexisting list
   new_results = {}
@@ -580,8 +813,8 @@ def _process_syndication_urls(source, permalink, syndication_urls,
                          and sp.original == permalink), None)
     if not relationship:
       logging.debug('saving discovered relationship %s -> %s', url, permalink)
-      relationship = SyndicatedPost.insert(
-        source, syndication=url, original=permalink)
+      relationship = models.SyndicatedPostIndex.for_source(source).insert(
+        syndication=url, original=permalink)
     results.setdefault(url, []).append(relationship)
 
   return results
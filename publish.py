@@ -232,7 +232,7 @@ class Handler(webmention.WebmentionHandler):
     # find rel-shortlink, if any
     # http://microformats.org/wiki/rel-shortlink
     # https://github.com/snarfed/bridgy/issues/173
-    soup = util.beautifulsoup_parse(self.fetched.text)
+    soup = self.doc.soup
     shortlinks = (soup.find_all('link', rel='shortlink') +
                   soup.find_all('a', rel='shortlink') +
                   soup.find_all('a', class_='shortlink'))
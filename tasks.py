@@ -3,15 +3,19 @@
 """
 from __future__ import unicode_literals
 
+import collections
 import datetime
 import gc
+import itertools
 import json
 import logging
 import random
+import urlparse
 
 from oauth_dropins.webutil import logs
-from google.appengine.api import memcache
 from google.appengine.api import datastore_errors
+from google.appengine.api.datastore import MAX_ALLOWABLE_QUERIES
+from google.appengine.api import taskqueue
 from google.appengine.api.datastore_types import _MAX_STRING_LENGTH
 from google.appengine.ext import ndb
 from granary.source import Source
@@ -35,8 +39,6 @@ import twitter
 import util
 import wordpress_rest
 
-WEBMENTION_DISCOVERY_CACHE_TIME = 60 * 60 * 2  # 2h
-
 
 class Poll(webapp2.RequestHandler):
   """Task handler that fetches and processes new responses from a single source.
@@ -68,27 +70,84 @@ class Poll(webapp2.RequestHandler):
 
     key = self.request.params['source_key']
     source = ndb.Key(urlsafe=key).get()
+    if (not self._should_poll(source, self.request.params['last_polled']) or
+        self._delay_if_rate_limited(source)):
+      return
+
+    # mark this source as polling
+    self._start_poll(source)
+    source = models.Source.put_updates(source)
+
+    try:
+      finished = self._poll_and_handle_errors(source)
+    finally:
+      source = models.Source.put_updates(source)
+
+    if not finished:
+      self.abort(util.ERROR_HTTP_RETURN_CODE)
+
+    self._add_next_poll_task(source)
+
+    # feeble attempt to avoid hitting the instance memory limit
+    source = None
+    gc.collect()
+
+  def _should_poll(self, source, last_polled):
+    """Returns True if this task should poll the given source, False otherwise.
+
+    Args:
+      source: :class:`models.Source`, or None
+      last_polled: string, the task's last_polled parameter
+    """
     if not source or source.status == 'disabled' or 'listen' not in source.features:
       logging.error('Source not found or disabled. Dropping task.')
-      return
+      return False
     logging.info('Source: %s %s, %s', source.label(), source.key.string_id(),
                  source.bridgy_url(self))
 
-    last_polled = self.request.params['last_polled']
     if last_polled != source.last_polled.strftime(util.POLL_TASK_DATETIME_FORMAT):
       logging.warning('duplicate poll task! deferring to the other task.')
-      return
+      return False
 
     logging.info('Last poll: %s', self._last_poll_url(source))
+    return True
 
-    # mark this source as polling
+  @staticmethod
+  def _delay_if_rate_limited(source):
+    """If a source is over its silo rate limit budget, adds a later poll task.
+
+    Returns:
+      boolean, True if the poll was delayed, False if it can happen now
+    """
+    delay = source.rate_limit_delay()
+    if delay:
+      logging.info('Over rate limit budget. Delaying poll by %s', delay)
+      util.add_poll_task(source, countdown=delay.total_seconds())
+      return True
+    return False
+
+  @staticmethod
+  def _start_poll(source):
+    """Stores the updates that mark a source as polling in source.updates."""
     source.updates = {
       'poll_status': 'polling',
       'last_poll_attempt': util.now_fn(),
       'rate_limited': False,
     }
-    source = models.Source.put_updates(source)
 
+  def _poll_and_handle_errors(self, source):
+    """Polls a source and handles expected errors.
+
+    Stores property names and values to update in source.updates.
+
+    Returns:
+      boolean, True if the poll finished, successfully or not, and the source
+      should get a new poll task. False if it failed temporarily and should be
+      retried.
+
+    Raises:
+      unexpected exceptions from :meth:`poll()`
+    """
     source.updates = {}
     try:
       self.poll(source)
@@ -110,27 +169,29 @@ class Poll(webapp2.RequestHandler):
 
       elif code in source.RATE_LIMIT_HTTP_CODES:
         logging.info('Rate limited. Marking as error and finishing. %s', e)
-        source.updates['rate_limited'] = True
+        # if we know when the rate limit resets, the next poll task will wait
+        # until then. otherwise, fall back to slowing down polling.
+        if not source.record_rate_limit(e):
+          source.updates['rate_limited'] = True
       elif ((code and int(code) / 100 == 5) or
             (code == '400' and isinstance(source, flickr.Flickr)) or
             util.is_connection_failure(e)):
         logging.error('API call failed. Marking as error and finishing. %s: %s\n%s',
                       code, body, e)
-        self.abort(util.ERROR_HTTP_RETURN_CODE)
+        return False
       else:
         raise
-    finally:
-      source = models.Source.put_updates(source)
 
-    # add new poll task. randomize task ETA to within +/- 20% to try to spread
-    # out tasks and prevent thundering herds.
+    return True
+
+  @staticmethod
+  def _add_next_poll_task(source):
+    """Adds a new poll task for a source, based on its poll period."""
+    # randomize task ETA to within +/- 20% to try to spread out tasks and
+    # prevent thundering herds.
     task_countdown = source.poll_period().total_seconds() * random.uniform(.8, 1.2)
     util.add_poll_task(source, countdown=task_countdown)
 
-    # feeble attempt to avoid hitting the instance memory limit
-    source = None
-    gc.collect()
-
   def poll(self, source):
     """Actually runs the poll.
 
@@ -149,15 +210,17 @@ class Poll(webapp2.RequestHandler):
     if source.last_activities_cache_json:
       cache.update(json.loads(source.last_activities_cache_json))
 
-    # search for links first so that the user's activities and responses
-    # override them if they overlap
-    links = source.search_for_links()
-
-    # this user's own activities (and user mentions)
-    resp = source.get_activities_response(
-      fetch_replies=True, fetch_likes=True, fetch_shares=True,
-      fetch_mentions=True, count=50, etag=source.last_activities_etag,
-      min_id=source.last_activity_id, cache=cache)
+    # search for links and fetch this user's own activities (and user mentions)
+    # at the same time, since they're independent silo API calls. links come
+    # first below so that the user's activities and responses override them if
+    # they overlap.
+    links, resp = util.run_concurrently((
+      source.search_for_links,
+      lambda: source.get_activities_response(
+        fetch_replies=True, fetch_likes=True, fetch_shares=True,
+        fetch_mentions=True, count=50, etag=source.last_activities_etag,
+        min_id=source.last_activity_id, cache=cache),
+    ))
     etag = resp.get('etag')  # used later
     user_activities = resp.get('items', [])
 
@@ -191,7 +254,8 @@ class Poll(webapp2.RequestHandler):
     source.updates['last_activities_cache_json'] = json.dumps(
       {k: v for k, v in cache.items() if k.split()[-1] in silo_activity_ids})
 
-    self.backfeed(source, responses, activities=activities)
+    num_responses = self.backfeed(source, responses, activities=activities)
+    source.record_poll_responses(num_responses)
 
     source.updates.update({'last_polled': source.last_poll_attempt,
                            'poll_status': 'ok'})
@@ -238,6 +302,9 @@ class Poll(webapp2.RequestHandler):
       source: Source
       responses: dict mapping AS response id to AS object
       activities: dict mapping AS activity id to AS object
+
+    Returns:
+      integer, number of new or changed responses
     """
     if responses is None:
       responses = {}
@@ -277,6 +344,10 @@ class Poll(webapp2.RequestHandler):
     # prune_activity() and prune_response() in step 4 to remove these before
     # serializing to JSON.
     #
+    # user and quote mentions, which need original post discovery. maps
+    # activity id to mention URLs from the user's tag.
+    mentions = collections.OrderedDict()
+
     for id, activity in public.items():
       obj = activity.get('object') or activity
 
@@ -286,12 +357,7 @@ class Poll(webapp2.RequestHandler):
         for tag in obj.get('tags', []):
           urls = tag.get('urls')
           if tag.get('objectType') == 'person' and tag.get('id') == user_id and urls:
-            activity['originals'], activity['mentions'] = \
-              original_post_discovery.discover(
-                source, activity, fetch_hfeed=True,
-                include_redirect_sources=False,
-                already_fetched_hfeeds=fetched_hfeeds)
-            activity['mentions'].update(u.get('value') for u in urls)
+            mentions[id] = [u.get('value') for u in urls]
             responses[id] = activity
             break
 
@@ -301,12 +367,7 @@ class Poll(webapp2.RequestHandler):
                 and att.get('author', {}).get('id') == source.user_tag_id()):
           # now that we've confirmed that one exists, OPD will dig
           # into the actual attachments
-          if 'originals' not in activity or 'mentions' not in activity:
-            activity['originals'], activity['mentions'] = \
-              original_post_discovery.discover(
-                source, activity, fetch_hfeed=True,
-                include_redirect_sources=False,
-                already_fetched_hfeeds=fetched_hfeeds)
+          mentions.setdefault(id, [])
           responses[id] = activity
           break
 
@@ -345,41 +406,45 @@ class Poll(webapp2.RequestHandler):
 
         responses[id] = resp
 
+    self._discover_originals(source, [public[id] for id in mentions],
+                             fetched_hfeeds)
+    for id, urls in mentions.items():
+      public[id]['mentions'].update(urls)
+
     #
     # Step 3: filter out responses we've already seen
     #
-    # seen responses (JSON objects) for each source are stored in its entity.
-    unchanged_responses = []
-    if source.seen_responses_cache_json:
-      for seen in json.loads(source.seen_responses_cache_json):
-        id = seen['id']
-        resp = responses.get(id)
-        if resp and not source.gr_source.activity_changed(seen, resp, log=True):
-          unchanged_responses.append(seen)
-          del responses[id]
+    # fingerprints of seen responses for each source are stored in its entity.
+    # a response is unchanged if its fingerprint matches.
+    seen = source.seen_response_fingerprints()
+    unchanged_fingerprints = {}
+    for id, resp in responses.items():
+      fingerprint = seen.get(id)
+      if fingerprint and fingerprint == util.activity_fingerprint(resp):
+        unchanged_fingerprints[id] = fingerprint
+        del responses[id]
 
     #
-    # Step 4: store new responses and enqueue propagate tasks
+    # Step 4: store new responses and enqueue propagate tasks, in batches
     #
-    pruned_responses = []
+    # we'll usually have multiple responses for the same activity, and the
+    # objects in resp['activities'] are shared, so cache each activity's
+    # discovered webmention targets inside its object.
+    self._discover_originals(
+      source, itertools.chain(*(self._response_activities(resp)
+                                for resp in responses.values())),
+      fetched_hfeeds)
+
+    new_fingerprints = {}
+    resp_entities = []
     for id, resp in responses.items():
+      new_fingerprints[id] = util.activity_fingerprint(resp)
       resp_type = Response.get_type(resp)
-      activities = resp.pop('activities', [])
-      if not activities and resp_type == 'post':
-        activities = [resp]
+      activities = self._response_activities(resp)
+      resp.pop('activities', None)
       too_long = set()
       urls_to_activity = {}
       for i, activity in enumerate(activities):
-        # we'll usually have multiple responses for the same activity, and the
-        # objects in resp['activities'] are shared, so cache each activity's
-        # discovered webmention targets inside its object.
-        if 'originals' not in activity or 'mentions' not in activity:
-          activity['originals'], activity['mentions'] = \
-            original_post_discovery.discover(
-              source, activity, fetch_hfeed=True,
-              include_redirect_sources=False,
-              already_fetched_hfeeds=fetched_hfeeds)
-
         targets = original_post_discovery.targets_for_response(
           resp, originals=activity['originals'], mentions=activity['mentions'])
         if targets:
@@ -397,7 +462,6 @@ class Poll(webapp2.RequestHandler):
       # remove circular references in link responses, which are their own
       # activities. details in the step 2 comment above.
       pruned_response = util.prune_response(resp)
-      pruned_responses.append(pruned_response)
       resp_entity = Response(
         id=id,
         source=source.key,
@@ -410,12 +474,57 @@ class Poll(webapp2.RequestHandler):
         original_posts=resp.get('originals', []))
       if urls_to_activity and len(activities) > 1:
         resp_entity.urls_to_activity=json.dumps(urls_to_activity)
-      resp_entity.get_or_save(source, restart=self.RESTART_EXISTING_TASKS)
+      resp_entities.append(resp_entity)
+
+    # store them all and enqueue their propagate tasks in batches
+    Response.get_or_save_multi(resp_entities, source,
+                               restart=self.RESTART_EXISTING_TASKS)
+
+    # update fingerprint index
+    if new_fingerprints:
+      new_fingerprints.update(unchanged_fingerprints)
+      source.updates['seen_response_fingerprints_json'] = json.dumps(
+        new_fingerprints, sort_keys=True)
+      if source.seen_responses_cache_json:
+        source.updates['seen_responses_cache_json'] = None
 
-    # update cache
-    if pruned_responses:
-      source.updates['seen_responses_cache_json'] = json.dumps(
-        pruned_responses + unchanged_responses)
+    return len(resp_entities)
+
+  @staticmethod
+  def _response_activities(resp):
+    """Returns the activities a response is in reply to, like, repost, etc."""
+    return (resp.get('activities') or
+            ([resp] if Response.get_type(resp) == 'post' else []))
+
+  @staticmethod
+  def _discover_originals(source, activities, already_fetched_hfeeds):
+    """Runs original post discovery on activities concurrently.
+
+    Stores each activity's original and mention URLs in its 'originals' and
+    'mentions' fields. Skips activities that already have them. Writes the
+    :class:`models.SyndicatedPost`\ s they stage, e.g. blanks for new
+    syndication URLs, together at the end.
+
+    Args:
+      source: :class:`models.Source`
+      activities: sequence of activity dicts. May contain duplicates.
+      already_fetched_hfeeds: set of URLs, passed through to
+        :func:`original_post_discovery.discover`
+    """
+    todo = collections.OrderedDict()
+    for activity in activities:
+      if 'originals' not in activity or 'mentions' not in activity:
+        todo.setdefault(id(activity), activity)
+
+    def discover(activity):
+      activity['originals'], activity['mentions'] = \
+        original_post_discovery.discover(
+          source, activity, fetch_hfeed=True, include_redirect_sources=False,
+          already_fetched_hfeeds=already_fetched_hfeeds, commit=False)
+
+    util.run_concurrently([lambda activity=activity: discover(activity)
+                           for activity in todo.values()])
+    models.SyndicatedPostIndex.for_source(source).commit()
 
   def repropagate_old_responses(self, source, relationships):
     """Find old Responses that match a new SyndicatedPost and repropagate them.
@@ -465,6 +574,113 @@ class Poll(webapp2.RequestHandler):
         response.add_task()
 
 
+class BatchPoll(Poll):
+  """Task handler that polls a batch of sources from the same silo at once.
+
+  Sources whose class sets :attr:`models.Source.BATCH_POLL` get their poll
+  tasks in the poll-pull pull queue, tagged with their silo, instead of the
+  poll push queue. See :func:`util.add_poll_task`. This leases up to
+  :attr:`BATCH_SIZE` of them that are due, loads the sources and their auth
+  entities with :func:`ndb.get_multi`, polls them concurrently, and writes all
+  of their poll state updates together.
+
+  Pull tasks for sources that fail temporarily aren't deleted, so they're
+  leased and retried again after their lease expires. After
+  :attr:`MAX_LEASES` tries, we give up and delete them, and
+  :class:`cron.ReplacePollTasks` eventually adds new ones.
+
+  Request parameters:
+
+  * silo: string, :attr:`models.Source.SHORT_NAME`, e.g. 'twitter'
+  """
+  BATCH_SIZE = 20
+  MAX_THREADS = 5
+  LEASE_LENGTH = datetime.timedelta(minutes=12)
+  MAX_LEASES = 5
+
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+    silo = util.get_required_param(self, 'silo')
+
+    queue = taskqueue.Queue('poll-pull')
+    leased = queue.lease_tasks_by_tag(self.LEASE_LENGTH.total_seconds(),
+                                      self.BATCH_SIZE, tag=silo)
+    logging.info('Leased %d %s poll tasks', len(leased), silo)
+    if not leased:
+      return
+
+    to_poll = []
+    for task in leased:
+      if task.retry_count > self.MAX_LEASES:
+        logging.warning('Giving up on poll task %s after %d leases',
+                        task.name, task.retry_count)
+        queue.delete_tasks(task)
+      else:
+        to_poll.append(task)
+
+    if to_poll:
+      done = self.poll_batch([urlparse.parse_qs(task.payload) for task in to_poll])
+      queue.delete_tasks([task for task, ok in zip(to_poll, done) if ok])
+
+    if len(leased) == self.BATCH_SIZE:
+      # there may be more due. keep going.
+      util.add_poll_batch_task(silo)
+
+    gc.collect()
+
+  def poll_batch(self, params):
+    """Polls a batch of sources.
+
+    Args:
+      params: sequence of dicts mapping 'source_key' and 'last_polled' to
+        single-element lists of string values, ie parsed poll task payloads
+
+    Returns:
+      list of booleans, one per element of params. True if that poll task is
+      done and can be deleted, False if it should be retried.
+    """
+    keys = [ndb.Key(urlsafe=p['source_key'][0]) for p in params]
+    sources = ndb.get_multi(keys)
+    to_poll = [source for source, p in zip(sources, params)
+               if self._should_poll(source, p['last_polled'][0]) and
+               not self._delay_if_rate_limited(source)]
+    if not to_poll:
+      return [True] * len(params)
+
+    # load all auth entities at once
+    auth_keys = list(set(s.auth_entity for s in to_poll if s.auth_entity))
+    auth_entities = {a.key: a for a in ndb.get_multi(auth_keys) if a}
+    for source in to_poll:
+      auth_entity = auth_entities.get(source.auth_entity)
+      if auth_entity:
+        source.load_gr_source(auth_entity)
+
+    for source in to_poll:
+      self._start_poll(source)
+    to_poll = models.Source.put_updates_multi(to_poll)
+
+    def poll_one(source):
+      try:
+        return self._poll_and_handle_errors(source)
+      except BaseException:
+        logging.error('Poll failed for %s', source.label(), exc_info=True)
+        return False
+
+    finished = util.run_concurrently(
+      [lambda source=source: poll_one(source) for source in to_poll],
+      max_threads=self.MAX_THREADS)
+    to_poll = models.Source.put_updates_multi(to_poll)
+
+    retry = set()
+    for source, ok in zip(to_poll, finished):
+      if ok:
+        self._add_next_poll_task(source)
+      else:
+        retry.add(source.key)
+
+    return [key not in retry for key in keys]
+
+
 class Discover(Poll):
   """Task handler that fetches and processes new responses to a single post.
 
@@ -494,6 +710,13 @@ class Discover(Poll):
                  source.bridgy_url(self))
 
     post_id = util.get_required_param(self, 'post_id')
+    delay = source.rate_limit_delay()
+    if delay:
+      logging.info('Over rate limit budget. Delaying by %s', delay)
+      util.add_discover_task(source, post_id, type=type,
+                             countdown=delay.total_seconds())
+      return
+
     source.updates = {}
 
     try:
@@ -519,6 +742,8 @@ class Discover(Poll):
 
     except Exception, e:
       code, body = util.interpret_http_exception(e)
+      if code in source.RATE_LIMIT_HTTP_CODES:
+        source.record_rate_limit(e)
       if (code and (code in source.RATE_LIMIT_HTTP_CODES or
                     code in ('400', '404') or
                     int(code) / 100 == 5)
@@ -535,11 +760,22 @@ class SendWebmentions(webapp2.RequestHandler):
   Attributes:
 
   * entity: :class:`models.Webmentions` subclass instance (set in :meth:`lease_entity`)
-  * source: :class:`models.Source` entity (set in :meth:`send_webmentions`)
+  * source: :class:`models.Source` entity. Subclasses may load it before
+    :meth:`send_webmentions`, which only loads it if they don't.
+  * coalesced: boolean, True if self.entity was leased by another entity's task
+    and sent along with it. Its own task is still in the queue.
   """
+  source = None
+  coalesced = False
 
   # request deadline (10m) plus some padding
   LEASE_LENGTH = datetime.timedelta(minutes=12)
+  # max number of webmentions to send at once
+  MAX_THREADS = 5
+  # retries for individual targets that error. see _prepare_targets().
+  TARGET_MAX_ATTEMPTS = 8
+  TARGET_MIN_BACKOFF = datetime.timedelta(minutes=2)
+  TARGET_MAX_BACKOFF = datetime.timedelta(hours=4)
 
   def source_url(self, target_url):
     """Return the source URL to use for a given target URL.
@@ -554,34 +790,100 @@ class SendWebmentions(webapp2.RequestHandler):
     """
     raise NotImplementedError()
 
-  def send_webmentions(self):
+  def send_webmentions(self, others=()):
     """Tries to send each unsent webmention in self.entity.
 
     Uses :meth:`source_url()` to determine the source parameter for each
     webmention.
 
     :meth:`lease()` *must* be called before this!
+
+    Args:
+      others: sequence of :class:`SendWebmentions` for other leased entities to
+        send at the same time. See :meth:`do_send_webmentions`.
     """
-    logging.info('Starting %s', self.entity.label())
+    handlers = [self] + list(others)
+    for handler in handlers:
+      logging.info('Starting %s', handler.entity.label())
+      if not handler.source:
+        handler.source = handler.entity.source.get()
 
-    self.source = self.entity.source.get()
     try:
-      self.do_send_webmentions()
+      self.do_send_webmentions(others)
     except:
       logging.info('Propagate task failed', exc_info=True)
-      self.release('error')
+      for handler in handlers:
+        handler.release('error')
       raise
 
-  def do_send_webmentions(self):
-    urls = self.entity.unsent + self.entity.error + self.entity.failed
+  def do_send_webmentions(self, others=()):
+    """Sends the webmentions for self.entity and others' entities together.
+
+    Webmentions to the same target are sent one after another so that we only
+    discover its endpoint once, and each source's last_webmention_sent is only
+    updated once. Different targets are sent concurrently. Each entity still
+    gets its own status.
+
+    Args:
+      others: sequence of :class:`SendWebmentions`
+    """
+    handlers = [self] + list(others)
+    pairs = []  # (handler, target, source URL)
+    for handler in handlers:
+      for target in handler._prepare_targets():
+        pairs.append((handler, target, handler.source_url(target)))
+
+    results = self._send_coalesced(pairs)
+
+    sent = collections.OrderedDict()  # maps source key to (handler, mentions)
+    for handler in handlers:
+      handler_results = [(target, result) for (h, target, _), result
+                         in zip(pairs, results) if h is handler]
+      mentions = handler._handle_results(handler_results)
+      if mentions:
+        sent.setdefault(handler.source.key, (handler, []))[1].extend(mentions)
+
+    for handler, mentions in sent.values():
+      handler.record_source_webmention(mentions)
+
+    util.webmention_endpoint_cache.flush_stats()
+    try:
+      for handler in handlers:
+        handler._finish()
+    finally:
+      # even if finishing failed, these webmentions were sent
+      self.put_source_updates([handler for handler, _ in sent.values()])
+
+  def _prepare_targets(self):
+    """Rechecks and normalizes self.entity's targets and moves them to unsent.
+
+    Error and failed targets that the retry ledger says aren't due yet, or that
+    we've given up on, are left where they are. See
+    :meth:`models.Webmentions.retries`.
+
+    Returns:
+      list of string target URLs to send to
+    """
+    retries = self.entity.retries()
+    now = util.now_fn()
+
+    def due(url):
+      _, next = retries.get(url, (0, now))
+      return next is not None and next <= now
+
+    retrying = [url for url in self.entity.error + self.entity.failed if due(url)]
+    urls = self.entity.unsent + retrying
     unsent = set()
-    self.entity.error = []
-    self.entity.failed = []
+    self.entity.error = [url for url in self.entity.error if not due(url)]
+    self.entity.failed = [url for url in self.entity.failed if not due(url)]
+    if self.entity.error:
+      logging.info('Holding back %d error target(s) until they\'re due: %s',
+                   len(self.entity.error), ' '.join(self.entity.error))
 
-    for orig_url in urls:
-      # recheck the url here since the checks may have failed during the poll
-      # or streaming add.
-      url, domain, ok = util.get_webmention_target(orig_url)
+    # recheck the urls here since the checks may have failed during the poll
+    # or streaming add.
+    for orig_url, (url, domain, ok) in zip(urls,
+                                           util.get_webmention_targets(urls)):
       if ok:
         if len(url) <= _MAX_STRING_LENGTH:
           unsent.add(url)
@@ -590,49 +892,63 @@ class SendWebmentions(webapp2.RequestHandler):
                        _MAX_STRING_LENGTH, url)
           self.entity.failed.append(orig_url)
     self.entity.unsent = sorted(unsent)
+    return list(self.entity.unsent)
 
-    while self.entity.unsent:
-      target = self.entity.unsent.pop(0)
-      source_url = self.source_url(target)
-      logging.info('Webmention from %s to %s', source_url, target)
-
-      # see if we've cached webmention discovery for this domain. the cache
-      # value is a string URL endpoint if discovery succeeded, a
-      # WebmentionSend error dict if it failed (semi-)permanently, or None.
-      cache_key = util.webmention_endpoint_cache_key(target)
-      cached = memcache.get(cache_key)
-      if cached:
-        logging.info('Using cached webmention endpoint %r: %s', cache_key, cached)
-
-      # send! and handle response or error
-      error = None
-      if isinstance(cached, dict):
-        error = cached
-      else:
-        mention = send.WebmentionSend(source_url, target, endpoint=cached)
-        headers = util.request_headers(source=self.source)
-        logging.info('Sending...')
-        try:
-          if not mention.send(timeout=999, headers=headers):
-            error = mention.error
-        except BaseException, e:
-          logging.info('', exc_info=True)
-          error = getattr(mention, 'error')
-          if not error:
-            error = ({'code': 'BAD_TARGET_URL', 'http_status': 499}
-                     if 'DNS lookup failed for URL:' in str(e)
-                     else {'code': 'EXCEPTION'})
-
-      error_code = error['code'] if error else None
-      if error_code != 'BAD_TARGET_URL' and not cached:
-        val = error if error_code == 'NO_ENDPOINT' else mention.receiver_endpoint
-        memcache.set(cache_key, val, time=WEBMENTION_DISCOVERY_CACHE_TIME)
+  def _send_coalesced(self, pairs):
+    """Sends webmentions, grouped by target.
 
+    Args:
+      pairs: sequence of (:class:`SendWebmentions`, target URL, source URL)
+
+    Returns:
+      list of :meth:`_send_webmention` results, in the same order as pairs
+    """
+    groups = collections.OrderedDict()
+    for i, (_, target, _) in enumerate(pairs):
+      groups.setdefault(target, []).append(i)
+
+    results = [None] * len(pairs)
+
+    def send_group(indices):
+      # the first send caches the endpoint (or NO_ENDPOINT), the rest use it
+      delay = None
+      for i in indices:
+        handler, target, source_url = pairs[i]
+        results[i] = ((None, None, delay) if delay
+                      else handler._send_webmention(source_url, target))
+        delay = results[i][2]
+
+    util.run_concurrently([lambda indices=indices: send_group(indices)
+                           for indices in groups.values()],
+                          max_threads=self.MAX_THREADS)
+    return results
+
+  def _handle_results(self, results):
+    """Moves self.entity's targets to sent, error, failed, or skipped.
+
+    Args:
+      results: sequence of (target URL, :meth:`_send_webmention` result)
+
+    Returns:
+      list of :class:`webmentiontools.send.WebmentionSend` that were sent
+    """
+    sent = []
+    self.deferred = []
+    self.errored = []
+    retries = self.entity.retries()
+    for target, (mention, error, delay) in results:
+      if delay:
+        # leave it in unsent for a later task
+        self.deferred.append(delay)
+        continue
+
+      attempts = retries.pop(target, (0, None))[0]
       if error is None:
         logging.info('Sent! %s', mention.response)
-        self.record_source_webmention(mention)
+        sent.append(mention)
         self.entity.sent.append(target)
       else:
+        error_code = error['code']
         status = error.get('http_status', 0)
         if (error_code == 'NO_ENDPOINT' or
             (error_code == 'BAD_TARGET_URL' and status == 204)):  # No Content
@@ -642,19 +958,115 @@ class SendWebmentions(webapp2.RequestHandler):
           # Give up on 4XX errors; we don't expect later retries to succeed.
           logging.info('Giving up this target. %s', error)
           self.entity.failed.append(target)
+        elif attempts + 1 >= self.TARGET_MAX_ATTEMPTS:
+          logging.info('Giving up this target after %d attempts. %s',
+                       attempts + 1, error)
+          self.entity.failed.append(target)
+          retries[target] = (attempts + 1, None)
         else:
           self.fail('Error sending to endpoint: %s' % error, level=logging.INFO)
           self.entity.error.append(target)
+          self.errored.append(target)
+          backoff = min(self.TARGET_MIN_BACKOFF * 2 ** attempts,
+                        self.TARGET_MAX_BACKOFF)
+          retries[target] = (attempts + 1, util.now_fn() + backoff)
+
+      self.entity.unsent.remove(target)
+
+    self.entity.set_retries(retries)
+    return sent
 
-      if target in self.entity.unsent:
-        self.entity.unsent.remove(target)
+  def _finish(self):
+    """Completes or releases self.entity after sending.
 
+    If self.entity still has targets to retry later, we usually add a new task
+    for it, but not if it was coalesced, since its own task will retry it.
+    """
     if self.entity.error:
       logging.info('Propagate task failed')
       self.release('error')
+      if self.coalesced:
+        logging.info("Leaving error targets to this entity's own task")
+      elif not self.errored:
+        # all of the error targets were held back, so this task didn't fail and
+        # the queue won't retry it. add a new task for when the next is due.
+        retries = self.entity.retries()
+        next = min(retries[url][1] for url in self.entity.error)
+        countdown = max((next - util.now_fn()).total_seconds(), 0)
+        logging.info('Retrying error targets in %ss', countdown)
+        self.entity.add_task(countdown=countdown)
+    elif self.deferred:
+      countdown = max(self.deferred).total_seconds()
+      logging.info('Deferring %d target(s) by %ss', len(self.deferred), countdown)
+      self.release('new')
+      if not self.coalesced:
+        self.entity.add_task(countdown=countdown)
     else:
       self.complete()
 
+  def _send_webmention(self, source_url, target):
+    """Sends a single webmention. Thread safe.
+
+    Args:
+      source_url: string
+      target: string URL
+
+    Returns:
+      (:class:`webmentiontools.send.WebmentionSend` or None, error, delay)
+      tuple. error is None if the webmention was sent successfully, otherwise
+      a WebmentionSend error dict. delay is a :class:`datetime.timedelta` if
+      the target's host is over its :class:`util.HostLimiter` limits and we
+      should try again later, otherwise None.
+    """
+    logging.info('Webmention from %s to %s', source_url, target)
+
+    # see if we've cached webmention discovery for this domain. the cache
+    # value is a string URL endpoint if discovery succeeded, a
+    # WebmentionSend error dict if it failed (semi-)permanently, or None.
+    cached = util.webmention_endpoint_cache.get(target)
+    if cached:
+      logging.info('Using cached webmention endpoint for %s: %s', target, cached)
+
+    # send! and handle response or error
+    if isinstance(cached, dict):
+      return None, cached, None
+
+    # be polite to the target's host
+    limiter = util.HostLimiter(util.domain_from_link(target))
+    delay = limiter.acquire()
+    if delay:
+      logging.info('Over limits for host; deferring by %s', delay)
+      return None, None, delay
+
+    error = None
+    mention = send.WebmentionSend(source_url, target, endpoint=cached)
+    headers = util.request_headers(source=self.source)
+    logging.info('Sending...')
+    try:
+      if not mention.send(timeout=999, headers=headers):
+        error = mention.error
+    except BaseException, e:
+      logging.info('', exc_info=True)
+      error = getattr(mention, 'error')
+      if not error:
+        error = ({'code': 'BAD_TARGET_URL', 'http_status': 499}
+                 if 'DNS lookup failed for URL:' in str(e)
+                 else {'code': 'EXCEPTION'})
+    finally:
+      limiter.release()
+
+    error_code = error['code'] if error else None
+    if error is None:
+      limiter.record_success()
+    elif error_code == 'EXCEPTION' or error.get('http_status', 0) // 100 == 5:
+      limiter.record_failure()
+
+    if error_code != 'BAD_TARGET_URL' and not cached:
+      util.webmention_endpoint_cache.set(
+        target, error if error_code == 'NO_ENDPOINT' else mention.receiver_endpoint)
+
+    return mention, error, None
+
   @ndb.transactional
   def lease(self, key):
     """Attempts to acquire and lease the :class:`models.Webmentions` entity.
@@ -730,25 +1142,63 @@ class SendWebmentions(webapp2.RequestHandler):
     logging.log(level, message)
     self.response.out.write(message)
 
-  @ndb.transactional
-  def record_source_webmention(self, mention):
-    """Sets this source's last_webmention_sent and maybe webmention_endpoint.
+  def record_source_webmention(self, mentions):
+    """Records last_webmention_sent and maybe webmention_endpoint for the source.
+
+    Doesn't write them! They're accumulated in self.source.updates and written
+    once per task by :meth:`put_source_updates`.
 
     Args:
-      mention: :class:`webmentiontools.send.WebmentionSend`
+      mentions: non-empty sequence of :class:`webmentiontools.send.WebmentionSend`
     """
-    self.source = self.source.key.get()
+    updates = self.source.updates = self.source.updates or {}
     logging.info('Setting last_webmention_sent')
-    self.source.last_webmention_sent = util.now_fn()
+    updates['last_webmention_sent'] = util.now_fn()
+
+    for mention in mentions:
+      if util.domain_from_link(mention.target_url) in self.source.domains:
+        if mention.receiver_endpoint != self.source.webmention_endpoint:
+          logging.info('Also setting webmention_endpoint to %s (discovered in %s; was %s)',
+                       mention.receiver_endpoint, mention.target_url,
+                       self.source.webmention_endpoint)
+          updates['webmention_endpoint'] = mention.receiver_endpoint
+        break
+
+  @staticmethod
+  def put_source_updates(handlers):
+    """Writes the handlers' accumulated source updates.
+
+    Uses :meth:`models.Source.put_updates_multi`, so this is one transaction
+    for up to :const:`models.MAX_XG_ENTITY_GROUPS` sources. If that fails, e.g.
+    due to contention on one of the sources, falls back to writing each
+    source's updates in its own transaction so that one bad source doesn't lose
+    the others' updates. The webmentions were already sent, so datastore errors
+    here are logged and otherwise ignored instead of failing (and retrying) the
+    task.
 
-    if (mention.receiver_endpoint != self.source.webmention_endpoint and
-        util.domain_from_link(mention.target_url) in self.source.domains):
-      logging.info('Also setting webmention_endpoint to %s (discovered in %s; was %s)',
-                   mention.receiver_endpoint, mention.target_url,
-                   self.source.webmention_endpoint)
-      self.source.webmention_endpoint = mention.receiver_endpoint
+    Args:
+      handlers: sequence of :class:`SendWebmentions`
+    """
+    sources = {}
+    for handler in handlers:
+      if handler.source.updates:
+        sources[handler.source.key] = handler.source
+    if not sources:
+      return
+
+    try:
+      models.Source.put_updates_multi(sources.values())
+      return
+    except datastore_errors.Error:
+      logging.warning('Batch source updates failed, falling back to one at a '
+                      'time', exc_info=True)
 
-    self.source.put()
+    for key, source in sources.items():
+      try:
+        models.Source.put_updates(source)
+      except datastore_errors.Error:
+        logging.warning("Couldn't record sent webmentions for %s",
+                        key.string_id(), exc_info=True)
 
 
 class PropagateResponse(SendWebmentions):
@@ -757,21 +1207,36 @@ class PropagateResponse(SendWebmentions):
   Attributes:
 
   * activities: parsed :attr:`models.Response.activities_json` list
+  * urls_to_activity: parsed :attr:`models.Response.urls_to_activity` dict
 
   Request parameters:
 
   * response_key: string key of :class:`models.Response` entity
   """
 
+  # max number of other new responses with the same targets to send along with
+  # this one. see lease_coalesced().
+  MAX_COALESCED = 10
+
   def post(self):
     logging.debug('Params: %s', self.request.params)
     if not self.lease(ndb.Key(urlsafe=self.request.params['response_key'])):
       return
 
-    source = self.entity.source.get()
+    if self.check_response():
+      self.send_webmentions(others=self.lease_coalesced())
+
+  def check_response(self):
+    """Checks that self.entity should be propagated and loads its source and
+    activities.
+
+    Returns:
+      boolean, True if it should be propagated, False if it was dropped
+    """
+    source = self.source = self.entity.source.get()
     if not source:
       logging.warning('Source not found! Dropping response.')
-      return
+      return False
     logging.info('Source: %s %s, %s', source.label(), source.key.string_id(),
                  source.bridgy_url(self))
     poll_estimate = self.entity.created - datetime.timedelta(seconds=61)
@@ -779,23 +1244,60 @@ class PropagateResponse(SendWebmentions):
                  logs.url(poll_estimate, source.key))
 
     self.activities = [json.loads(a) for a in self.entity.activities_json]
+    self.urls_to_activity = (json.loads(self.entity.urls_to_activity)
+                             if self.entity.urls_to_activity else None)
     response_obj = json.loads(self.entity.response_json)
     if (not source.is_activity_public(response_obj) or
         not all(source.is_activity_public(a) for a in self.activities)):
       logging.info('Response or activity is non-public. Dropping.')
       self.complete()
-      return
+      return False
 
-    self.send_webmentions()
+    return True
+
+  def lease_coalesced(self):
+    """Leases other new responses with the same targets as self.entity.
+
+    Bursts of responses to the same post all have the same targets, so we send
+    their webmentions together. Their own propagate tasks then find them
+    complete, or retry them if they failed.
+
+    Returns:
+      list of :class:`PropagateResponse` handlers with leased entities, ready
+      to send
+    """
+    targets = self.entity.unsent + self.entity.error
+    if not targets or not self.MAX_COALESCED:
+      return []
+
+    keys = Response.query(Response.status == 'new',
+                          Response.unsent.IN(targets[:MAX_ALLOWABLE_QUERIES])
+                          ).fetch(self.MAX_COALESCED + 1, keys_only=True)
+
+    others = []
+    for key in keys:
+      if key == self.entity.key or len(others) >= self.MAX_COALESCED:
+        continue
+      # separate response so that its failures don't fail this task
+      other = PropagateResponse(self.request, webapp2.Response())
+      other.coalesced = True
+      if other.lease(key):
+        if other.check_response():
+          others.append(other)
+        elif other.entity.status == 'processing':
+          other.release('new')
+
+    if others:
+      logging.info('Coalescing %d other responses with the same targets: %s',
+                   len(others), ' '.join(o.entity.key.string_id() for o in others))
+    return others
 
   def source_url(self, target_url):
     # determine which activity to use
     try:
       activity = self.activities[0]
-      if self.entity.urls_to_activity:
-        urls_to_activity = json.loads(self.entity.urls_to_activity)
-        if urls_to_activity:
-          activity = self.activities[urls_to_activity[target_url]]
+      if self.urls_to_activity:
+        activity = self.activities[self.urls_to_activity[target_url]]
     except (KeyError, IndexError):
       logging.warning("""\
 Hit https://github.com/snarfed/bridgy/issues/237 KeyError!
@@ -815,7 +1317,7 @@ activities: %s""", target_url, self.entity.urls_to_activity, self.activities)
     if domain == util.PRIMARY_DOMAIN or domain in util.OTHER_DOMAINS:
       host_url = 'https://brid-gy.appspot.com'
 
-    path = [host_url, self.entity.type, self.entity.source.get().SHORT_NAME,
+    path = [host_url, self.entity.type, self.source.SHORT_NAME,
             self.entity.source.string_id(), post_id]
 
     if self.entity.type != 'post':
@@ -845,10 +1347,10 @@ class PropagateBlogPost(SendWebmentions):
     if not self.lease(ndb.Key(urlsafe=self.request.params['key'])):
       return
 
-    source_domains = self.entity.source.get().domains
+    self.source = self.entity.source.get()
+    source_domains = self.source.domains
     to_send = set()
-    for url in self.entity.unsent:
-      url, domain, ok = util.get_webmention_target(url)
+    for url, domain, ok in util.get_webmention_targets(self.entity.unsent):
       # skip "self" links to this blog's domain
       if ok and domain not in source_domains:
         to_send.add(url)
@@ -862,6 +1364,7 @@ class PropagateBlogPost(SendWebmentions):
 
 application = webapp2.WSGIApplication([
     ('/_ah/queue/poll(-now)?', Poll),
+    ('/_ah/queue/poll-batch', BatchPoll),
     ('/_ah/queue/discover', Discover),
     ('/_ah/queue/propagate', PropagateResponse),
     ('/_ah/queue/propagate-blogpost', PropagateBlogPost),
@@ -80,9 +80,11 @@ class AppTest(testutil.ModelsTest):
       json.dumps({'url': 'https://fa.ke/3'}),
     ]
     resp.put()
-    SyndicatedPost.insert(source, 'https://fa.ke/1', 'https://orig/1')
-    SyndicatedPost.insert(source, 'https://fa.ke/2', 'http://orig/2')
-    SyndicatedPost.insert(source, 'https://fa.ke/3', 'http://orig/3')
+    index = models.SyndicatedPostIndex.for_source(source)
+    index.insert('https://fa.ke/1', 'https://orig/1')
+    index.insert('https://fa.ke/2', 'http://orig/2')
+    index.insert('https://fa.ke/3', 'http://orig/3')
+    index.commit()
 
     # cached webmention endpoint
     memcache.set('W https skipped /', 'asdf')
@@ -96,6 +96,14 @@ class CronTest(HandlerTest):
     self.assert_equals(sources[4].urlsafe(),
                        testutil.get_task_params(tasks[0])['source_key'])
 
+  def test_poll_batches(self):
+    self.mox.stubs.Set(FakeSource, 'BATCH_POLL', True)
+    resp = cron.application.get_response('/cron/poll_batches')
+    self.assertEqual(200, resp.status_int)
+    tasks = self.taskqueue_stub.GetTasks('poll-batch')
+    self.assertItemsEqual(['fake', 'twitter'],
+                          [testutil.get_task_params(t)['silo'] for t in tasks])
+
   def test_update_twitter_pictures(self):
     sources = []
     for screen_name in ('a', 'b', 'c'):
@@ -499,22 +499,32 @@ class FacebookPageTest(testutil.ModelsTest):
     }
     self.fb.put()
 
+  def insert_syndicated_post(self, syndication, original):
+    """Stores a SyndicatedPost the way original post discovery does."""
+    index = models.SyndicatedPostIndex.for_source(self.fb)
+    if syndication:
+      syndpost = index.insert(syndication, original)
+    else:
+      syndpost = index.insert_original_blank(original)
+    index.commit()
+    return syndpost
+
   def test_on_new_syndicated_post_infer_username(self):
     # username is already set
-    models.SyndicatedPost.insert(self.fb, original='http://or.ig',
-                                 syndication='http://facebook.com/fooey/posts/123')
+    self.insert_syndicated_post('http://facebook.com/fooey/posts/123',
+                                'http://or.ig')
     fb = self.fb.key.get()
     self.assertIsNone(fb.inferred_username)
 
     # url has original user id, not username
     fb.username = None
     fb.put()
-    models.SyndicatedPost.insert(self.fb, original='http://an.other',
-                                 syndication='http://facebook.com/212038/posts/123')
+    self.insert_syndicated_post('http://facebook.com/212038/posts/123',
+                                'http://an.other')
     self.assertIsNone(fb.key.get().inferred_username)
 
     # no syndication url in SyndicatedPost
-    models.SyndicatedPost.insert_original_blank(self.fb, original='http://x')
+    self.insert_syndicated_post(None, 'http://x')
     self.assertIsNone(fb.key.get().inferred_username)
 
     # should infer username
@@ -522,9 +532,8 @@ class FacebookPageTest(testutil.ModelsTest):
     self.expect_api_call(API_OBJECT % ('212038', '123'),
                          {'id': '0', 'object_id': '123'})
     self.mox.ReplayAll()
-    syndpost = models.SyndicatedPost.insert(
-      self.fb, original='http://fin.al',
-      syndication='http://facebook.com/fooey/posts/123')
+    syndpost = self.insert_syndicated_post(
+      'http://facebook.com/fooey/posts/123', 'http://fin.al')
     self.assertEquals('fooey', fb.key.get().inferred_username)
     self.assertEquals('https://www.facebook.com/212038/posts/123',
                       syndpost.syndication)
@@ -537,9 +546,8 @@ class FacebookPageTest(testutil.ModelsTest):
                          {'id': '0', 'object_id': '456'})
     self.mox.ReplayAll()
 
-    syndpost = models.SyndicatedPost.insert(
-      self.fb, original='http://aga.in',
-      syndication='https://www.facebook.com/101008675309/posts/456')
+    syndpost = self.insert_syndicated_post(
+      'https://www.facebook.com/101008675309/posts/456', 'http://aga.in')
     self.assertEquals(['101008675309'], self.fb.key.get().inferred_user_ids)
     self.assertEquals('https://www.facebook.com/212038/posts/456',
                       syndpost.syndication)
@@ -549,9 +557,8 @@ class FacebookPageTest(testutil.ModelsTest):
     self.fb.inferred_user_ids = ['789']
     self.fb.put()
 
-    syndpost = models.SyndicatedPost.insert(
-      self.fb, original='http://aga.in',
-      syndication='https://www.facebook.com/789/posts/456')
+    syndpost = self.insert_syndicated_post(
+      'https://www.facebook.com/789/posts/456', 'http://aga.in')
     self.assertEquals(['789'], self.fb.key.get().inferred_user_ids)
     self.assertEquals('https://www.facebook.com/789/posts/456',
                       syndpost.syndication)
@@ -8,6 +8,7 @@ import json
 from unittest import skip
 
 import appengine_config
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 import mox
 import requests
@@ -141,6 +142,90 @@ class ResponseTest(testutil.ModelsTest):
       self.assertEqual([], field)
     self.assert_propagate_task()
 
+  def test_get_or_save_multi(self):
+    source = self.sources[0]
+    self.responses[1].unsent = []
+    saved = Response.get_or_save_multi(self.responses[:3], source)
+    self.assert_entities_equal(self.responses[:3], saved)
+    self.assert_entities_equal(self.responses[:3], Response.query().fetch(),
+                               ignore=('created', 'updated'))
+    self.assertEqual('complete', self.responses[1].key.get().status)
+
+    # one batch of tasks, only for responses with targets
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assert_equals([self.responses[0].key, self.responses[2].key],
+                       [ndb.Key(urlsafe=testutil.get_task_params(t)['response_key'])
+                        for t in tasks])
+    self.taskqueue_stub.FlushQueue('propagate')
+
+    # existing and unchanged. no new tasks.
+    Response.get_or_save_multi(self.responses[:3], source)
+    self.assert_no_propagate_task()
+
+    # one changed, one new
+    changed = Response(**self.responses[0].to_dict())
+    changed.key = self.responses[0].key
+    reply = json.loads(changed.response_json)
+    reply['content'] = 'new content'
+    changed.response_json = json.dumps(reply)
+
+    saved = Response.get_or_save_multi([changed, self.responses[1],
+                                        self.responses[3]], source)
+    self.assertEqual('new', saved[0].status)
+    self.assert_equals([self.responses[0].response_json],
+                       saved[0].old_response_jsons)
+    self.assertEqual(changed.response_json,
+                     self.responses[0].key.get().response_json)
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assert_equals([self.responses[0].key, self.responses[3].key],
+                       [ndb.Key(urlsafe=testutil.get_task_params(t)['response_key'])
+                        for t in tasks])
+
+  def test_get_or_save_multi_task_failure_restores_changed(self):
+    source = self.sources[0]
+    self.responses[0].status = 'complete'
+    self.responses[0].put()
+    stored = self.responses[0].key.get()
+
+    changed = Response(**self.responses[0].to_dict())
+    changed.key = self.responses[0].key
+    reply = json.loads(changed.response_json)
+    reply['content'] = 'new content'
+    changed.response_json = json.dumps(reply)
+
+    self.mox.StubOutWithMock(util, 'add_propagate_tasks')
+    util.add_propagate_tasks(mox.IgnoreArg()).AndRaise(
+      taskqueue.TransientError())
+    self.mox.ReplayAll()
+
+    with self.assertRaises(taskqueue.TransientError):
+      Response.get_or_save_multi([changed, self.responses[1]], source)
+
+    # the changed response should be back the way it was, so that the next poll
+    # sees it as changed again, and the new one should be gone
+    self.assert_entities_equal([stored], [self.responses[0].key.get()])
+    self.assertIsNone(self.responses[1].key.get())
+
+  def test_get_or_save_multi_restart(self):
+    source = self.sources[0]
+    self.responses[0].status = 'complete'
+    self.responses[0].sent = self.responses[0].unsent
+    self.responses[0].unsent = []
+    self.responses[0].put()
+
+    self.responses[1].put()
+
+    # cached endpoints for all of the restarted responses are cleared at once
+    self.mox.StubOutWithMock(util.webmention_endpoint_cache, 'delete')
+    util.webmention_endpoint_cache.delete(
+      ['http://target1/post/url', 'http://target1/post/url'])
+    self.mox.ReplayAll()
+
+    saved = Response.get_or_save_multi(self.responses[:2], source, restart=True)
+    self.assertEqual('new', saved[0].status)
+    self.assertEqual(['http://target1/post/url'], saved[0].unsent)
+    self.assertEqual(2, len(self.taskqueue_stub.GetTasks('propagate')))
+
   def test_get_or_save_objectType_note(self):
     self.responses[0].response_json = json.dumps({
       'objectType': 'note',
@@ -557,6 +642,23 @@ class SourceTest(testutil.HandlerTest):
     finally:
       del FakeSource._pre_put_hook
 
+  def test_put_updates_multi(self):
+    sources = [FakeSource.new(None) for i in range(models.MAX_XG_ENTITY_GROUPS + 2)]
+    ndb.put_multi(sources)
+    for i, source in enumerate(sources):
+      if i != 1:
+        source.updates = {'poll_status': 'polling', 'name': 'updated %d' % i}
+
+    updated = Source.put_updates_multi(sources)
+    self.assertEquals([s.key for s in sources], [s.key for s in updated])
+    for i, source in enumerate(sources):
+      stored = source.key.get()
+      if i == 1:
+        self.assertEquals('ok', stored.poll_status)
+      else:
+        self.assertEquals('polling', stored.poll_status)
+        self.assertEquals('updated %d' % i, stored.name)
+
   def test_poll_period(self):
     source = FakeSource.new(None)
     source.put()
@@ -576,6 +678,97 @@ class SourceTest(testutil.HandlerTest):
     source.rate_limited = True
     self.assertEqual(source.RATE_LIMITED_POLL, source.poll_period())
 
+  def test_poll_period_adaptive(self):
+    source = FakeSource.new(None)
+    source.created = datetime.datetime(2000, 1, 1)
+    source.poll_response_observations = source.ADAPTIVE_POLL_MIN_OBSERVATIONS
+
+    # no responses lately
+    source.poll_response_rate = 0.0
+    self.assertEqual(source.ADAPTIVE_POLL_MAX, source.poll_period())
+
+    # the last webmention sent bounds the period
+    now = datetime.datetime.now()
+    source.last_webmention_sent = now
+    self.assertEqual(source.FAST_POLL, source.poll_period())
+    source.last_webmention_sent = now - datetime.timedelta(days=8)
+    self.assertEqual(source.FAST_POLL * 10, source.poll_period())
+
+    # one response every 4h
+    source.poll_response_rate = .25
+    self.assertEqual(datetime.timedelta(hours=4), source.poll_period())
+
+    # lots of responses, but bounded
+    source.poll_response_rate = 100.0
+    self.assertEqual(source.ADAPTIVE_POLL_MIN, source.poll_period())
+
+    # busier at this time of day
+    source.poll_response_rate = .25
+    source.poll_hourly_response_rates = [.5] * 24
+    self.assertEqual(datetime.timedelta(hours=2), source.poll_period())
+
+    # not enough observations yet
+    source.poll_response_observations = source.ADAPTIVE_POLL_MIN_OBSERVATIONS - 1
+    self.assertEqual(source.FAST_POLL * 10, source.poll_period())
+
+    # grace period still wins
+    source.poll_response_observations = source.ADAPTIVE_POLL_MIN_OBSERVATIONS
+    source.created = datetime.datetime.now()
+    source.poll_response_rate = 0.0
+    self.assertEqual(source.FAST_POLL, source.poll_period())
+
+  def test_poll_period_adaptive_cold_start(self):
+    """An active source's first empty polls shouldn't slow it down."""
+    source = FakeSource.new(None)
+    source.created = datetime.datetime(2000, 1, 1)
+    now = datetime.datetime.now()
+    source.last_webmention_sent = now - datetime.timedelta(minutes=5)
+    source.last_polled = now - source.FAST_POLL
+    source.last_poll_attempt = now
+
+    for _ in range(source.ADAPTIVE_POLL_MIN_OBSERVATIONS):
+      source.updates = {}
+      source.record_poll_responses(0)
+      source.populate(**source.updates)
+      self.assertEqual(source.FAST_POLL, source.poll_period())
+
+    # the estimate started from the active rate, and half hours of nothing
+    # haven't moved it far
+    self.assertGreater(source.poll_response_rate, 1.0)
+
+  def test_record_poll_responses(self):
+    source = FakeSource.new(None)
+    source.updates = {}
+
+    # never polled successfully before, so no estimate
+    source.record_poll_responses(5)
+    self.assertEqual({}, source.updates)
+
+    # first estimate starts from the slow poll rate, since this source has never
+    # sent a webmention. each hour of this observation has weight .05.
+    source.last_poll_attempt = datetime.datetime(2000, 1, 1, 10)
+    source.last_polled = datetime.datetime(2000, 1, 1, 8)
+    source.record_poll_responses(4)
+    weight = 1 - .95 ** 2
+    seed = 1 / 24.0
+    rate = weight * 2.0 + (1 - weight) * seed
+    self.assertAlmostEqual(rate, source.updates['poll_response_rate'])
+    hourly = source.updates['poll_hourly_response_rates']
+    self.assertAlmostEqual(rate, hourly[10])
+    for other in hourly[:10] + hourly[11:]:
+      self.assertAlmostEqual(seed, other)
+    self.assertEqual(1, source.updates['poll_response_observations'])
+
+    source.poll_response_rate = 2.0
+    source.poll_hourly_response_rates = [2.0] * 24
+    source.poll_response_observations = 1
+    source.record_poll_responses(0)
+    self.assertAlmostEqual(2.0 * .95 ** 2, source.updates['poll_response_rate'])
+    hourly = source.updates['poll_hourly_response_rates']
+    self.assertAlmostEqual(2.0 * .95 ** 2, hourly[10])
+    self.assertEqual([2.0] * 23, hourly[:10] + hourly[11:])
+    self.assertEqual(2, source.updates['poll_response_observations'])
+
   def test_should_refetch(self):
     source = FakeSource.new(None)  # haven't found a synd url yet
     self.assertFalse(source.should_refetch())
@@ -599,6 +792,38 @@ class SourceTest(testutil.HandlerTest):
     source.last_hfeed_refetch -= (Source.SLOW_REFETCH + hour)
     self.assertTrue(source.should_refetch())
 
+    # subscribed to the h-feed with WebSub, but its entries may still get
+    # syndication links on their permalinks, so keep refetching
+    source.last_hfeed_refetch = testutil.NOW - Source.SLOW_REFETCH - hour
+    now = datetime.datetime.now()
+    first_seen = now - models.REFETCH_UNCHANGED_PERMALINKS_FOR + hour
+    source.hfeed_entry_hashes_json = json.dumps({'http://author/': {
+      'http://author/post': ['abc', first_seen.strftime(
+        models.HFEED_ENTRY_HASH_TIME_FORMAT)],
+    }})
+    source.set_websub_subscriptions({'http://author/feed': (
+      'http://author/', 'http://hub/', now, now + datetime.timedelta(days=1))})
+    self.assertTrue(source.should_refetch())
+
+    # entries have settled, so only refetch as a fallback
+    first_seen -= 2 * hour
+    source.hfeed_entry_hashes_json = json.dumps({'http://author/': {
+      'http://author/post': ['abc', first_seen.strftime(
+        models.HFEED_ENTRY_HASH_TIME_FORMAT)],
+    }})
+    self.assertFalse(source.should_refetch())
+
+    # another author URL isn't subscribed
+    hashes = json.loads(source.hfeed_entry_hashes_json)
+    hashes['http://other/'] = {}
+    source.hfeed_entry_hashes_json = json.dumps(hashes)
+    self.assertTrue(source.should_refetch())
+    del hashes['http://other/']
+    source.hfeed_entry_hashes_json = json.dumps(hashes)
+
+    source.last_hfeed_refetch -= Source.WEBSUB_REFETCH
+    self.assertTrue(source.should_refetch())
+
   def test_is_beta_user(self):
     source = Source(id='x')
     self.assertFalse(source.is_beta_user())
@@ -675,13 +900,81 @@ class SyndicatedPostTest(testutil.ModelsTest):
     for r in self.relationships:
       r.put()
 
+  def test_index(self):
+    index = models.SyndicatedPostIndex.for_source(self.source)
+    self.assertIs(index, models.SyndicatedPostIndex.for_source(self.source))
+
+    self.assert_entities_equal(self.relationships[:2],
+                               index.by_original('http://original/post/url'))
+    self.assert_entities_equal([self.relationships[0], self.relationships[2]],
+                               index.by_syndication('http://silo/post/url'))
+    self.assertEquals([], index.by_original('http://unknown'))
+
+    # inserting a relationship should stage deleting the blanks for its URLs
+    r = index.insert(original='http://original/no-syndication',
+                     syndication='http://silo/no-original')
+    self.assert_entities_equal(
+      [r], index.by_original('http://original/no-syndication'))
+    self.assert_entities_equal(
+      [r], index.by_syndication('http://silo/no-original'))
+    self.assertIs(r, index.insert(original='http://original/no-syndication',
+                                  syndication='http://silo/no-original'))
+    self.assertIsNone(index.insert_original_blank('http://original/post/url'))
+
+    # nothing is written until commit
+    self.assertEquals(5, SyndicatedPost.query().count())
+    index.commit()
+    self.assert_entities_equal(self.relationships[:3] + [r],
+                               SyndicatedPost.query())
+
+    index.delete(r)
+    self.assertEquals([], index.by_original('http://original/no-syndication'))
+    index.commit()
+    self.assertIsNone(r.key.get())
+
+  def test_index_commit_conflict(self):
+    index = models.SyndicatedPostIndex.for_source(self.source)
+    blank = index.insert_original_blank('http://original/new')
+    self.assertIsNotNone(blank)
+
+    # another request stores a relationship for the same original first
+    other = models.SyndicatedPostIndex(self.source.key)
+    r = other.insert('http://silo/new', 'http://original/new')
+    other.commit()
+    index.commit()
+
+    # the blank shouldn't be stored, and the index should reload
+    self.assert_entities_equal(
+      [r], SyndicatedPost.query(SyndicatedPost.original == 'http://original/new',
+                                ancestor=self.source.key))
+    self.assert_entities_equal([r], index.by_original('http://original/new'))
+
+  def test_index_commit_only_loads_affected_posts(self):
+    index = models.SyndicatedPostIndex.for_source(self.source)
+    new = index.insert_syndication_blank('http://silo/new')
+    index.delete(index.by_original('http://original/no-syndication')[0])
+
+    # the commit transaction should only query for the posts with these URLs,
+    # not load all of the source's posts
+    self.mox.StubOutWithMock(models.SyndicatedPostIndex, '_load')
+    self.mox.ReplayAll()
+    index.commit()
+
+    self.assert_entities_equal(
+      [new], SyndicatedPost.query(SyndicatedPost.syndication == 'http://silo/new',
+                                  ancestor=self.source.key))
+    self.assertIsNone(SyndicatedPost.query(
+      SyndicatedPost.original == 'http://original/no-syndication',
+      ancestor=self.source.key).get())
+
   def test_insert_replaces_blanks(self):
     """Make sure we replace original=None with original=something
     when it is discovered"""
 
     # add a blank for the original too
-    SyndicatedPost.insert_original_blank(
-      self.source, 'http://original/newly-discovered')
+    index = models.SyndicatedPostIndex.for_source(self.source)
+    index.insert_original_blank('http://original/newly-discovered')
+    index.commit()
 
     self.assertTrue(
       SyndicatedPost.query(
@@ -693,9 +986,9 @@ class SyndicatedPostTest(testutil.ModelsTest):
         SyndicatedPost.original == 'http://original/newly-discovered',
         SyndicatedPost.syndication == None, ancestor=self.source.key).get())
 
-    r = SyndicatedPost.insert(
-        self.source, 'http://silo/no-original',
-        'http://original/newly-discovered')
+    r = index.insert('http://silo/no-original',
+                     'http://original/newly-discovered')
+    index.commit()
     self.assertIsNotNone(r)
     self.assertEquals('http://original/newly-discovered', r.original)
 
@@ -723,9 +1016,9 @@ class SyndicatedPostTest(testutil.ModelsTest):
     """Make sure we add newly discovered urls for a given syndication url,
     rather than overwrite them
     """
-    r = SyndicatedPost.insert(
-        self.source, 'http://silo/post/url',
-        'http://original/different/url')
+    index = models.SyndicatedPostIndex.for_source(self.source)
+    r = index.insert('http://silo/post/url', 'http://original/different/url')
+    index.commit()
     self.assertIsNotNone(r)
     self.assertEquals('http://original/different/url', r.original)
 
@@ -743,8 +1036,9 @@ class SyndicatedPostTest(testutil.ModelsTest):
   def test_get_or_insert_by_syndication_do_not_duplicate_blanks(self):
     """Make sure we don't insert duplicate blank entries"""
 
-    SyndicatedPost.insert_syndication_blank(
-      self.source, 'http://silo/no-original')
+    index = models.SyndicatedPostIndex.for_source(self.source)
+    self.assertIsNone(index.insert_syndication_blank('http://silo/no-original'))
+    index.commit()
 
     # make sure there's only one in the DB
     rs = SyndicatedPost.query(
@@ -757,8 +1051,9 @@ class SyndicatedPostTest(testutil.ModelsTest):
   def test_insert_no_duplicates(self):
     """Make sure we don't insert duplicate entries"""
 
-    r = SyndicatedPost.insert(
-      self.source, 'http://silo/post/url', 'http://original/post/url')
+    index = models.SyndicatedPostIndex.for_source(self.source)
+    r = index.insert('http://silo/post/url', 'http://original/post/url')
+    index.commit()
     self.assertIsNotNone(r)
     self.assertEqual('http://original/post/url', r.original)
 
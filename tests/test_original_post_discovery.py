@@ -3,8 +3,11 @@
 """
 from __future__ import unicode_literals
 
+import collections
 import datetime
 import json
+import threading
+import time
 
 from granary import facebook as gr_facebook
 from oauth_dropins import facebook as oauth_facebook
@@ -12,6 +15,7 @@ from requests.exceptions import HTTPError
 
 import appengine_config
 from facebook import FacebookPage
+import models
 from models import SyndicatedPost
 import original_post_discovery
 from original_post_discovery import discover, refetch
@@ -91,6 +95,8 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
 
     self.assertEquals(testutil.NOW, self.source.updates['last_syndication_url'])
     self.assertEquals(testutil.NOW, self.source.updates['last_feed_syndication_url'])
+    # we're done with the author URL's lock, so it should be gone
+    self.assertEquals({}, original_post_discovery._author_fetch_locks)
 
   def test_syndication_url_in_hfeed_with_redirect(self):
     """Like test_syndication_url_in_hfeed but u-url redirects to the
@@ -375,6 +381,42 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
     discover(self.source, self.activity)
     self.assertEquals(['author', 'other'], self.source.updates['domains'])
 
+  def test_concurrent_discover_fetches_author_once(self):
+    """Concurrent discovery for activities with the same author URL should
+    fetch it once and share what it found."""
+    self.mox.stubs.Set(util, 'MAX_THREADS', 2)
+    for i, activity in enumerate(self.activities[:2]):
+      activity['object'].update({
+        'content': 'post content without backlinks',
+        'url': 'https://fa.ke/post/url%d' % (i + 1),
+      })
+
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <link rel="feed" href="http://other/feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url1"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url2"></a>
+      </div>
+    </html>""")
+    self.expect_requests_get('http://other/feed', 'foo')
+    self.mox.ReplayAll()
+
+    already_fetched = set()
+    results = util.run_concurrently([
+      lambda activity=activity: discover(self.source, activity,
+                                         already_fetched_hfeeds=already_fetched)
+      for activity in self.activities[:2]])
+
+    self.assertEquals([(set(['http://author/post']), set())] * 2, results)
+    self.assertEquals(set(['http://author']), already_fetched)
+    self.assertEquals(['author', 'other'], self.source.updates['domains'])
+    self.assertEquals({}, original_post_discovery._author_fetch_locks)
+    self.assert_syndicated_posts(
+      ('http://author/post', 'https://fa.ke/post/url1'),
+      ('http://author/post', 'https://fa.ke/post/url2'))
+
   def test_no_h_entries(self):
     """Make sure nothing bad happens when fetching a feed without h-entries.
     """
@@ -651,6 +693,102 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
     """
     self._test_failed_post_permalink_fetch(raise_exception=True)
 
+  def test_permalink_fetches_concurrently_per_host_cap(self):
+    """Permalinks should be fetched concurrently, but only a few per host."""
+    self.mox.stubs.Set(util, 'MAX_THREADS', 6)
+    self.mox.stubs.Set(original_post_discovery,
+                       'MAX_PERMALINK_FETCHES_PER_HOST', 2)
+
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry"><a class="u-url" href="http://author/a"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://author/b"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://author/c"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://author/d"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://other/e"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://other/f"></a></div>
+    </html>""")
+    self.mox.ReplayAll()
+
+    lock = threading.Lock()
+    active = collections.Counter()
+    most = collections.Counter()
+    fetched = []
+
+    def fetch_permalink(permalink, type_ok):
+      host = util.domain_from_link(permalink)
+      with lock:
+        fetched.append(permalink)
+        active[host] += 1
+        most[host] = max(most[host], active[host])
+      time.sleep(.05)
+      with lock:
+        active[host] -= 1
+      return {'items': [], 'rels': {}}, True
+
+    self.mox.stubs.Set(original_post_discovery, '_fetch_permalink',
+                       fetch_permalink)
+    self.assert_discover([])
+
+    self.assertItemsEqual(['http://author/%s' % p for p in 'abcd'] +
+                          ['http://other/e', 'http://other/f'], fetched)
+    self.assertLessEqual(most['author'], 2)
+    self.assertLessEqual(most['other'], 2)
+    self.assertGreater(sum(most.values()), 2)
+
+  def test_failed_permalink_fetches_concurrently_not_hashed(self):
+    """Concurrently fetched permalinks that fail should be retried next time."""
+    self.mox.stubs.Set(util, 'MAX_THREADS', 3)
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry"><a class="u-url" href="http://author/ok"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://author/fail"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://author/ok2"></a></div>
+    </html>""")
+    self.mox.ReplayAll()
+
+    def fetch_permalink(permalink, type_ok):
+      if permalink == 'http://author/fail':
+        return None, False
+      return {'items': [], 'rels': {}}, True
+
+    self.mox.stubs.Set(original_post_discovery, '_fetch_permalink',
+                       fetch_permalink)
+    self.assert_discover([])
+
+    hashes = json.loads(self.source.updates['hfeed_entry_hashes_json'])
+    self.assertItemsEqual(['http://author/ok', 'http://author/ok2'],
+                          hashes['http://author'].keys())
+
+  def test_fetch_permalinks_with_other_silo_syndication_concurrently(self):
+    """Entries whose u-syndication links are all for other silos should still
+    have their permalinks fetched."""
+    self.mox.stubs.Set(util, 'MAX_THREADS', 2)
+    feed = """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/a"></a>
+        <a class="u-syndication" href="https://other.silo/a"></a>
+      </div>
+      <div class="h-entry">
+        <a class="u-url" href="http://author/b"></a>
+        <a class="u-syndication" href="https://other.silo/b"></a>
+      </div>
+    </html>"""
+    self.expect_requests_get('http://author', feed)
+    self.mox.ReplayAll()
+
+    fetched = []
+
+    def fetch_permalink(permalink, type_ok):
+      fetched.append(permalink)
+      return {'items': [], 'rels': {'syndication': ['https://fa.ke/post/url']}}, True
+
+    self.mox.stubs.Set(original_post_discovery, '_fetch_permalink',
+                       fetch_permalink)
+    self.assert_discover(['http://author/a', 'http://author/b'])
+    self.assertItemsEqual(['http://author/a', 'http://author/b'], fetched)
+
   def test_no_author_url(self):
     """Make sure something reasonable happens when the author doesn't have
     a url at all.
@@ -1051,6 +1189,137 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
     refetch(self.source)
     self.assert_syndicated_posts(('http://author/permalink', 'https://fa.ke/post/url'))
 
+  def test_unchanged_hfeed(self):
+    """If the author's h-feed hasn't changed, discover shouldn't walk its
+    permalinks again, but refetch should, using the stored feed items."""
+    for i, activity in enumerate(self.activities[:2]):
+      activity['object'].update({
+        'content': 'post content without backlinks',
+        'url': 'https://fa.ke/post/url%d' % (i + 1),
+      })
+
+    hfeed = """<html class="h-feed">
+    <a class="h-entry" href="/permalink"></a>
+    </html>"""
+    unsyndicated = """<html class="h-entry">
+    <a class="u-url" href="/permalink"></a>
+    </html>"""
+    syndicated = """<html class="h-entry">
+    <a class="u-url" href="/permalink"></a>
+    <a class="u-syndication" href="https://fa.ke/post/url1"></a>
+    </html>"""
+    conditional = dict(util.REQUEST_HEADERS, **{'If-None-Match': '"abc"'})
+
+    self.expect_requests_get('http://author', hfeed,
+                             response_headers={'ETag': '"abc"'})
+    self.expect_requests_get('http://author/permalink', unsyndicated)
+    # discover again, h-feed hasn't changed
+    self.expect_requests_get('http://author', '', status_code=304,
+                             headers=conditional)
+    # refetch, h-feed hasn't changed but the permalink has
+    self.expect_requests_get('http://author', '', status_code=304,
+                             headers=conditional)
+    self.expect_requests_get('http://author/permalink', syndicated)
+    self.mox.ReplayAll()
+
+    discover(self.source, self.activities[0])
+    discover(self.source, self.activities[1])
+    fetched = util.FetchedUrl.get_by_id('http://author')
+    self.assertEquals([{
+      'type': ['h-entry'],
+      'properties': {'url': ['http://author/permalink']},
+    }], fetched.data['items'])
+
+    self.assertEquals(['https://fa.ke/post/url1'], refetch(self.source).keys())
+    self.assert_syndicated_posts(
+      ('http://author/permalink', 'https://fa.ke/post/url1'),
+      (None, 'https://fa.ke/post/url2'))
+
+  def test_unchanged_hfeed_other_source(self):
+    """An unchanged h-feed that we walked for one source should still be walked
+    for another source with the same author URL."""
+    other = self.sources[1]
+    other.domain_urls = ['http://author']
+    other.domains = ['author']
+    other.put()
+    other.updates = {}
+
+    self.activities[1]['object'].update({
+      'content': 'post content without backlinks',
+      'url': 'https://fa.ke/post/url2',
+    })
+
+    hfeed = """<html class="h-feed">
+    <a class="h-entry" href="/permalink"></a>
+    </html>"""
+    self.expect_requests_get('http://author', hfeed,
+                             response_headers={'ETag': '"abc"'})
+    self.expect_requests_get('http://author/permalink', """
+    <html class="h-entry">
+      <a class="u-url" href="/permalink"></a>
+      <a class="u-syndication" href="https://fa.ke/post/url2"></a>
+    </html>""")
+    # h-feed hasn't changed, but the other source hasn't walked it yet
+    self.expect_requests_get(
+      'http://author', '', status_code=304,
+      headers=dict(util.REQUEST_HEADERS, **{'If-None-Match': '"abc"'}))
+    self.expect_requests_get('http://author/permalink', """
+    <html class="h-entry">
+      <a class="u-url" href="/permalink"></a>
+      <a class="u-syndication" href="https://fa.ke/post/url2"></a>
+    </html>""")
+    self.mox.ReplayAll()
+
+    discover(self.source, self.activity)
+    self.assertEquals((set(['http://author/permalink']), set()),
+                      discover(other, self.activities[1]))
+    self.assertItemsEqual(
+      [('http://author/permalink', 'https://fa.ke/post/url2')],
+      [(r.original, r.syndication)
+       for r in SyndicatedPost.query(ancestor=other.key)])
+
+  def test_refetch_skips_unchanged_entries(self):
+    """Refetch should skip h-feed entries that haven't changed, once they've
+    been unchanged long enough that they probably won't get syndication links.
+    """
+    self.activities[0]['object'].update({
+      'content': 'post content without backlinks',
+      'url': 'https://fa.ke/post/url',
+    })
+
+    hfeed = """<html class="h-feed">
+    <div class="h-entry">
+      <a class="u-url" href="/permalink"></a>
+      %s
+    </div>
+    </html>"""
+    hentry = """<html class="h-entry">
+    <a class="u-url" href="/permalink"></a>
+    </html>"""
+
+    self.expect_requests_get('http://author', hfeed % '')
+    self.expect_requests_get('http://author/permalink', hentry)
+    # refetch soon after, still fetches the permalink
+    self.expect_requests_get('http://author', hfeed % '')
+    self.expect_requests_get('http://author/permalink', hentry)
+    # refetch a while later, skips it
+    self.expect_requests_get('http://author', hfeed % '')
+    # the entry changed, so fetch it again
+    updated = '<time class="dt-updated" datetime="2016-01-01"></time>'
+    self.expect_requests_get('http://author', hfeed % updated)
+    self.expect_requests_get('http://author/permalink', hentry)
+    self.mox.ReplayAll()
+
+    discover(self.source, self.activities[0])
+    self.assertFalse(refetch(self.source))
+
+    util.now_fn = lambda: (testutil.NOW +
+                           models.REFETCH_UNCHANGED_PERMALINKS_FOR)
+    self.assertFalse(refetch(self.source))
+    self.assertFalse(refetch(self.source))
+    self.assert_syndicated_posts(('http://author/permalink', None),
+                                 (None, 'https://fa.ke/post/url'))
+
   def test_refetch_two_permalinks_same_syndication(self):
     """
     This causes a problem if refetch assumes that syndication-url is
@@ -3,6 +3,8 @@
 """
 from __future__ import unicode_literals
 
+import base64
+import collections
 import copy
 import datetime
 import httplib
@@ -12,13 +14,14 @@ import mox
 import socket
 import string
 import StringIO
+import threading
 import time
 import urllib
 import urllib2
+import urlparse
 
 import apiclient
 from google.appengine.api import datastore_errors
-from google.appengine.api import memcache
 from google.appengine.api.datastore_types import _MAX_STRING_LENGTH
 from google.appengine.ext import ndb
 import httplib2
@@ -30,6 +33,7 @@ import appengine_config
 
 import models
 from models import Response, SyndicatedPost
+import original_post_discovery
 from twitter import Twitter
 import tasks
 from tasks import PropagateResponse
@@ -99,7 +103,8 @@ class PollTest(TaskQueueTest):
     appengine_config.DEBUG = False
     super(PollTest, self).tearDown()
 
-  def post_task(self, expected_status=200, source=None, reset=False):
+  def post_task(self, expected_status=200, source=None, reset=False,
+                last_polled=util.EPOCH):
     if source is None:
       source = self.sources[0]
 
@@ -111,7 +116,7 @@ class PollTest(TaskQueueTest):
     super(PollTest, self).post_task(
       expected_status=expected_status,
       params={'source_key': source.key.urlsafe(),
-              'last_polled': '1970-01-01-00-00-00'})
+              'last_polled': last_polled.strftime(util.POLL_TASK_DATETIME_FORMAT)})
 
   def assert_task_eta(self, countdown):
     """Checks the current poll task's eta. Handles the random range.
@@ -255,6 +260,21 @@ class PollTest(TaskQueueTest):
     self.post_task()
     self.assert_equals(['https://tar.get/a'], self.responses[0].key.get().unsent)
 
+  def test_original_post_discovery_once_per_activity(self):
+    """Responses to the same activity should share one discovery run."""
+    FakeGrSource.activities = [self.activities[0]]
+
+    self.mox.StubOutWithMock(original_post_discovery, 'discover')
+    original_post_discovery.discover(
+      mox.IgnoreArg(), mox.IgnoreArg(), fetch_hfeed=True,
+      include_redirect_sources=False, already_fetched_hfeeds=set(),
+    ).AndReturn(({'http://tar.get/a'}, set()))
+    self.mox.ReplayAll()
+
+    self.post_task()
+    for resp in Response.query():
+      self.assert_equals(['http://tar.get/a'], resp.unsent)
+
   def test_backfeed_requires_syndication_link(self):
     # trigger posse post discovery
     self.sources[0].domain_urls = ['http://author']
@@ -897,6 +917,39 @@ class PollTest(TaskQueueTest):
     finally:
       self.mox.UnsetStubs()
 
+  def test_rate_limited_until_reset(self):
+    """If the silo says when its rate limit resets, wait until then."""
+    reset = NOW + datetime.timedelta(minutes=10)
+    self.mox.StubOutWithMock(util, 'rate_limit_reset')
+    err = urllib2.HTTPError('url', 429, 'Rate limited', {}, None)
+    self.expect_get_activities().AndRaise(err)
+    util.rate_limit_reset(err).AndReturn(reset)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    source = self.sources[0].key.get()
+    self.assertEqual('error', source.poll_status)
+    self.assertFalse(source.rate_limited)
+    self.assert_task_eta(FakeSource.FAST_POLL)
+    self.taskqueue_stub.FlushQueue('poll')
+
+    # the next poll waits until the rate limit resets
+    self.post_task(last_polled=source.last_polled)
+    polls = self.taskqueue_stub.GetTasks('poll')
+    self.assertEqual(1, len(polls))
+    self.assert_task_eta(reset - NOW)
+
+  def test_over_rate_limit_budget(self):
+    """If a source is over its silo's budget, delay the poll."""
+    self.mox.stubs.Set(FakeSource, 'TOKEN_RATE_LIMIT',
+                       (1, datetime.timedelta(hours=1)))
+    self.assertEqual(datetime.timedelta(0), self.sources[0].rate_limit_delay())
+
+    self.post_task()
+    self.assertEqual(0, Response.query().count())
+    self.assertEqual(util.EPOCH, self.sources[0].key.get().last_poll_attempt)
+    self.assert_task_eta(datetime.timedelta(hours=1))
+
   def test_etag(self):
     """If we see an ETag, we should send it with the next get_activities()."""
     FakeGrSource.etag = '"my etag"'
@@ -978,6 +1031,24 @@ class PollTest(TaskQueueTest):
     self.post_task()
     self.assert_task_eta(FakeSource.FAST_POLL)
 
+  def test_adaptive_poll_period(self):
+    """Polls should record the response rate and use it to schedule."""
+    source = self.sources[0]
+    source.created = NOW - (FakeSource.FAST_POLL_GRACE_PERIOD +
+                            datetime.timedelta(minutes=1))
+    source.last_polled = source.last_poll_attempt = NOW - datetime.timedelta(hours=3)
+    source.last_webmention_sent = NOW - datetime.timedelta(days=10)
+    source.poll_response_rate = 4.0
+    source.poll_response_observations = FakeSource.ADAPTIVE_POLL_MIN_OBSERVATIONS - 1
+    source.put()
+
+    self.post_task(reset=False, source=source, last_polled=source.last_polled)
+    source = source.key.get()
+    self.assertAlmostEqual(4.0, source.poll_response_rate)  # 12 responses in 3h
+    self.assertEqual(FakeSource.ADAPTIVE_POLL_MIN_OBSERVATIONS,
+                     source.poll_response_observations)
+    self.assert_task_eta(FakeSource.ADAPTIVE_POLL_MIN)
+
   def _expect_fetch_hfeed(self):
     self.expect_requests_get('http://author', """
     <html class="h-feed">
@@ -1027,6 +1098,13 @@ class PollTest(TaskQueueTest):
     self.mox.ReplayAll()
     self.post_task()
 
+    # discover() only stages the blanks for the activities' syndication URLs.
+    # they should all be written at the end of the backfeed pass.
+    self.assertItemsEqual(
+      [self.sources[0].canonicalize_url(a['url']) for a in self.activities],
+      [p.syndication for p in models.SyndicatedPost.query(
+        models.SyndicatedPost.original == None, ancestor=self.sources[0].key)])
+
   def test_syndicated_post_does_not_prevent_fetch_hfeed(self):
     """The original fix to fetch the source's h-feed only once per task
     had a bug that prevented us from fetching the h-feed *at all* if
@@ -1045,9 +1123,10 @@ class PollTest(TaskQueueTest):
       activity['object']['content'] = 'foo bar'
 
     # set up a blank, which will short-circuit fetch for the first activity
-    SyndicatedPost.insert_syndication_blank(
-      self.sources[0],
+    index = models.SyndicatedPostIndex(self.sources[0].key)
+    index.insert_syndication_blank(
       self.sources[0].canonicalize_url(self.activities[0].get('url')))
+    index.commit()
 
     self._expect_fetch_hfeed()
     self.mox.ReplayAll()
@@ -1215,12 +1294,12 @@ class PollTest(TaskQueueTest):
     self._change_response_and_poll()
 
     # return new response *and* existing response. both should be stored in
-    # Source.seen_responses_cache_json
+    # Source.seen_response_fingerprints_json
     replies = activity['object']['replies']['items']
     replies.append(self.activities[1]['object']['replies']['items'][0])
 
     self.post_task(reset=True)
-    self.assert_equals(replies, json.loads(source.key.get().seen_responses_cache_json))
+    self.assert_fingerprints(replies)
     self.responses[4].key.delete()
 
     # new responses that don't include existing response. cache will have
@@ -1231,7 +1310,7 @@ class PollTest(TaskQueueTest):
     self.post_task(reset=True)
     self.assert_equals([r.key for r in self.responses[:4]],
                        list(Response.query().iter(keys_only=True)))
-    self.assert_equals(tags, json.loads(source.key.get().seen_responses_cache_json))
+    self.assert_fingerprints(tags)
 
   def _change_response_and_poll(self):
     resp = self.responses[0].key.get() or self.responses[0]
@@ -1259,8 +1338,35 @@ class PollTest(TaskQueueTest):
                       testutil.get_task_params(tasks[0])['response_key'])
     self.taskqueue_stub.FlushQueue('propagate')
 
+    self.assert_fingerprints([reply])
+
+  def assert_fingerprints(self, responses):
     source = self.sources[0].key.get()
-    self.assert_equals([reply], json.loads(source.seen_responses_cache_json))
+    self.assert_equals({r['id']: util.activity_fingerprint(r) for r in responses},
+                       json.loads(source.seen_response_fingerprints_json))
+    self.assertIsNone(source.seen_responses_cache_json)
+
+  def test_seen_responses_cache_json_migrates_to_fingerprints(self):
+    """Responses in the deprecated seen_responses_cache_json count as seen."""
+    source = self.sources[0]
+    activity = self.activities[0]
+    del activity['object']['tags']
+    FakeGrSource.activities = [activity]
+    reply = activity['object']['replies']['items'][0]
+
+    source.seen_responses_cache_json = json.dumps([reply])
+    source.put()
+
+    self.post_task()
+    self.assertEqual(0, Response.query().count())
+    self.assertEqual([], self.taskqueue_stub.GetTasks('propagate'))
+
+    # new response. the index should now include both, and the old cache is gone
+    replies = activity['object']['replies']['items']
+    replies.append(self.activities[1]['object']['replies']['items'][0])
+    self.post_task(reset=True)
+    self.assertEqual(1, Response.query().count())
+    self.assert_fingerprints(replies)
 
   def test_in_blocklist(self):
     """Responses from blocked users should be ignored."""
@@ -1281,6 +1387,88 @@ class PollTest(TaskQueueTest):
     self.assert_equals(keys, [r.key for r in expected])
 
 
+
+class BatchPollTest(TaskQueueTest):
+
+  post_url = '/_ah/queue/poll-batch'
+
+  def setUp(self):
+    super(BatchPollTest, self).setUp()
+    self.mox.stubs.Set(FakeSource, 'BATCH_POLL', True)
+    for source in self.sources:
+      util.add_poll_task(source)
+
+  def test_batch_poll(self):
+    self.assertEqual([], self.taskqueue_stub.GetTasks('poll'))
+    self.assertEqual(2, len(self.taskqueue_stub.GetTasks('poll-pull')))
+
+    self.post_task(params={'silo': 'fake'})
+
+    for source in self.sources:
+      source = source.key.get()
+      self.assertEqual(NOW, source.last_polled)
+      self.assertEqual('ok', source.poll_status)
+
+    # the leased tasks are deleted and replaced with new ones for the next poll
+    self.assertEqual([], self.taskqueue_stub.GetTasks('poll'))
+    pulls = self.taskqueue_stub.GetTasks('poll-pull')
+    self.assertEqual(2, len(pulls))
+    for task in pulls:
+      self.assertGreater(testutil.get_task_eta(task), datetime.datetime.utcnow())
+    self.assertEqual([], self.taskqueue_stub.GetTasks('poll-batch'))
+
+  def test_batch_poll_error_retries_just_that_source(self):
+    self.mox.StubOutWithMock(FakeSource, 'get_activities_response')
+    FakeSource.get_activities_response(
+      fetch_replies=True, fetch_likes=True, fetch_shares=True,
+      fetch_mentions=True, count=mox.IgnoreArg(), etag=None, min_id=None,
+      cache=mox.IgnoreArg()).AndReturn({'items': []})
+    FakeSource.get_activities_response(
+      fetch_replies=True, fetch_likes=True, fetch_shares=True,
+      fetch_mentions=True, count=mox.IgnoreArg(), etag=None, min_id=None,
+      cache=mox.IgnoreArg()).AndRaise(Exception('foo'))
+    self.mox.ReplayAll()
+
+    self.post_task(params={'silo': 'fake'})
+    self.assertEqual('ok', self.sources[0].key.get().poll_status)
+    self.assertEqual('error', self.sources[1].key.get().poll_status)
+
+    # the failed source's task is still leased, waiting to be retried. the
+    # successful source has a new task for its next poll.
+    pulls = self.taskqueue_stub.GetTasks('poll-pull')
+    self.assertEqual(2, len(pulls))
+    self.assertItemsEqual(
+      [s.key.urlsafe() for s in self.sources],
+      [urlparse.parse_qs(base64.b64decode(t['body']))['source_key'][0]
+       for t in pulls])
+
+  def test_batch_poll_duplicate_task(self):
+    source = self.sources[0].key.get()
+    source.last_polled = NOW
+    source.put()
+    self.sources[1].status = 'disabled'
+    self.sources[1].put()
+
+    self.post_task(params={'silo': 'fake'})
+    self.assertEqual([], self.taskqueue_stub.GetTasks('poll-pull'))
+    self.assertEqual(NOW, self.sources[0].key.get().last_polled)
+    self.assertEqual(util.EPOCH, self.sources[1].key.get().last_polled)
+
+  def test_batch_poll_gives_up_after_max_leases(self):
+    self.mox.stubs.Set(tasks.BatchPoll, 'MAX_LEASES', 0)
+    self.post_task(params={'silo': 'fake'})
+    self.assertEqual([], self.taskqueue_stub.GetTasks('poll-pull'))
+    for source in self.sources:
+      self.assertEqual(util.EPOCH, source.key.get().last_polled)
+
+  def test_full_batch_adds_another_batch_task(self):
+    self.mox.stubs.Set(tasks.BatchPoll, 'BATCH_SIZE', 2)
+    self.post_task(params={'silo': 'fake'})
+    batches = self.taskqueue_stub.GetTasks('poll-batch')
+    self.assertEqual(1, len(batches))
+    self.assertEqual('fake', testutil.get_task_params(batches[0])['silo'])
+
+
 class DiscoverTest(TaskQueueTest):
 
   post_url = '/_ah/queue/discover'
@@ -1411,6 +1599,8 @@ class PropagateTest(TaskQueueTest):
     for r in self.responses[:4]:
       r.put()
     self.mox.StubOutClassWithMocks(send, 'WebmentionSend')
+    # most tests expect one response per task. test_coalesce() tests coalescing.
+    self.mox.stubs.Set(PropagateResponse, 'MAX_COALESCED', 0)
 
   def tearDown(self):
     self.mox.UnsetStubs()
@@ -1479,7 +1669,97 @@ class PropagateTest(TaskQueueTest):
       self.assert_response_is('complete', now + LEASE_LENGTH,
                               sent=['http://target1/post/url'], response=r)
       self.assert_equals(now, self.sources[0].key.get().last_webmention_sent)
-      memcache.flush_all()
+      util.webmention_endpoint_cache.delete(['http://target1/post/url'])
+
+  def test_coalesce(self):
+    """New responses with the same targets should be sent together."""
+    self.mox.stubs.Set(PropagateResponse, 'MAX_COALESCED', 10)
+    self.responses[3].status = 'error'
+    self.responses[3].put()
+
+    id = self.sources[0].key.string_id()
+    # the first discovers the endpoint, the others use the cached endpoint
+    self.expect_webmention(
+      source_url='http://localhost/comment/fake/%s/a/1_2_a' % id).AndReturn(True)
+    for url in ('http://localhost/like/fake/%s/a/alice' % id,
+                'http://localhost/repost/fake/%s/a/bob' % id):
+      self.expect_webmention(source_url=url,
+                             input_endpoint='http://webmention/endpoint'
+                             ).InAnyOrder().AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    for r in self.responses[:3]:
+      self.assert_response_is('complete', sent=['http://target1/post/url'],
+                              response=r)
+    # responses in error aren't coalesced
+    self.assert_response_is('error', unsent=['http://target1/post/url'],
+                            response=self.responses[3])
+
+  def test_coalesce_deferred_adds_one_task(self):
+    """Coalesced responses' own tasks are still queued, so don't add more."""
+    self.mox.stubs.Set(PropagateResponse, 'MAX_COALESCED', 10)
+    util.HostLimiter('target1').record_failure()
+    self.mox.ReplayAll()
+
+    self.post_task()
+    for r in self.responses[:4]:
+      self.assert_response_is('new', None, unsent=['http://target1/post/url'],
+                              response=r)
+
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertEqual(1, len(tasks))
+    self.assertEqual(self.responses[0].key.urlsafe(),
+                     testutil.get_task_params(tasks[0])['response_key'])
+
+  def test_coalesce_writes_source_once(self):
+    self.mox.stubs.Set(PropagateResponse, 'MAX_COALESCED', 10)
+    self.mox.StubOutWithMock(models.Source, 'put_updates_multi')
+    models.Source.put_updates_multi(mox.Func(
+      lambda sources: [s.key for s in sources] == [self.sources[0].key]))
+
+    id = self.sources[0].key.string_id()
+    self.expect_webmention().AndReturn(True)
+    for url in ('http://localhost/like/fake/%s/a/alice' % id,
+                'http://localhost/repost/fake/%s/a/bob' % id):
+      self.expect_webmention(source_url=url,
+                             input_endpoint='http://webmention/endpoint'
+                             ).InAnyOrder().AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    for r in self.responses[:3]:
+      self.assert_response_is('complete', sent=['http://target1/post/url'],
+                              response=r)
+
+  def test_source_updates_batch_fails(self):
+    """If the batched source updates fail, we should put them one at a time."""
+    self.mox.StubOutWithMock(models.Source, 'put_updates_multi')
+    models.Source.put_updates_multi(mox.IgnoreArg()).AndRaise(
+      datastore_errors.TransactionFailedError('foo'))
+    self.expect_webmention().AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assert_response_is('complete', NOW + LEASE_LENGTH,
+                            sent=['http://target1/post/url'])
+    self.assert_equals(NOW, self.sources[0].key.get().last_webmention_sent)
+
+  def test_source_updates_fail(self):
+    """Failing to record last_webmention_sent shouldn't fail the task."""
+    self.mox.StubOutWithMock(models.Source, 'put_updates_multi')
+    models.Source.put_updates_multi(mox.IgnoreArg()).AndRaise(
+      datastore_errors.TransactionFailedError('foo'))
+    self.mox.StubOutWithMock(models.Source, 'put_updates')
+    models.Source.put_updates(mox.IgnoreArg()).AndRaise(
+      datastore_errors.TransactionFailedError('bar'))
+    self.expect_webmention().AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assert_response_is('complete', NOW + LEASE_LENGTH,
+                            sent=['http://target1/post/url'])
+    self.assertIsNone(self.sources[0].key.get().last_webmention_sent)
 
   def test_propagate_from_error(self):
     """A normal propagate task, with a response starting as 'error'."""
@@ -1597,13 +1877,16 @@ class PropagateTest(TaskQueueTest):
     # but i eventually got impatient and gave up. background:
     # https://code.google.com/p/googleappengine/
     # https://code.google.com/p/googleappengine/issues/list?can=1&q=patch&sort=-id
-    now = time.time()
+    #
+    # the in-process and datastore tiers use util.now_fn instead.
+    start = now = time.time()
     self.testbed.get_stub('memcache')._gettime = lambda: now
+    util.now_fn = lambda: NOW + datetime.timedelta(seconds=now - start)
 
     self.post_task()
     self.assert_response_is('complete', skipped=['http://target1/post/url'])
 
-    now += tasks.WEBMENTION_DISCOVERY_CACHE_TIME - 1
+    now += util.WebmentionEndpointCache.NO_ENDPOINT_TIME.total_seconds() - 1
     self.responses[0].status = 'new'
     self.responses[0].put()
     self.post_task()
@@ -1766,6 +2049,63 @@ class PropagateTest(TaskQueueTest):
     self.post_task()
     self.assert_response_is('complete', NOW + LEASE_LENGTH)
 
+  def test_send_concurrently(self):
+    """Targets should be sent in parallel and their results handled in order."""
+    self.mox.stubs.Set(util, 'MAX_THREADS', 5)
+    targets = ['http://target%s/post/url' % i for i in range(1, 5)]
+    self.responses[0].unsent = targets
+    self.responses[0].put()
+
+    errors = {
+      targets[1]: {'code': 'NO_ENDPOINT'},
+      targets[2]: {'code': 'RECEIVER_ERROR', 'http_status': 404},
+      targets[3]: {'code': 'RECEIVER_ERROR', 'http_status': 500},
+    }
+    Mention = collections.namedtuple(
+      'Mention', ('target_url', 'receiver_endpoint', 'response'))
+    threads = set()
+
+    def send_webmention(handler, source_url, target):
+      threads.add(threading.current_thread().ident)
+      time.sleep(.1)
+      return (Mention(target, 'http://webmention/endpoint', 'resp'),
+              errors.get(target), None)
+
+    self.mox.stubs.Set(tasks.SendWebmentions, '_send_webmention', send_webmention)
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', sent=targets[:1], skipped=targets[1:2],
+                            failed=targets[2:3], error=targets[3:])
+    self.assertGreater(len(threads), 1)
+
+  def test_host_backoff_defers_targets(self):
+    """Targets on failing hosts should wait without using up retries."""
+    self.responses[0].unsent = ['http://target1/post/url', 'http://other/post']
+    self.responses[0].put()
+    util.HostLimiter('target1').record_failure()
+
+    self.expect_webmention(target='http://other/post').AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assert_response_is('new', None, unsent=['http://target1/post/url'],
+                            sent=['http://other/post'])
+
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertEqual(1, len(tasks))
+    self.assertEqual(self.responses[0].key.urlsafe(),
+                     testutil.get_task_params(tasks[0])['response_key'])
+
+  def test_host_server_error_backs_off(self):
+    """A 5xx from a host should make later targets on it wait."""
+    self.expect_webmention(error={'code': 'RECEIVER_ERROR', 'http_status': 502}
+                           ).AndReturn(False)
+    self.mox.ReplayAll()
+
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', error=['http://target1/post/url'])
+    self.assertEqual(util.HostLimiter.MIN_BACKOFF,
+                     util.HostLimiter('target1').acquire())
+
   def test_unicode_in_target_url(self):
     """Target URLs with escaped unicode chars should work ok.
     Background: https://github.com/snarfed/bridgy/issues/248
@@ -1901,6 +2241,59 @@ class PropagateTest(TaskQueueTest):
                            sent=['http://second'])
     self.assert_equals(NOW, self.sources[0].key.get().last_webmention_sent)
 
+  def test_retry_ledger(self):
+    """Error targets should only be retried when they're due."""
+    self.expect_webmention(error={'code': 'FOO'}).AndReturn(False)
+    self.expect_webmention(input_endpoint='http://webmention/endpoint'
+                           ).AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', None, error=['http://target1/post/url'])
+    due = NOW + tasks.SendWebmentions.TARGET_MIN_BACKOFF
+    self.assertEquals({'http://target1/post/url': (1, due)},
+                      self.responses[0].key.get().retries())
+
+    # not due yet. shouldn't send, should add a task for when it's due
+    self.post_task()
+    self.assert_response_is('error', None, error=['http://target1/post/url'])
+    propagate_tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertEquals(1, len(propagate_tasks))
+    self.assertAlmostEqual(
+      datetime.datetime.utcnow() + tasks.SendWebmentions.TARGET_MIN_BACKOFF,
+      testutil.get_task_eta(propagate_tasks[0]),
+      delta=datetime.timedelta(seconds=10))
+
+    util.now_fn = lambda: due
+    self.post_task()
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+    self.assertEquals({}, self.responses[0].key.get().retries())
+
+  def test_retry_ledger_gives_up(self):
+    """A target that keeps erroring should eventually move to failed."""
+    self.responses[0].unsent = ['http://error', 'http://good']
+    attempts = tasks.SendWebmentions.TARGET_MAX_ATTEMPTS - 1
+    self.responses[0].set_retries({'http://error': (attempts, NOW)})
+    self.responses[0].put()
+
+    self.expect_webmention(target='http://error', error={'code': 'FOO'})\
+        .AndReturn(False)
+    self.expect_webmention(target='http://good').AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assert_response_is('complete', None, failed=['http://error'],
+                            sent=['http://good'])
+
+    # shouldn't retry it again
+    response = self.responses[0].key.get()
+    self.assertEquals({'http://error': (attempts + 1, None)}, response.retries())
+    response.status = 'new'
+    response.put()
+    self.post_task()
+    self.assert_response_is('complete', None, failed=['http://error'],
+                            sent=['http://good'])
+
   def test_webmention_exception(self):
     """Exceptions on individual target URLs shouldn't stop the whole task."""
     self.responses[0].unsent = ['http://error', 'http://good']
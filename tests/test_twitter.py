@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 
 import copy
+import datetime
 import json
 import urllib
 
@@ -50,6 +51,18 @@ class TwitterTest(testutil.ModelsTest):
     self.assertEqual('tag:twitter.com,2013:snarfed_org', self.tw.user_tag_id())
     self.assertEqual('snarfed_org (Twitter)', self.tw.label())
 
+  def test_rate_limit_delay(self):
+    calls, period = Twitter.TOKEN_RATE_LIMIT
+    for _ in range(calls):
+      self.assertEqual(datetime.timedelta(0), self.tw.rate_limit_delay())
+
+    delay = self.tw.rate_limit_delay()
+    self.assertGreater(delay, datetime.timedelta(0))
+    self.assertLessEqual(delay, period)
+
+    # Twitter has no silo-wide budget, so we shouldn't touch its bucket
+    self.assertIsNone(memcache.get('RL silo twitter'))
+
   def test_new_massages_profile_image(self):
     """We should use profile_image_url_https and drop '_normal' if possible."""
     user = json.loads(self.auth_entity.user_json)
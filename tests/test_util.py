@@ -2,16 +2,21 @@
 """Unit tests for util.py."""
 from __future__ import unicode_literals
 
+import copy
 import datetime
+import io
 import json
+import threading
 import time
 import urllib
+import urllib2
 import urlparse
 
 from appengine_config import HTTP_TIMEOUT
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
+import requests
 import webapp2
 from webmentiontools import send
 from webob import exc
@@ -211,6 +216,91 @@ class UtilTest(testutil.ModelsTest):
     self.assert_equals(('https://end', 'end', True),
                        util.get_webmention_target('http://orig', resolve=True))
 
+  def test_parsed_document(self):
+    self.mox.StubOutWithMock(util, 'beautifulsoup_parse')
+    util.beautifulsoup_parse('<html>x</html>').AndReturn(
+      util.bs4.BeautifulSoup("""\
+<html><link rel="me" href="/me" />
+<div class="h-card"><p class="p-name">x</p></div></html>""", 'lxml'))
+    self.mox.ReplayAll()
+
+    doc = util.ParsedDocument('<html>x</html>', 'http://foo/')
+    soup = doc.soup
+    self.assertIs(soup, doc.soup)
+    self.assertEquals(['http://foo/me'], doc.rels['me'])
+    self.assertEquals(['h-card'], doc.mf2['items'][0]['type'])
+    self.assertIs(soup, doc.soup)
+
+  def test_get_webmention_targets(self):
+    cached = requests.Response()
+    cached.url = 'http://cached/final'
+    cached.headers['content-type'] = 'text/html'
+    memcache.set('R http://cached', cached)
+
+    self.expect_requests_head('http://a', redirected_url='http://a/final')
+    self.expect_requests_head('http://b', content_type='application/pdf')
+    self.mox.ReplayAll()
+
+    self.assert_equals([
+      ('http://a/final', 'a', True),
+      ('http://cached/final', 'cached', True),
+      ('http://b', 'b', False),
+      ('http://a/final', 'a', True),
+    ], util.get_webmention_targets(['http://a', 'http://cached', 'http://b',
+                                    'http://a']))
+
+  def test_get_webmention_targets_failed_resolve(self):
+    """A failed HEAD is still a resolution. We shouldn't resolve it again."""
+    self.expect_requests_head('http://fails', status_code=400)
+    self.mox.ReplayAll()
+
+    self.assert_equals([('http://fails', 'fails', True)],
+                       util.get_webmention_targets(['http://fails']))
+
+  def test_get_webmention_targets_no_resolve(self):
+    self.assert_equals([('http://foo/bar', 'foo', True)],
+                       util.get_webmention_targets(['http://foo/bar?utm_source=x'],
+                                                   resolve=False))
+    self.assert_equals([], util.get_webmention_targets([]))
+
+  def test_redirect_cache_datastore(self):
+    self.expect_requests_head('http://orig',
+                              redirected_url=['http://mid', 'http://final'],
+                              response_headers={'Content-Length': '123'})
+    self.mox.ReplayAll()
+
+    self.assert_equals(('http://final', 'final', True),
+                       util.get_webmention_target('http://orig'))
+    resolved = util.ResolvedUrl.get_by_id('http://orig')
+    self.assertEquals('http://final', resolved.final_url)
+    self.assertEquals(['http://orig', 'http://mid'], resolved.redirects)
+    self.assertEquals('text/html', resolved.content_type)
+    self.assertEquals(123, resolved.content_length)
+    self.assertEquals(util.now_fn() + util.RedirectCache.RESOLVED_TIME,
+                      resolved.expires)
+
+    # evicted from memcache, should come from the datastore without fetching
+    memcache.flush_all()
+    resp = util.redirect_cache.resolve('http://orig')
+    self.assertEquals('http://final', resp.url)
+    self.assertEquals('123', resp.headers['Content-Length'])
+    self.assertEquals(['http://orig', 'http://mid'],
+                      [r.url for r in resp.history])
+    self.assertIsNotNone(memcache.get('R http://orig'))
+
+  def test_redirect_cache_expired(self):
+    util.ResolvedUrl(id='http://orig', final_url='http://stale',
+                     expires=util.now_fn()).put()
+    self.expect_requests_head('http://orig', redirected_url='http://final')
+    self.mox.ReplayAll()
+    self.assertEquals('http://final', util.redirect_cache.resolve('http://orig').url)
+
+  def test_redirect_cache_doesnt_store_failures(self):
+    self.expect_requests_head('http://orig', status_code=404)
+    self.mox.ReplayAll()
+    util.redirect_cache.resolve('http://orig')
+    self.assertIsNone(util.ResolvedUrl.get_by_id('http://orig'))
+
   def test_get_webmention_target_too_big(self):
     self.expect_requests_head('http://orig', response_headers={
       'Content-Length': str(util.MAX_HTTP_RESPONSE_SIZE + 1),
@@ -385,6 +475,18 @@ class UtilTest(testutil.ModelsTest):
     self.assertEquals(200, resp.status_code)
     self.assertEquals('xyz', resp.content)
 
+  def test_read_capped(self):
+    resp = requests.Response()
+    resp.raw = io.BytesIO(b'abcdef')
+    self.assertTrue(util._read_capped(resp, 6))
+    self.assertEquals('abcdef', resp.content)
+
+    # no Content-Length, eg chunked. should stop reading past the limit.
+    resp = requests.Response()
+    resp.raw = io.BytesIO(b'x' * (util.HTTP_RESPONSE_CHUNK_SIZE * 3))
+    self.assertFalse(util._read_capped(resp, util.HTTP_RESPONSE_CHUNK_SIZE + 1))
+    self.assertTrue(resp.raw.closed)
+
   def test_requests_get_url_blacklist(self):
     resp = util.requests_get(next(iter(util.URL_BLACKLIST)))
     self.assertEquals(util.HTTP_REQUEST_REFUSED_STATUS_CODE, resp.status_code)
@@ -453,3 +555,198 @@ class UtilTest(testutil.ModelsTest):
     ):
       got = util.webmention_endpoint_cache_key(url)
       self.assertEquals(expected, got, (url, got))
+
+  def test_run_concurrently(self):
+    self.mox.stubs.Set(util, 'MAX_THREADS', 3)
+    fns = [lambda i=i: i * 2 for i in range(10)]
+    self.assertEquals([i * 2 for i in range(10)], util.run_concurrently(fns))
+    self.assertEquals([i * 2 for i in range(10)],
+                      util.run_concurrently(fns, max_threads=1))
+    self.assertEquals([], util.run_concurrently([]))
+
+  def test_run_concurrently_raises_first_exception(self):
+    self.mox.stubs.Set(util, 'MAX_THREADS', 3)
+    finished = []
+
+    def fail(msg):
+      raise ValueError(msg)
+
+    with self.assertRaises(ValueError) as cm:
+      util.run_concurrently((lambda: fail('first'),
+                             lambda: finished.append(1),
+                             lambda: fail('second')))
+
+    self.assertEquals('first', str(cm.exception))
+    self.assertEquals([1], finished)
+
+  def test_run_concurrently_nested_runs_serially(self):
+    self.mox.stubs.Set(util, 'MAX_THREADS', 3)
+    outer = threading.current_thread()
+
+    def inner():
+      threads = set()
+      def record():
+        threads.add(threading.current_thread())
+      util.run_concurrently([record] * 5)
+      return threads
+
+    for threads in util.run_concurrently([inner] * 3):
+      self.assertEquals(1, len(threads))
+      self.assertNotIn(outer, threads)
+
+  def test_activity_fingerprint(self):
+    obj = {
+      'id': 'tag:fa.ke,2013:123',
+      'objectType': 'comment',
+      'content': 'foo',
+      'author': {'id': 'alice'},
+      'published': '2012-12-05T00:58:26+00:00',
+    }
+    fingerprint = util.activity_fingerprint(obj)
+
+    # fields that activity_changed() ignores don't change the fingerprint
+    for field, val in ('author', {'id': 'bob'}), ('published', None), ('x', 'y'):
+      other = copy.deepcopy(obj)
+      other[field] = val
+      self.assertEquals(fingerprint, util.activity_fingerprint(other))
+
+    # empty values are ignored
+    other = copy.deepcopy(obj)
+    other.update({'verb': None, 'image': {}, 'to': []})
+    self.assertEquals(fingerprint, util.activity_fingerprint(other))
+
+    # fields that activity_changed() compares do, on the activity or its object
+    for changed in ({'content': 'bar'}, {'objectType': 'note'},
+                    {'object': {'content': 'foo'}},
+                    {'to': [{'objectType': 'group', 'alias': '@private'}]}):
+      other = copy.deepcopy(obj)
+      other.update(changed)
+      self.assertNotEquals(fingerprint, util.activity_fingerprint(other), changed)
+
+  def test_token_bucket(self):
+    now = datetime.datetime(2018, 1, 2)
+    self.mox.stubs.Set(util, 'now_fn', lambda: now)
+    bucket = util.TokenBucket('x', 2, datetime.timedelta(minutes=1))
+
+    zero = datetime.timedelta(0)
+    self.assertEquals(zero, bucket.take())
+    self.assertEquals(zero, bucket.take())
+    self.assertEquals(datetime.timedelta(seconds=30), bucket.take())
+
+    # refills over time
+    now += datetime.timedelta(seconds=30)
+    self.assertEquals(zero, bucket.take())
+    self.assertEquals(datetime.timedelta(seconds=30), bucket.take())
+
+    # shared via memcache
+    other = util.TokenBucket('x', 2, datetime.timedelta(minutes=1))
+    self.assertEquals(datetime.timedelta(seconds=30), other.take())
+
+  def test_token_bucket_pause_until(self):
+    now = datetime.datetime(2018, 1, 2)
+    self.mox.stubs.Set(util, 'now_fn', lambda: now)
+    bucket = util.TokenBucket('x')
+    self.assertEquals(datetime.timedelta(0), bucket.take())
+
+    bucket.pause_until(now + datetime.timedelta(minutes=5))
+    # an earlier pause doesn't shorten it
+    bucket.pause_until(now + datetime.timedelta(minutes=1))
+    self.assertEquals(datetime.timedelta(minutes=5), bucket.take())
+
+    now += datetime.timedelta(minutes=5)
+    self.assertEquals(datetime.timedelta(0), bucket.take())
+
+  def test_rate_limit_reset(self):
+    now = datetime.datetime(2018, 1, 2)
+    self.mox.stubs.Set(util, 'now_fn', lambda: now)
+
+    def error(headers):
+      resp = requests.Response()
+      resp.status_code = 429
+      resp.headers.update(headers)
+      return requests.HTTPError(response=resp)
+
+    for headers, expected in (
+        ({}, None),
+        ({'Retry-After': '120'}, now + datetime.timedelta(minutes=2)),
+        ({'Retry-After': 'Tue, 02 Jan 2018 00:03:00 GMT'},
+         datetime.datetime(2018, 1, 2, 0, 3)),
+        ({'X-Rate-Limit-Reset': '1514851380'}, datetime.datetime(2018, 1, 2, 0, 3)),
+        ({'X-RateLimit-Reset': 'junk'}, None),
+    ):
+      self.assertEquals(expected, util.rate_limit_reset(error(headers)), headers)
+
+    self.assertIsNone(util.rate_limit_reset(
+      urllib2.HTTPError('url', 429, 'Rate limited', {}, None)))
+
+  def test_webmention_endpoint_cache(self):
+    cache = util.WebmentionEndpointCache()
+    url = 'http://foo.com/post'
+    self.assertIsNone(cache.get(url))
+
+    cache.set(url, 'http://foo.com/endpoint')
+    self.assertEquals('http://foo.com/endpoint', cache.get('http://foo.com/other'))
+    self.assertEquals({'lru': 1, 'miss': 1}, cache.stats)
+
+    # falls back to memcache, then datastore
+    cache.clear_lru()
+    self.assertEquals('http://foo.com/endpoint', cache.get(url))
+    cache.clear_lru()
+    memcache.flush_all()
+    self.assertEquals('http://foo.com/endpoint', cache.get(url))
+    self.assertEquals('http://foo.com/endpoint',
+                      memcache.get(util.webmention_endpoint_cache_key(url)))
+    self.assertEquals({'lru': 1, 'memcache': 1, 'datastore': 1, 'miss': 1},
+                      cache.stats)
+
+    cache.flush_stats()
+    self.assertEquals({}, cache.stats)
+    self.assertEquals(1, memcache.get('W stats datastore'))
+    self.assertEquals({'lru': 1, 'memcache': 1, 'datastore': 1, 'miss': 1},
+                      cache.total_stats())
+
+    cache.delete([url])
+    self.assertIsNone(cache.get(url))
+
+  def test_webmention_endpoint_cache_error_expires(self):
+    cache = util.WebmentionEndpointCache()
+    url = 'http://foo.com/post'
+    error = {'code': 'NO_ENDPOINT'}
+    cache.set(url, error)
+    self.assertEquals(error, cache.get(url))
+
+    # datastore tier expires
+    cache.clear_lru()
+    memcache.flush_all()
+    now = util.now_fn() + cache.NO_ENDPOINT_TIME
+    self.mox.stubs.Set(util, 'now_fn', lambda: now)
+    self.assertIsNone(cache.get(url))
+
+  def test_webmention_endpoint_cache_lru_evicts(self):
+    self.mox.stubs.Set(util.WebmentionEndpointCache, 'LRU_SIZE', 2)
+    cache = util.WebmentionEndpointCache()
+    for domain in 'a', 'b', 'c':
+      cache.set('http://%s/' % domain, 'http://%s/endpoint' % domain)
+    self.assertEquals(['W http b /', 'W http c /'], list(cache._lru.keys()))
+
+  def test_host_limiter_concurrency(self):
+    self.mox.stubs.Set(util.HostLimiter, 'MAX_CONCURRENT', 1)
+    limiter = util.HostLimiter('foo.com')
+    zero = datetime.timedelta(0)
+    self.assertEquals(zero, limiter.acquire())
+    self.assertEquals(util.HostLimiter.CONCURRENT_DELAY, limiter.acquire())
+    limiter.release()
+    self.assertEquals(zero, limiter.acquire())
+
+  def test_host_limiter_backoff(self):
+    limiter = util.HostLimiter('foo.com')
+    self.assertEquals(limiter.MIN_BACKOFF, limiter.record_failure())
+    self.assertEquals(limiter.MIN_BACKOFF * 2, limiter.record_failure())
+    self.assertEquals(limiter.MIN_BACKOFF * 2, limiter.acquire())
+
+    limiter.record_success()
+    self.assertEquals(limiter.MIN_BACKOFF, limiter.record_failure())
+
+    for _ in range(20):
+      limiter.record_failure()
+    self.assertEquals(limiter.MAX_BACKOFF, limiter.record_failure())
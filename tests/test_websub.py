@@ -0,0 +1,171 @@
+"""Unit tests for websub.py.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import hashlib
+import hmac
+import urllib
+
+import requests
+
+import models
+import testutil
+from testutil import FakeSource
+import util
+import websub
+
+
+class WebSubTest(testutil.HandlerTest):
+
+  def setUp(self):
+    super(WebSubTest, self).setUp()
+    self.source = FakeSource(id='foo.com', features=['listen'])
+    self.source.put()
+
+  def subscribe(self, expires=None):
+    self.source.websub_secret = 'sekret'
+    self.source.set_websub_subscriptions({'http://foo.com/': (
+      'http://foo.com/', 'http://hub/', testutil.NOW, expires)})
+    self.source.put()
+
+  def expect_subscribe(self, topic='http://foo.com/', hub='http://hub/'):
+    self.expect_requests_post(hub, data={
+      'hub.mode': 'subscribe',
+      'hub.topic': topic,
+      'hub.callback': websub.CALLBACK_HOST_URL + '/websub/fake/foo.com',
+      'hub.secret': 'sekret',
+      'hub.lease_seconds': int(websub.LEASE.total_seconds()),
+    })
+
+  def test_discover(self):
+    resp = requests.Response()
+    resp.headers['Link'] = '</hub>; rel="hub"'
+    doc = util.ParsedDocument(
+      '<link rel="self" href="http://foo.com/feed">', 'http://foo.com/')
+    self.assertEquals(('http://foo.com/hub', 'http://foo.com/feed'),
+                      websub.discover(resp, doc))
+
+    # no rel=self, topic defaults to the page's URL
+    doc = util.ParsedDocument('<link rel="hub" href="http://hub/">',
+                              'http://foo.com/')
+    self.assertEquals(('http://hub/', 'http://foo.com/'),
+                      websub.discover(requests.Response(), doc))
+
+    doc = util.ParsedDocument('<p>no hub</p>', 'http://foo.com/')
+    self.assertEquals((None, None), websub.discover(requests.Response(), doc))
+
+  def test_subscribe(self):
+    self.mox.stubs.Set(util, 'generate_secret', lambda: 'sekret')
+    self.expect_subscribe()
+    self.mox.ReplayAll()
+
+    websub.subscribe(self.source, 'http://foo.com/', 'http://hub/',
+                     'http://foo.com/')
+    stored = self.source.key.get()
+    self.assertEquals({'http://foo.com/': (
+      'http://foo.com/', 'http://hub/', testutil.NOW, None)},
+      stored.websub_subscriptions())
+    self.assertEquals('sekret', stored.websub_secret)
+
+    # already requested, shouldn't request again
+    websub.subscribe(self.source, 'http://foo.com/', 'http://hub/',
+                     'http://foo.com/')
+
+  def test_subscribe_still_subscribed(self):
+    self.subscribe(expires=testutil.NOW + websub.RENEW_BEFORE * 3)
+    util.now_fn = lambda: testutil.NOW + websub.RENEW_BEFORE
+    websub.subscribe(self.source, 'http://foo.com/', 'http://hub/',
+                     'http://foo.com/')
+
+  def test_subscribe_multiple_author_urls(self):
+    """Each author URL's h-feed gets its own subscription."""
+    self.subscribe()
+    self.expect_subscribe(topic='http://bar.com/feed', hub='http://other/hub')
+    self.mox.ReplayAll()
+
+    websub.subscribe(self.source, 'http://bar.com/', 'http://other/hub',
+                     'http://bar.com/feed')
+    # both already requested, shouldn't request again
+    websub.subscribe(self.source, 'http://foo.com/', 'http://hub/',
+                     'http://foo.com/')
+    websub.subscribe(self.source, 'http://bar.com/', 'http://other/hub',
+                     'http://bar.com/feed')
+
+    self.assertEquals({
+      'http://foo.com/': ('http://foo.com/', 'http://hub/', testutil.NOW, None),
+      'http://bar.com/feed': ('http://bar.com/', 'http://other/hub',
+                              testutil.NOW, None),
+    }, self.source.key.get().websub_subscriptions())
+
+  def test_subscribe_new_topic_replaces_old(self):
+    self.subscribe()
+    self.expect_subscribe(topic='http://foo.com/feed')
+    self.mox.ReplayAll()
+
+    websub.subscribe(self.source, 'http://foo.com/', 'http://hub/',
+                     'http://foo.com/feed')
+    self.assertEquals(['http://foo.com/feed'],
+                      self.source.key.get().websub_subscriptions().keys())
+
+  def test_verify(self):
+    self.subscribe()
+    resp = websub.application.get_response(
+      '/websub/fake/foo.com?' + urllib.urlencode({
+        'hub.mode': 'subscribe',
+        'hub.topic': 'http://foo.com/',
+        'hub.challenge': 'xyz',
+        'hub.lease_seconds': '3600',
+      }))
+    self.assertEquals(200, resp.status_int)
+    self.assertEquals('xyz', resp.body)
+    self.assertEquals({'http://foo.com/': (
+      'http://foo.com/', 'http://hub/', testutil.NOW,
+      testutil.NOW + datetime.timedelta(hours=1))},
+      self.source.key.get().websub_subscriptions())
+
+  def test_verify_wrong_topic(self):
+    self.subscribe()
+    resp = websub.application.get_response(
+      '/websub/fake/foo.com?' + urllib.urlencode({
+        'hub.mode': 'subscribe',
+        'hub.topic': 'http://other/',
+        'hub.challenge': 'xyz',
+      }))
+    self.assertEquals(404, resp.status_int)
+    self.assertIsNone(
+      self.source.key.get().websub_subscriptions()['http://foo.com/'][3])
+
+  def test_verify_not_subscribed(self):
+    resp = websub.application.get_response(
+      '/websub/fake/foo.com?hub.mode=subscribe&hub.challenge=xyz')
+    self.assertEquals(404, resp.status_int)
+
+  def notify(self, signature):
+    return websub.application.get_response(
+      '/websub/fake/foo.com', method='POST', body=b'<html>new post</html>',
+      headers={'X-Hub-Signature': str(signature)})
+
+  def test_notify(self):
+    self.subscribe()
+    resp = self.notify('sha256=' + hmac.new(
+      b'sekret', b'<html>new post</html>', hashlib.sha256).hexdigest())
+    self.assertEquals(200, resp.status_int)
+    self.assertEquals(models.REFETCH_HFEED_TRIGGER,
+                      self.source.key.get().last_hfeed_refetch)
+
+  def test_notify_bad_signature(self):
+    self.subscribe()
+    for signature in '', 'sha256=xyz', 'md5=xyz':
+      resp = self.notify(signature)
+      self.assertEquals(200, resp.status_int)
+      self.assertEquals(util.EPOCH, self.source.key.get().last_hfeed_refetch)
+
+  def test_notify_disabled_source(self):
+    self.subscribe()
+    self.source.status = 'disabled'
+    self.source.put()
+    resp = self.notify('sha1=' + hmac.new(
+      b'sekret', b'<html>new post</html>', hashlib.sha1).hexdigest())
+    self.assertEquals(200, resp.status_int)
+    self.assertEquals(util.EPOCH, self.source.key.get().last_hfeed_refetch)
@@ -203,6 +203,9 @@ class FakeSource(Source):
   def search_for_links(self):
     return copy.deepcopy(FakeGrSource.search_results)
 
+  def load_gr_source(self, auth_entity):
+    return self.gr_source
+
   @classmethod
   def new(cls, handler, **props):
     id = None
@@ -236,6 +239,9 @@ class HandlerTest(testutil_appengine.HandlerTest):
     self.handler = util.Handler(self.request, self.response)
     FakeGrSource.clear()
     util.now_fn = lambda: NOW
+    # run "concurrent" work serially so that mocked calls happen in order
+    util.MAX_THREADS = 1
+    util.webmention_endpoint_cache.clear_lru()
 
     # we use global queries in tests to verify entities in the datastore, so
     # make the datastore stub always return consistent data. not ideal, since it
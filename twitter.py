@@ -7,6 +7,7 @@ https://dev.twitter.com/docs/rate-limiting/1.1/limits
 """
 from __future__ import unicode_literals
 
+import datetime
 import json
 import logging
 
@@ -42,6 +43,10 @@ class Twitter(models.Source):
     'repost': 'retweet',
     'like': 'favorite',
   }
+  BATCH_POLL = True
+  # polls make at least two calls, and handlers fetch posts too, so leave
+  # plenty of headroom under the 180 calls per window. (see module docstring.)
+  TOKEN_RATE_LIMIT = (60, datetime.timedelta(minutes=15))
 
   URL_CANONICALIZER = gr_twitter.Twitter.URL_CANONICALIZER
   URL_CANONICALIZER.headers = util.REQUEST_HEADERS
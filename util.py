@@ -16,16 +16,23 @@ import copy
 from http.cookies import CookieError, SimpleCookie
 import contextlib
 import datetime
+import email.utils
+import hashlib
+import json
 import logging
 import re
+import sys
+import threading
 import time
 import urllib
+import urllib2
 import urlparse
 
 from appengine_config import DEBUG
 import bs4
 import humanize
 import mf2py
+import requests
 from oauth_dropins.webutil import handlers as webutil_handlers
 from oauth_dropins.webutil.models import StringIdModel
 from oauth_dropins.webutil import util
@@ -35,6 +42,7 @@ from google.appengine.api import mail
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb.key import _MAX_KEYPART_BYTES
 from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
 # when running in dev_appserver, replace these domains in links with localhost
@@ -45,6 +53,9 @@ LOCALHOST_TEST_DOMAINS = frozenset([
 
 POLL_TASK_DATETIME_FORMAT = '%Y-%m-%d-%H-%M-%S'
 
+# max attempts at a compare-and-set update to a TokenBucket in memcache
+TOKEN_BUCKET_CAS_RETRIES = 5
+
 REQUEST_HEADERS = {
   'User-Agent': 'Bridgy (https://brid.gy/about)',
 }
@@ -85,6 +96,24 @@ with open(os.path.join(_dir, 'beta_users.txt'), 'rt', encoding='utf-8') as f:
 # http://www.sitepoint.com/average-page-weight-increases-15-2014/
 # http://httparchive.org/interesting.php#bytesperpage
 MAX_HTTP_RESPONSE_SIZE = 500000
+# how much of a response body requests_get() reads at a time
+HTTP_RESPONSE_CHUNK_SIZE = 16384
+
+# Fields that granary.source.Source.activity_changed() compares, on both an
+# activity and its object. Keep in sync with granary!
+ACTIVITY_CHANGED_FIELDS = ('objectType', 'verb', 'to', 'content', 'location',
+                           'image')
+
+# memcache key prefix that webutil's follow_redirects() caches resolved URLs
+# under. RedirectCache shares it.
+REDIRECT_CACHE_PREFIX = 'R '
+
+# Max number of threads that run_concurrently() will use at once. Unit tests set
+# this to 1 so that mocked calls happen in a deterministic order.
+MAX_THREADS = 10
+# set in run_concurrently()'s worker threads, so that nested calls run serially
+# instead of starting more threads.
+_run_concurrently_local = threading.local()
 
 # Returned as the HTTP status code when an upstream API fails. Not 5xx so that
 # it doesn't show up as a server error in graphs or trigger StackDriver's error
@@ -117,18 +146,34 @@ webutil_handlers.JINJA_ENV.globals.update({
 def add_poll_task(source, now=False, **kwargs):
   """Adds a poll task for the given source entity.
 
-  Pass now=True to insert a poll-now task.
+  Pass now=True to insert a poll-now task. Otherwise, if the source's class
+  polls in batches, adds a pull task tagged with its silo to the poll-pull
+  queue for :class:`tasks.BatchPoll` to lease.
   """
   last_polled_str = source.last_polled.strftime(POLL_TASK_DATETIME_FORMAT)
+  params = {'source_key': source.key.urlsafe(),
+            'last_polled': last_polled_str}
+
+  if source.BATCH_POLL and not now:
+    task = taskqueue.Queue('poll-pull').add(taskqueue.Task(
+      payload=urllib.urlencode(params), method='PULL', tag=source.SHORT_NAME,
+      **kwargs))
+    logging.info('Added poll-pull task %s with args %s', task.name, kwargs)
+    return
+
   queue = 'poll-now' if now else 'poll'
-  task = taskqueue.add(queue_name=queue,
-                       params={'source_key': source.key.urlsafe(),
-                               'last_polled': last_polled_str},
-                       target='background',
+  task = taskqueue.add(queue_name=queue, params=params, target='background',
                        **kwargs)
   logging.info('Added %s task %s with args %s', queue, task.name, kwargs)
 
 
+def add_poll_batch_task(silo):
+  """Adds a poll-batch task for the given silo short name, e.g. 'twitter'."""
+  task = taskqueue.add(queue_name='poll-batch', params={'silo': silo},
+                       target='background')
+  logging.info('Added poll-batch task for %s: %s', silo, task.name)
+
+
 def add_propagate_task(entity, **kwargs):
   """Adds a propagate task for the given response entity."""
   task = taskqueue.add(queue_name='propagate',
@@ -138,6 +183,18 @@ def add_propagate_task(entity, **kwargs):
   logging.info('Added propagate task: %s', task.name)
 
 
+def add_propagate_tasks(entities):
+  """Adds propagate tasks for the given response entities in batches."""
+  tasks = [taskqueue.Task(params={'response_key': entity.key.urlsafe()},
+                          target='background')
+           for entity in entities]
+  queue = taskqueue.Queue('propagate')
+  for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+  if tasks:
+    logging.info('Added %d propagate tasks', len(tasks))
+
+
 def add_propagate_blogpost_task(entity, **kwargs):
   """Adds a propagate-blogpost task for the given response entity."""
   task = taskqueue.add(queue_name='propagate-blogpost',
@@ -156,7 +213,7 @@ def add_discover_task(source, post_id, type=None, **kwargs):
     params['type'] = type
 
   task = taskqueue.add(queue_name='discover', params=params,
-                       target='background')
+                       target='background', **kwargs)
   logging.info('Added discover task for post %s for %s: %s', post_id,
                source.label(), task.name)
 
@@ -179,6 +236,302 @@ def webmention_endpoint_cache_key(url):
   return ' '.join(parts)
 
 
+class WebmentionEndpoint(StringIdModel):
+  """A cached webmention endpoint discovery result. Key id is cache key.
+
+  See :func:`webmention_endpoint_cache_key` and :class:`WebmentionEndpointCache`.
+  """
+  # Turn off instance and memcache caching. WebmentionEndpointCache does its own.
+  _use_cache = False
+  _use_memcache = False
+
+  endpoint = ndb.StringProperty(indexed=False)
+  # WebmentionSend error dict, for (semi-)permanent failures like NO_ENDPOINT
+  error_json = ndb.TextProperty()
+  expires = ndb.DateTimeProperty()
+
+  def value(self):
+    return json.loads(self.error_json) if self.error_json else self.endpoint
+
+
+class WebmentionEndpointCache(object):
+  """Caches webmention endpoint discovery results per domain.
+
+  Values are string endpoint URLs or, for (semi-)permanent failures like
+  NO_ENDPOINT, :class:`webmentiontools.send.WebmentionSend` error dicts. Keys
+  are from :func:`webmention_endpoint_cache_key`.
+
+  Has three tiers: an in-process LRU, memcache, and the datastore, via
+  :class:`WebmentionEndpoint`. LRU entries expire after :attr:`LRU_TIME` since
+  other instances can't invalidate them. Thread safe.
+
+  Attributes:
+    stats: :class:`collections.Counter` of hits per tier and misses since the
+      last :meth:`flush_stats`
+  """
+  STATS = ('lru', 'memcache', 'datastore', 'miss')
+  STATS_KEY_PREFIX = 'W stats '
+  ENDPOINT_TIME = datetime.timedelta(days=1)
+  NO_ENDPOINT_TIME = datetime.timedelta(hours=2)
+  LRU_TIME = datetime.timedelta(minutes=5)
+  LRU_SIZE = 2000
+
+  def __init__(self):
+    self._lru = collections.OrderedDict()  # maps key to (value, expires)
+    self._lock = threading.Lock()
+    self.stats = collections.Counter()
+
+  def get(self, url):
+    """Returns the cached value for a URL's domain, or None if it's not cached.
+
+    Args:
+      url: string
+    """
+    key = webmention_endpoint_cache_key(url)
+    now = now_fn()
+
+    with self._lock:
+      val, expires = self._lru.pop(key, (None, None))
+      if val is not None and now < expires:
+        self._lru[key] = val, expires  # most recently used
+        self.stats['lru'] += 1
+        return val
+
+    val = memcache.get(key)
+    if val is not None:
+      tier = 'memcache'
+    else:
+      entity = WebmentionEndpoint.get_by_id(key)
+      if entity and entity.expires and now < entity.expires:
+        tier = 'datastore'
+        val = entity.value()
+        memcache.set(key, val,
+                     time=int((entity.expires - now).total_seconds()) or 1)
+
+    with self._lock:
+      if val is None:
+        self.stats['miss'] += 1
+        return None
+      self.stats[tier] += 1
+      self._add_to_lru(key, val, now + self.LRU_TIME)
+
+    return val
+
+  def set(self, url, val):
+    """Caches a discovery result for a URL's domain in all tiers.
+
+    Args:
+      url: string
+      val: string endpoint URL or error dict. None is ignored.
+    """
+    if val is None:
+      return
+
+    key = webmention_endpoint_cache_key(url)
+    is_error = isinstance(val, dict)
+    ttl = self.NO_ENDPOINT_TIME if is_error else self.ENDPOINT_TIME
+    now = now_fn()
+
+    with self._lock:
+      self._add_to_lru(key, val, now + min(ttl, self.LRU_TIME))
+    memcache.set(key, val, time=int(ttl.total_seconds()))
+    WebmentionEndpoint(id=key, expires=now + ttl,
+                       endpoint=None if is_error else val,
+                       error_json=json.dumps(val) if is_error else None).put()
+
+  def delete(self, urls):
+    """Clears the cached values for the domains of the given URLs.
+
+    Args:
+      urls: sequence of string URLs
+    """
+    keys = set(webmention_endpoint_cache_key(url) for url in urls)
+    with self._lock:
+      for key in keys:
+        self._lru.pop(key, None)
+    memcache.delete_multi(list(keys))
+    ndb.delete_multi([ndb.Key(WebmentionEndpoint, key) for key in keys])
+
+  def clear_lru(self):
+    """Clears the in-process LRU tier."""
+    with self._lock:
+      self._lru.clear()
+
+  def flush_stats(self):
+    """Adds :attr:`stats` to the running totals in memcache, logs them, and
+    resets them.
+
+    The totals are in memcache keys 'W stats [tier]' and 'W stats miss'. Read
+    them with :meth:`total_stats`.
+    """
+    with self._lock:
+      stats = self.stats
+      self.stats = collections.Counter()
+    if stats:
+      totals = memcache.offset_multi(stats, key_prefix=self.STATS_KEY_PREFIX,
+                                     initial_value=0)
+      logging.info('Webmention endpoint cache: %s, totals %s',
+                   dict(stats), totals)
+
+  def total_stats(self):
+    """Returns the running totals from :meth:`flush_stats`.
+
+    Returns:
+      dict mapping tier name (or 'miss') to int count. Missing totals, e.g. if
+      memcache evicted them, are 0.
+    """
+    totals = memcache.get_multi(self.STATS, key_prefix=self.STATS_KEY_PREFIX)
+    return {name: totals.get(name, 0) for name in self.STATS}
+
+  def _add_to_lru(self, key, val, expires):
+    """Adds or replaces an LRU entry and evicts the oldest. Call with lock held!
+    """
+    self._lru.pop(key, None)
+    self._lru[key] = val, expires
+    while len(self._lru) > self.LRU_SIZE:
+      self._lru.popitem(last=False)
+
+
+webmention_endpoint_cache = WebmentionEndpointCache()
+
+
+class ResolvedUrl(StringIdModel):
+  """A cached :func:`follow_redirects` result. Key id is the original URL.
+
+  See :class:`RedirectCache`.
+  """
+  # Turn off instance and memcache caching. RedirectCache does its own.
+  _use_cache = False
+  _use_memcache = False
+
+  final_url = ndb.StringProperty(indexed=False)
+  # intermediate URLs in the redirect chain, starting with the original
+  redirects = ndb.StringProperty(repeated=True, indexed=False)
+  content_type = ndb.StringProperty(indexed=False)
+  content_length = ndb.IntegerProperty(indexed=False)
+  fetched = ndb.DateTimeProperty()
+  expires = ndb.DateTimeProperty()
+
+  @classmethod
+  def from_response(cls, url, resp, fetched, expires):
+    """Returns a new, unsaved :class:`ResolvedUrl`.
+
+    Args:
+      url: string, original URL
+      resp: :class:`requests.Response` from :func:`follow_redirects`
+      fetched: :class:`datetime.datetime`
+      expires: :class:`datetime.datetime`
+    """
+    length = resp.headers.get('Content-Length')
+    return cls(id=url, final_url=resp.url,
+               redirects=[r.url for r in resp.history],
+               content_type=resp.headers.get('content-type'),
+               content_length=int(length) if util.is_int(length) else None,
+               fetched=fetched, expires=expires)
+
+  def response(self):
+    """Returns a :class:`requests.Response` like :func:`follow_redirects`'s."""
+    resp = requests.Response()
+    resp.url = self.final_url
+    resp.status_code = 200
+    if self.content_type:
+      resp.headers['content-type'] = self.content_type
+    if self.content_length is not None:
+      resp.headers['Content-Length'] = str(self.content_length)
+    for url in self.redirects:
+      redirect = requests.Response()
+      redirect.url = url
+      resp.history.append(redirect)
+    return resp
+
+
+class RedirectCache(object):
+  """Caches :func:`follow_redirects` results durably.
+
+  :func:`follow_redirects` only caches in memcache, which evicts popular link
+  shortener and news URLs long before they change. This adds a datastore tier,
+  via :class:`ResolvedUrl`, that keeps the final URL, content type, and length
+  for :attr:`RESOLVED_TIME`. Failed resolutions aren't stored in the datastore;
+  :func:`follow_redirects` already caches those in memcache for a while.
+
+  Values are :class:`requests.Response` objects. Memcache keys are the same as
+  :func:`follow_redirects`'s, so the two share that tier.
+  """
+  RESOLVED_TIME = datetime.timedelta(days=7)
+
+  def get_multi(self, urls):
+    """Returns cached resolutions. Use this to prefetch a batch of URLs.
+
+    Args:
+      urls: sequence of string URLs
+
+    Returns:
+      dict mapping string URL to :class:`requests.Response`. URLs that aren't
+      cached are omitted.
+    """
+    urls = set(urls)
+    if not urls:
+      return {}
+
+    cached = memcache.get_multi(list(urls), key_prefix=REDIRECT_CACHE_PREFIX)
+    misses = [url for url in urls if url not in cached and
+              len(url) <= _MAX_KEYPART_BYTES]
+    if not misses:
+      return cached
+
+    now = now_fn()
+    backfill = {}
+    for url, entity in zip(misses, ndb.get_multi(
+        [ndb.Key(ResolvedUrl, url) for url in misses])):
+      if entity and entity.expires and now < entity.expires:
+        cached[url] = backfill[url] = entity.response()
+        memcache.set(REDIRECT_CACHE_PREFIX + url, backfill[url],
+                     time=int((entity.expires - now).total_seconds()) or 1)
+
+    logging.debug('Redirect cache: %s URLs, %s from memcache, %s from datastore',
+                  len(urls), len(cached) - len(backfill), len(backfill))
+    return cached
+
+  def resolve(self, url):
+    """Returns the cached resolution of a URL, resolving it if necessary.
+
+    Args:
+      url: string
+
+    Returns:
+      :class:`requests.Response`
+    """
+    return self.resolve_multi([url])[url]
+
+  def resolve_multi(self, urls):
+    """Returns the cached resolutions of URLs, resolving misses concurrently.
+
+    Args:
+      urls: sequence of string URLs
+
+    Returns:
+      dict mapping string URL to :class:`requests.Response`
+    """
+    resolved = self.get_multi(urls)
+    misses = [url for url in set(urls) if url not in resolved]
+    if not misses:
+      return resolved
+
+    responses = run_concurrently(
+      [lambda url=url: follow_redirects(url, cache=True) for url in misses])
+    resolved.update(zip(misses, responses))
+
+    now = now_fn()
+    ndb.put_multi([
+      ResolvedUrl.from_response(url, resp, now, now + self.RESOLVED_TIME)
+      for url, resp in zip(misses, responses)
+      if resp.ok and len(url) <= _MAX_KEYPART_BYTES])
+    return resolved
+
+
+redirect_cache = RedirectCache()
+
+
 def email_me(**kwargs):
   """Thin wrapper around :func:`mail.send_mail()` that handles errors."""
   try:
@@ -188,14 +541,79 @@ def email_me(**kwargs):
     logging.warning('Error sending notification email', exc_info=True)
 
 
+def run_concurrently(fns, max_threads=None):
+  """Calls zero-argument functions concurrently in a bounded pool of threads.
+
+  App Engine's Python 2.7 runtime allows threads inside a request as long as
+  they finish before the request does. We join them all before returning. Each
+  thread gets its own ndb context.
+
+  If only one thread is allowed, or there's only one function, or we're already
+  in one of run_concurrently()'s threads, they're run serially in the calling
+  thread instead. That way nested calls never go past :const:`MAX_THREADS`.
+
+  Args:
+    fns: sequence of zero-argument callables
+    max_threads: integer, maximum number of threads to run at once. Defaults
+      to, and is capped by, :const:`MAX_THREADS`.
+
+  Returns:
+    list of the functions' return values, in the same order as fns
+
+  Raises:
+    the first exception, in fns order, raised by any of the functions. When
+    running in threads, this is raised after all of the functions finish.
+  """
+  fns = list(fns)
+  limit = MAX_THREADS if max_threads is None else min(max_threads, MAX_THREADS)
+  limit = min(limit, len(fns))
+  if limit <= 1 or getattr(_run_concurrently_local, 'in_worker', False):
+    return [fn() for fn in fns]
+
+  results = [None] * len(fns)
+  errors = [None] * len(fns)
+  indices = iter(xrange(len(fns)))
+  lock = threading.Lock()
+
+  def worker():
+    _run_concurrently_local.in_worker = True
+    while True:
+      with lock:
+        i = next(indices, None)
+      if i is None:
+        return
+      try:
+        results[i] = fns[i]()
+      except BaseException:
+        errors[i] = sys.exc_info()
+
+  threads = [threading.Thread(target=worker) for _ in xrange(limit)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for error in errors:
+    if error:
+      raise error[0], error[1], error[2]
+
+  return results
+
+
+# Note that appengine_config monkeypatches requests to send everything through
+# App Engine's URLFetch service, which manages outbound connections, keep-alive,
+# and TLS itself. A requests.Session connection pool wouldn't be reused here,
+# so we don't use one. Per host limits for webmentions are in HostLimiter.
 def requests_get(url, **kwargs):
   """Wraps :func:`requests.get` with extra semantics and our user agent.
 
-  If a server tells us a response will be too big (based on Content-Length), we
-  hijack the response and return 599 and an error response body instead. We pass
-  stream=True to :func:`requests.get` so that it doesn't fetch the response body
-  until we access :attr:`requests.Response.content` (or
-  :attr:`requests.Response.text`).
+  If a response is too big, we hijack it and return 599 and an error response
+  body instead. The Content-Length check is the only real guard, since it
+  happens before we read the body. Otherwise, we cap the body at
+  :const:`MAX_HTTP_RESPONSE_SIZE` after the fetch. appengine_config sends
+  requests through URLFetch, which buffers the whole body before we see any of
+  it, so that only keeps oversized bodies out of the rest of Bridgy; it doesn't
+  bound how much URLFetch downloads or holds in memory.
 
   http://docs.python-requests.org/en/latest/user/advanced/#body-content-workflow
   """
@@ -213,10 +631,126 @@ def requests_get(url, **kwargs):
     resp.status_code = HTTP_REQUEST_REFUSED_STATUS_CODE
     resp._text = resp._content = ('Content-Length %s is larger than our limit %s.' %
                                   (length, MAX_HTTP_RESPONSE_SIZE))
+  elif not _read_capped(resp, MAX_HTTP_RESPONSE_SIZE):
+    resp.status_code = HTTP_REQUEST_REFUSED_STATUS_CODE
+    resp._text = resp._content = ('Response body is larger than our limit %s.' %
+                                  MAX_HTTP_RESPONSE_SIZE)
 
   return resp
 
 
+def _read_capped(resp, max_size):
+  """Reads a streamed response's body, up to a maximum size.
+
+  If the body fits, stores it in the response so that
+  :attr:`requests.Response.content` and :attr:`requests.Response.text` work as
+  usual. If it doesn't, stops reading and closes the response. Under URLFetch
+  the body is already fully fetched, so this truncates it rather than stopping
+  the download.
+
+  Args:
+    resp: :class:`requests.Response`, fetched with stream=True
+    max_size: integer, in bytes
+
+  Returns:
+    boolean, True if the body fit, False if it was too big
+  """
+  if resp._content is not False:
+    # already read
+    return len(resp._content or b'') <= max_size
+
+  chunks = []
+  size = 0
+  for chunk in resp.iter_content(HTTP_RESPONSE_CHUNK_SIZE):
+    size += len(chunk)
+    if size > max_size:
+      logging.info('%s is over our limit of %s bytes; aborting', resp.url,
+                   max_size)
+      resp.close()
+      return False
+    chunks.append(chunk)
+
+  resp._content = b''.join(chunks)
+  resp._content_consumed = True
+  return True
+
+
+class FetchedUrl(StringIdModel):
+  """What we extracted the last time we fetched and processed a URL.
+
+  Key id is URL. Also stores the response's HTTP validators and a hash of its
+  body so that we can tell when it changes. See :func:`requests_get_if_changed`.
+  """
+  etag = ndb.StringProperty(indexed=False)
+  last_modified = ndb.StringProperty(indexed=False)
+  body_hash = ndb.StringProperty(indexed=False)
+  data = ndb.JsonProperty(compressed=True)
+  fetched = ndb.DateTimeProperty()
+
+  # after this long, ignore it and process the URL from scratch
+  EXPIRATION = datetime.timedelta(days=7)
+
+  @staticmethod
+  def body_hash_of(resp):
+    """Returns a hex hash of a :class:`requests.Response`'s body."""
+    return hashlib.sha1(resp.text.encode('utf-8')).hexdigest()
+
+  @classmethod
+  def from_response(cls, url, resp, data):
+    """Returns a new, unsaved :class:`FetchedUrl`, or None if url is too long.
+
+    Args:
+      url: string
+      resp: :class:`requests.Response`
+      data: JSON-serializable value extracted from resp
+    """
+    if len(url) > _MAX_KEYPART_BYTES:
+      return None
+    return cls(id=url, etag=resp.headers.get('ETag'),
+               last_modified=resp.headers.get('Last-Modified'),
+               body_hash=cls.body_hash_of(resp), data=data, fetched=now_fn())
+
+
+def requests_get_if_changed(url, **kwargs):
+  """Fetches a URL, checking whether it's changed since we stored it.
+
+  If we have an unexpired :class:`FetchedUrl` for url, sends its validators in
+  If-None-Match and If-Modified-Since. If the server returns 304, or the same
+  body as last time, the URL is unchanged, and you can use the
+  :attr:`FetchedUrl.data` you extracted and stored last time instead of
+  processing the response again.
+
+  Store new data with :meth:`FetchedUrl.from_response`.
+
+  Args:
+    url: string
+    kwargs: passed through to :func:`requests_get`
+
+  Returns:
+    (:class:`requests.Response`, :class:`FetchedUrl`) tuple. The
+    :class:`FetchedUrl` is None unless url is unchanged.
+  """
+  fetched = (FetchedUrl.get_by_id(url) if len(url) <= _MAX_KEYPART_BYTES
+             else None)
+  if fetched and (fetched.data is None or not fetched.fetched or
+                  now_fn() - fetched.fetched > FetchedUrl.EXPIRATION):
+    fetched = None
+
+  headers = kwargs.setdefault('headers', {})
+  if fetched and fetched.etag:
+    headers['If-None-Match'] = fetched.etag
+  if fetched and fetched.last_modified:
+    headers['If-Modified-Since'] = fetched.last_modified
+
+  resp = requests_get(url, **kwargs)
+  if fetched and (resp.status_code == 304 or
+                  (resp.ok and FetchedUrl.body_hash_of(resp) == fetched.body_hash)):
+    logging.info('%s is unchanged since %s', url, fetched.fetched)
+    return resp, fetched
+
+  return resp, None
+
+
 def requests_post(url, **kwargs):
   """Wraps :func:`requests.get` with our user agent."""
   kwargs.setdefault('headers', {}).update(request_headers(url=url))
@@ -240,7 +774,8 @@ def request_headers(url=None, source=None):
   return REQUEST_HEADERS
 
 
-def get_webmention_target(url, resolve=True, replace_test_domains=True):
+def get_webmention_target(url, resolve=True, replace_test_domains=True,
+                          _resolved=None):
   """Resolves a URL and decides whether we should try to send it a webmention.
 
   Note that this ignores failed HTTP requests, ie the boolean in the returned
@@ -250,6 +785,9 @@ def get_webmention_target(url, resolve=True, replace_test_domains=True):
     url: string
     resolve: whether to follow redirects
     replace_test_domains: whether to replace test user domains with localhost
+    _resolved: :class:`requests.Response` that :func:`follow_redirects`
+      already returned for url. Internal, used by
+      :func:`get_webmention_targets`.
 
   Returns:
     (string url, string pretty domain, boolean) tuple. The boolean is
@@ -265,8 +803,10 @@ def get_webmention_target(url, resolve=True, replace_test_domains=True):
 
   send = True
   if resolve:
-    # this follows *all* redirects, until the end
-    resolved = follow_redirects(url, cache=memcache)
+    # this follows *all* redirects, until the end. don't use `or` here since a
+    # failed Response is falsy.
+    resolved = (_resolved if _resolved is not None
+                else redirect_cache.resolve(url))
     html = resolved.headers.get('content-type', '').startswith('text/html')
     length = resolved.headers.get('Content-Length', 0)
     too_big = util.is_int(length) and int(length) > MAX_HTTP_RESPONSE_SIZE
@@ -280,6 +820,33 @@ def get_webmention_target(url, resolve=True, replace_test_domains=True):
   return url, domain, send
 
 
+def get_webmention_targets(urls, resolve=True, replace_test_domains=True):
+  """Batch version of :func:`get_webmention_target`.
+
+  Dedupes urls and resolves them all at once with
+  :meth:`RedirectCache.resolve_multi`.
+
+  Args:
+    urls: sequence of strings
+    resolve: whether to follow redirects
+    replace_test_domains: whether to replace test user domains with localhost
+
+  Returns:
+    list of (string url, string pretty domain, boolean) tuples, in the same
+    order as urls. See :func:`get_webmention_target`.
+  """
+  urls = list(urls)
+  unique = list(collections.OrderedDict.fromkeys(urls))
+  cleaned = {url: util.clean_url(url) for url in unique}
+  resolved = redirect_cache.resolve_multi(cleaned.values()) if resolve else {}
+
+  targets = {url: get_webmention_target(
+               url, resolve=resolve, replace_test_domains=replace_test_domains,
+               _resolved=resolved.get(cleaned[url]))
+             for url in unique}
+  return [targets[url] for url in urls]
+
+
 def in_webmention_blacklist(domain):
   """Returns True if the domain or its root domain is in BLACKLIST."""
   return util.domain_or_parent_in(domain.lower(), BLACKLIST)
@@ -334,6 +901,29 @@ def prune_response(response):
   return trim_nulls({k: v for k, v in response.items() if k not in drop})
 
 
+def activity_fingerprint(activity):
+  """Returns a short, stable hash of an activity's or response's content.
+
+  Only includes the fields that :meth:`granary.source.Source.activity_changed`
+  compares, ie :const:`ACTIVITY_CHANGED_FIELDS`, so two activities have the
+  same fingerprint iff activity_changed() would say they're the same, modulo
+  empty values, which are ignored.
+
+  Args:
+    activity: ActivityStreams activity or object dict
+
+  Returns:
+    string
+  """
+  obj = activity.get('object') or {}
+  fields = {
+    'activity': {f: activity.get(f) for f in ACTIVITY_CHANGED_FIELDS},
+    'object': {f: obj.get(f) for f in ACTIVITY_CHANGED_FIELDS},
+  }
+  canonical = json.dumps(trim_nulls(fields), sort_keys=True)
+  return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+
+
 def replace_test_domains_with_localhost(url):
   """Replace domains in LOCALHOST_TEST_DOMAINS with localhost for local
   testing when in DEBUG mode.
@@ -648,6 +1238,210 @@ class CachedPage(StringIdModel):
     CachedPage(id=path).key.delete()
 
 
+class TokenBucket(object):
+  """A token bucket rate limiter, shared across instances via memcache.
+
+  Holds up to capacity tokens and refills them evenly over period. It can also
+  be paused until a given time, e.g. when a silo tells us when its rate limit
+  resets. Without a capacity, it only pauses.
+
+  Best effort: if memcache evicts a bucket, it starts over full, and if
+  concurrent updates keep conflicting, :meth:`take` lets the caller through.
+  """
+
+  def __init__(self, name, capacity=None, period=None):
+    """Args:
+      name: string, unique name for this bucket
+      capacity: integer, or None for no limit
+      period: :class:`datetime.timedelta`, how long capacity tokens take to
+        refill. Required if capacity is set.
+    """
+    assert not capacity or period
+    self.key = 'RL ' + name
+    self.capacity = capacity
+    self.period = period
+
+  def take(self):
+    """Takes a token if one is available.
+
+    Returns:
+      :class:`datetime.timedelta`, zero if a token was taken, otherwise how
+      long until one will be available
+    """
+    def take(state, now):
+      paused_until = state.get('paused_until')
+      if paused_until and now < paused_until:
+        return None, paused_until - now
+      elif not self.capacity:
+        return None, datetime.timedelta(0)
+
+      rate = self.capacity / self.period.total_seconds()  # tokens per second
+      elapsed = (now - state.get('updated', now)).total_seconds()
+      tokens = min(self.capacity, state.get('tokens', self.capacity) + elapsed * rate)
+      if tokens < 1:
+        return None, datetime.timedelta(seconds=(1 - tokens) / rate)
+
+      state.update({'tokens': tokens - 1, 'updated': now})
+      return state, datetime.timedelta(0)
+
+    return self._update(take) or datetime.timedelta(0)
+
+  def pause_until(self, until):
+    """Makes :meth:`take` refuse all tokens until the given time.
+
+    Args:
+      until: :class:`datetime.datetime`
+    """
+    def pause(state, now):
+      paused_until = state.get('paused_until')
+      if paused_until and paused_until >= until:
+        return None, None
+      state['paused_until'] = until
+      return state, None
+
+    self._update(pause)
+
+  def _update(self, fn):
+    """Atomically reads, modifies, and writes this bucket's state.
+
+    Args:
+      fn: callable that takes (state dict, :class:`datetime.datetime` now) and
+        returns (new state dict or None to leave it unchanged, result)
+
+    Returns:
+      fn's result, or None if the write kept conflicting
+    """
+    client = memcache.Client()
+    for _ in range(TOKEN_BUCKET_CAS_RETRIES):
+      state = client.gets(self.key)
+      new_state, result = fn(dict(state or {}), now_fn())
+      if (new_state is None or
+          (client.cas(self.key, new_state) if state is not None
+           else client.add(self.key, new_state))):
+        return result
+
+    logging.warning('Giving up on updating rate limit bucket %s', self.key)
+    return None
+
+
+class HostLimiter(object):
+  """Politeness limits for our outbound requests to a single host.
+
+  Caps the request rate with a :class:`TokenBucket`, caps the number of
+  requests in flight with a memcache counter, and backs off exponentially from
+  hosts that are failing. All of these are shared across instances.
+
+  Usage::
+
+    limiter = HostLimiter(domain)
+    delay = limiter.acquire()
+    if delay:
+      ...try again after delay...
+    else:
+      try:
+        ...make request...
+      finally:
+        limiter.release()
+  """
+  RATE = (5, datetime.timedelta(seconds=10))  # (requests, period)
+  MAX_CONCURRENT = 2
+  # how long to wait before trying again when MAX_CONCURRENT are in flight
+  CONCURRENT_DELAY = datetime.timedelta(seconds=30)
+  # the in flight counter resets this often, in case a request dies without
+  # calling release()
+  CONCURRENT_EXPIRATION = datetime.timedelta(minutes=12)
+  MIN_BACKOFF = datetime.timedelta(minutes=1)
+  MAX_BACKOFF = datetime.timedelta(hours=1)
+
+  def __init__(self, domain):
+    self.domain = domain
+    self.bucket = TokenBucket('host %s' % domain, *self.RATE)
+    self.active_key = 'HA ' + domain
+    self.failures_key = 'HF ' + domain
+
+  def acquire(self):
+    """Tries to start a request to this host.
+
+    Returns:
+      :class:`datetime.timedelta`, zero if the caller may make the request and
+      must call :meth:`release` afterward. Otherwise, how long to wait before
+      trying again.
+    """
+    delay = self.bucket.take()
+    if delay:
+      return delay
+
+    memcache.add(self.active_key, 0,
+                 time=int(self.CONCURRENT_EXPIRATION.total_seconds()))
+    active = memcache.incr(self.active_key, initial_value=0)
+    if active > self.MAX_CONCURRENT:
+      memcache.decr(self.active_key)
+      return self.CONCURRENT_DELAY
+
+    return datetime.timedelta(0)
+
+  def release(self):
+    """Finishes a request started with :meth:`acquire`."""
+    memcache.decr(self.active_key)
+
+  def record_success(self):
+    """Resets this host's backoff."""
+    memcache.delete(self.failures_key)
+
+  def record_failure(self):
+    """Backs off from this host, doubling the backoff with each failure in a row.
+
+    Returns:
+      :class:`datetime.timedelta`, the backoff
+    """
+    failures = memcache.incr(self.failures_key, initial_value=0) or 1
+    backoff = min(self.MIN_BACKOFF * 2 ** min(failures - 1, 16), self.MAX_BACKOFF)
+    logging.info('Backing off from %s for %s after %s failure(s)',
+                 self.domain, backoff, failures)
+    self.bucket.pause_until(now_fn() + backoff)
+    return backoff
+
+
+def rate_limit_reset(exception):
+  """Returns when a silo rate limit resets, based on its HTTP response headers.
+
+  Understands Retry-After, in seconds or as an HTTP date, and X-Rate-Limit-Reset
+  and X-RateLimit-Reset, in UTC seconds since the epoch, e.g. Twitter and
+  GitHub.
+
+  Args:
+    exception: the exception raised by the rate limited HTTP request
+
+  Returns:
+    :class:`datetime.datetime`, or None if it's unknown
+  """
+  if isinstance(exception, urllib2.HTTPError):
+    headers = exception.info()
+  elif isinstance(exception, requests.HTTPError):
+    headers = getattr(exception.response, 'headers', None)
+  else:
+    headers = getattr(exception, 'resp', None)  # apiclient.errors.HttpError
+  if not headers:
+    return None
+
+  headers = {name.lower(): val for name, val in headers.items()}
+  retry_after = headers.get('retry-after')
+  reset = headers.get('x-rate-limit-reset') or headers.get('x-ratelimit-reset')
+  try:
+    if retry_after:
+      if retry_after.isdigit():
+        return now_fn() + datetime.timedelta(seconds=int(retry_after))
+      parsed = email.utils.parsedate_tz(retry_after)
+      if parsed:
+        return datetime.datetime.utcfromtimestamp(email.utils.mktime_tz(parsed))
+    if reset:
+      return datetime.datetime.utcfromtimestamp(int(reset))
+  except (ValueError, OverflowError):
+    logging.info("Couldn't parse rate limit headers %s", headers, exc_info=True)
+
+  return None
+
+
 def unwrap_t_umblr_com(url):
   """If url is a t.umblr.com short link, extract its destination URL.
 
@@ -707,3 +1501,50 @@ def mf2py_parse(input, url):
   # instrumenting, disabled for now:
   # with cache_time('mf2py', 1):
   return mf2py.parse(url=url, doc=input, img_with_alt=True)
+
+
+class ParsedDocument(object):
+  """An HTML document that's parsed lazily, at most once per parser.
+
+  Pass one of these around instead of raw HTML so that code that needs the
+  BeautifulSoup tree, the mf2, or the rels all share the same parse.
+
+  Attributes:
+    html: unicode string, or bytes to let BeautifulSoup detect the encoding
+    url: string, the document's URL, used to resolve relative URLs in mf2
+  """
+
+  def __init__(self, html, url):
+    self.html = html
+    self.url = url
+    self._soup = None
+    self._mf2 = None
+
+  @classmethod
+  def from_response(cls, resp):
+    """Returns a :class:`ParsedDocument` for a :class:`requests.Response`."""
+    # .text is decoded unicode string, .content is raw bytes. if the HTTP
+    # headers didn't specify a charset, pass raw bytes to BeautifulSoup so it
+    # can look for a <meta> tag with a charset and decode.
+    html = (resp.text if 'charset' in resp.headers.get('content-type', '')
+            else resp.content)
+    return cls(html, resp.url)
+
+  @property
+  def soup(self):
+    """The :class:`bs4.BeautifulSoup` tree."""
+    if self._soup is None:
+      self._soup = beautifulsoup_parse(self.html)
+    return self._soup
+
+  @property
+  def mf2(self):
+    """The mf2py parsed dict."""
+    if self._mf2 is None:
+      self._mf2 = mf2py_parse(self.soup, self.url)
+    return self._mf2
+
+  @property
+  def rels(self):
+    """The mf2py rels dict, mapping string rel value to list of URLs."""
+    return self.mf2.get('rels', {})
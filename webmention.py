@@ -41,15 +41,18 @@ class WebmentionHandler(WebmentionGetHandler):
   * source: the :class:`models.Source` for this webmention
   * entity: the :class:`models.Publish` or :class:`models.Webmention` entity for
     this webmention
+  * doc: :class:`util.ParsedDocument` for the page that :meth:`fetch_mf2`
+    fetched
   """
   source = None
   entity = None
+  doc = None
 
   def fetch_mf2(self, url, require_mf2=True, raise_errors=False):
     """Fetches a URL and extracts its mf2 data.
 
-    Side effects: sets :attr:`entity`\ .html on success, calls :attr:`error()`
-    on errors.
+    Side effects: sets :attr:`doc` and :attr:`entity`\ .html on success,
+    calls :attr:`error()` on errors.
 
     Args:
       url: string
@@ -72,15 +75,11 @@ class WebmentionHandler(WebmentionGetHandler):
     if self.entity:
       self.entity.html = fetched.text
 
-    # .text is decoded unicode string, .content is raw bytes. if the HTTP
-    # headers didn't specify a charset, pass raw bytes to BeautifulSoup so it
-    # can look for a <meta> tag with a charset and decode.
-    text = (fetched.text if 'charset' in fetched.headers.get('content-type', '')
-            else fetched.content)
-    doc = util.beautifulsoup_parse(text)
+    self.doc = util.ParsedDocument.from_response(fetched)
+    doc = self.doc.soup
 
     # parse microformats
-    data = util.mf2py_parse(doc, fetched.url)
+    data = self.doc.mf2
 
     # special case tumblr's markup: div#content > div.post > div.copy
     # convert to mf2 and re-parse
@@ -0,0 +1,240 @@
+"""WebSub subscriptions to users' h-feeds, for original post discovery.
+
+When original post discovery finds a WebSub hub for one of a beta user's
+h-feeds, we subscribe to it. Each author URL has its own subscription, stored in
+:attr:`models.Source.websub_subscriptions_json`. When a hub notifies us that an
+h-feed changed, we refetch on the source's next poll. While we're subscribed to
+all of them, we only refetch blindly every :attr:`models.Source.WEBSUB_REFETCH`,
+as a fallback. See :meth:`models.Source.should_refetch`.
+
+https://www.w3.org/TR/websub/
+"""
+from __future__ import unicode_literals
+
+import datetime
+import hashlib
+import hmac
+import logging
+import urlparse
+
+import appengine_config
+from google.appengine.ext import ndb
+import webapp2
+
+import models
+import util
+
+# import source model class definitions so that models.sources has them
+import blogger
+import facebook
+import flickr
+import github
+import instagram
+import medium
+import tumblr
+import twitter
+import wordpress_rest
+
+# how long we ask hubs to keep our subscriptions
+LEASE = datetime.timedelta(days=10)
+# renew subscriptions this long before they expire. also, if a hub hasn't
+# verified a subscription request after this long, send it again.
+RENEW_BEFORE = datetime.timedelta(days=1)
+# hubs call us back here, so use localhost in dev_appserver. that lets you test
+# against a local hub.
+CALLBACK_HOST_URL = ('http://localhost:8080' if appengine_config.DEBUG
+                     else util.HOST_URL)
+SIGNATURE_METHODS = ('sha1', 'sha256', 'sha384', 'sha512')
+
+
+def discover(resp, doc):
+  """Finds the WebSub hub and topic for a fetched page.
+
+  Looks in Link headers first, then in the page's rel links. The topic defaults
+  to the page's own URL.
+
+  https://www.w3.org/TR/websub/#discovery
+
+  Args:
+    resp: :class:`requests.Response`
+    doc: :class:`util.ParsedDocument` for resp
+
+  Returns:
+    (string hub URL, string topic URL) tuple, or (None, None) if there's no hub
+  """
+  def first(rel):
+    url = resp.links.get(rel, {}).get('url')
+    if url:
+      return urlparse.urljoin(doc.url, url)
+    urls = doc.rels.get(rel)
+    return urls[0] if urls else None
+
+  hub = first('hub')
+  if not hub:
+    return None, None
+  return hub, first('self') or doc.url
+
+
+def subscribe(source, author_url, hub, topic):
+  """Subscribes a source to a topic on a hub, unless it's already subscribed.
+
+  Replaces any other subscription for the same author URL, e.g. if its hub or
+  topic changed.
+
+  The hub verifies the request asynchronously by calling
+  :class:`CallbackHandler`, so we store the subscription in the source
+  directly, not in source.updates, before we send it.
+
+  Args:
+    source: :class:`models.Source`
+    author_url: string URL whose h-feed this is
+    hub: string URL
+    topic: string URL
+  """
+  now = util.now_fn()
+  existing = source.websub_subscriptions().get(topic)
+  if existing and existing[:2] == (author_url, hub):
+    _, _, requested, expires = existing
+    if requested and now - requested < RENEW_BEFORE:
+      return  # we just asked
+    elif expires and expires - RENEW_BEFORE > now:
+      return  # still subscribed
+  else:
+    expires = None
+
+  _store_subscription(source, topic, (author_url, hub, now, expires))
+
+  data = {
+    'hub.mode': 'subscribe',
+    'hub.topic': topic,
+    'hub.callback': '%s/websub/%s/%s' % (
+      CALLBACK_HOST_URL, source.SHORT_NAME, source.key.id()),
+    'hub.secret': source.websub_secret,
+    'hub.lease_seconds': int(LEASE.total_seconds()),
+  }
+  logging.info('Subscribing to WebSub hub %s: %s', hub, data)
+  try:
+    resp = util.requests_post(hub, data=data)
+    resp.raise_for_status()
+  except AssertionError:
+    raise  # for unit tests
+  except BaseException as e:
+    util.interpret_http_exception(e)  # log exception
+    logging.info("Couldn't subscribe; will try again in %s", RENEW_BEFORE)
+
+
+@ndb.transactional
+def _store_subscription(source, topic, subscription):
+  """Stores one of a source's subscriptions transactionally.
+
+  Drops any other subscription for the same author URL, and generates the
+  source's secret if it doesn't have one yet. Updates source too.
+
+  Args:
+    source: :class:`models.Source`
+    topic: string URL
+    subscription: tuple, same format as the values that
+      :meth:`models.Source.websub_subscriptions` returns
+  """
+  stored = source.key.get()
+  if not stored.websub_secret:
+    stored.websub_secret = util.generate_secret()
+  source.websub_secret = stored.websub_secret
+
+  for entity in source, stored:
+    subscriptions = {t: sub for t, sub in entity.websub_subscriptions().items()
+                     if sub[0] != subscription[0]}
+    subscriptions[topic] = subscription
+    entity.set_websub_subscriptions(subscriptions)
+
+  stored.put()
+
+
+@ndb.transactional
+def _update(source, **props):
+  """Sets property values on a source and stores them transactionally.
+
+  Args:
+    source: :class:`models.Source`
+    props: property names and values
+  """
+  source.populate(**props)
+  stored = source.key.get()
+  stored.populate(**props)
+  stored.put()
+
+
+class CallbackHandler(util.Handler):
+  """Handles WebSub hub requests for a source.
+
+  Path is /websub/SOURCE_SHORT_NAME/SOURCE_ID.
+  """
+
+  def load_subscribed_source(self, short_name, id):
+    source_cls = models.sources.get(short_name)
+    source = source_cls.get_by_id(id) if source_cls else None
+    if not source or not source.websub_subscriptions():
+      self.abort(404, 'No WebSub subscription for %s %s' % (short_name, id))
+    return source
+
+  def get(self, short_name, id):
+    """Verifies a subscription.
+
+    https://www.w3.org/TR/websub/#hub-verifies-intent
+    """
+    source = self.load_subscribed_source(short_name, id)
+    mode = self.request.get('hub.mode')
+    topic = self.request.get('hub.topic')
+    subscription = source.websub_subscriptions().get(topic)
+
+    if mode == 'denied':
+      logging.warning('WebSub hub denied subscription to %s: %s', topic,
+                      self.request.get('hub.reason'))
+      return
+    elif mode != 'subscribe' or not subscription:
+      self.abort(404, "We didn't ask to %s to %s" % (mode, topic))
+
+    lease = self.request.get('hub.lease_seconds')
+    lease = (datetime.timedelta(seconds=int(lease)) if util.is_int(lease)
+             else LEASE)
+    author_url, hub, requested, _ = subscription
+    expires = util.now_fn() + lease
+    _store_subscription(source, topic, (author_url, hub, requested, expires))
+    logging.info('Subscribed to %s until %s', topic, expires)
+
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write(self.request.get('hub.challenge'))
+
+  def post(self, short_name, id):
+    """Handles a notification that the h-feed changed.
+
+    Triggers an h-feed refetch on the source's next poll. Per the spec, responds
+    with 200 even if the signature is invalid, but ignores the notification.
+
+    https://www.w3.org/TR/websub/#content-distribution
+    """
+    source = self.load_subscribed_source(short_name, id)
+
+    method, _, signature = self.request.headers.get(
+      'X-Hub-Signature', '').partition('=')
+    if method not in SIGNATURE_METHODS or not source.websub_secret:
+      logging.warning('Ignoring notification without a valid signature')
+      return
+    expected = hmac.new(source.websub_secret.encode('utf-8'), self.request.body,
+                        getattr(hashlib, method)).hexdigest()
+    if not hmac.compare_digest(expected, str(signature)):
+      logging.warning('Ignoring notification with wrong signature')
+      return
+
+    if source.status != 'enabled' or 'listen' not in source.features:
+      logging.info('Dropping because source is %s with features %s',
+                   source.status, source.features)
+      return
+
+    logging.info('h-feed changed; refetching on the next poll')
+    _update(source, last_hfeed_refetch=models.REFETCH_HFEED_TRIGGER)
+
+
+application = webapp2.WSGIApplication([
+  ('/websub/([^/]+)/(.+)', CallbackHandler),
+], debug=appengine_config.DEBUG)